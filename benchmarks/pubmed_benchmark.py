@@ -0,0 +1,285 @@
+"""Offline benchmark of the PubMed text processing pipeline.
+
+Generates a synthetic PubMed-like corpus (abstract text and baseline XML
+files) and measures the throughput (documents and MB per second) and the
+peak resident memory of each stage: gtbtokenize.tokenize (fast and
+reference cores), pubmed_parser.normalize, pubmed_parser.parse and
+pubmed_parser.generate_dict. Each stage runs in a fresh process, so that
+its peak memory is not inflated by the other stages.
+
+Results are saved as JSON and can be compared against the results of a
+previous (baseline) run to catch throughput regressions.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+sys.path.append(os.path.join(parentdir, "pubmed_retrieval"))
+
+WORDS = ["the", "of", "and", "in", "to", "a", "with", "for", "was", "were", "patients", "cells", "expression",
+         "protein", "treatment", "study", "results", "increased", "associated", "analysis", "clinical",
+         "significantly", "receptor", "activity", "gene", "levels", "response", "tumor", "mice", "disease",
+         "effect", "induced", "compared", "risk", "therapy", "acute", "chronic", "binding", "signaling",
+         "inhibition", "mutation", "dose", "group", "cohort", "survival", "infection", "pathway", "model"]
+# tokens exercising the tokenization rules: brackets, quotes, contractions,
+# operators, abbreviations and non-ASCII characters
+SPECIAL = ["(IL-2)", "(n = 125)", "[95% CI, 1.2-3.4]", "{ref}", "beta-(1,3)-glucan", "CD34(+)", "p65(RelA)/p50",
+           "(+)-pentazocine", "E. coli", "5'-UTR", "3' end", "patients'", "don't", "can't", "it's", "cannot",
+           "\"novel\"", "'single'", "p < 0.05", "p<0.001", ">10", "-->", "</=", "50%", "$200", "R&D", "e.g.,",
+           "i.e.;", "vs.", "...", "--", "α-helix", "β-catenin", "naïve", "Müller", "≥ 18", "±", "µg/ml", "IL-6?",
+           "TNF-α!", "(i.e., [Ca2+])"]
+MESH = ["Humans", "Female", "Male", "Adult", "Mice", "Neoplasms", "Signal Transduction", "Risk Factors"]
+
+
+def synthetic_sentence(rng):
+    words = []
+    for i in range(rng.randint(8, 25)):
+        words.append(rng.choice(SPECIAL) if rng.random() < 0.12 else rng.choice(WORDS))
+    words[0] = words[0].capitalize()
+    return " ".join(words) + rng.choice([".", ".", ".", "?", ";", ":"])
+
+
+def synthetic_title(rng):
+    return synthetic_sentence(rng)[:-1]
+
+
+def synthetic_abstract(rng):
+    return " ".join(synthetic_sentence(rng) for i in range(rng.randint(5, 12)))
+
+
+def synthetic_texts(n_docs, seed=0):
+    rng = random.Random(seed)
+    return [synthetic_abstract(rng) for i in range(n_docs)]
+
+
+def xml_escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def write_synthetic_xml(file_path, n_docs, seed=0, start_pmid=1):
+    """Writes a PubMed baseline-like XML file with n_docs articles, some
+    without abstract (which the parser skips) and some deleted citations"""
+    rng = random.Random(seed)
+    with open(file_path, "w", encoding="utf-8") as xml_file:
+        xml_file.write('<?xml version="1.0" ?>\n<PubmedArticleSet>\n')
+        for pmid in range(start_pmid, start_pmid + n_docs):
+            abstract = ""
+            if rng.random() > 0.1:
+                abstract = "<Abstract><AbstractText>%s</AbstractText></Abstract>" % xml_escape(
+                    synthetic_abstract(rng))
+            mesh = "".join(
+                '<MeshHeading><DescriptorName UI="D%06d" MajorTopicYN="N">%s</DescriptorName>'
+                '<QualifierName UI="Q%06d" MajorTopicYN="Y">metabolism</QualifierName></MeshHeading>' % (
+                    rng.randint(1, 999999), rng.choice(MESH), rng.randint(1, 999))
+                for i in range(rng.randint(1, 8)))
+            xml_file.write(
+                '<PubmedArticle><MedlineCitation Status="MEDLINE"><PMID Version="1">%d</PMID>'
+                '<Article><ArticleTitle>%s</ArticleTitle>%s</Article>'
+                '<MeshHeadingList>%s</MeshHeadingList></MedlineCitation></PubmedArticle>\n' % (
+                    pmid, xml_escape(synthetic_title(rng)), abstract, mesh))
+            if pmid % 100 == 0:
+                xml_file.write('<DeleteCitation><PMID Version="1">%d</PMID></DeleteCitation>\n' % (pmid + 10 ** 8))
+        xml_file.write('</PubmedArticleSet>\n')
+
+
+def peak_rss_mb():
+    """Peak resident memory of the current process in MB. On Linux this is
+    read from /proc, as getrusage also counts the memory of the parent
+    process at the time this process was started"""
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024.0, 1)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return round(peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0), 1)
+
+
+def bench_tokenize(config, fast=True):
+    from utilities import gtbtokenize
+    gtbtokenize.USE_FAST_TOKENIZATION = fast
+    texts = synthetic_texts(config["docs"], seed=config["seed"])
+    start = time.time()
+    for text in texts:
+        gtbtokenize.tokenize(text)
+    return len(texts), sum(len(k.encode("utf-8")) for k in texts), time.time() - start
+
+
+def bench_tokenize_reference(config):
+    return bench_tokenize(config, fast=False)
+
+
+def bench_normalize(config):
+    import pubmed_parser
+    texts = synthetic_texts(config["docs"], seed=config["seed"])
+    start = time.time()
+    for text in texts:
+        pubmed_parser.normalize(text)
+    return len(texts), sum(len(k.encode("utf-8")) for k in texts), time.time() - start
+
+
+def bench_parse(config):
+    import pubmed_parser
+    xml_files = sorted(k for k in os.listdir(config["xml_folder"]) if pubmed_parser.is_pubmed_xml(k))
+    docs, size = 0, 0
+    start = time.time()
+    for k in xml_files:
+        with contextlib.redirect_stdout(io.StringIO()):
+            found, extracted = pubmed_parser.parse(config["xml_folder"] + k, out_format=config["format"])
+        docs += found
+        size += os.path.getsize(config["xml_folder"] + k)
+    return docs, size, time.time() - start
+
+
+def bench_generate(config):
+    import pubmed_parser
+    parsed_files = [k for k in os.listdir(config["parsed_folder"]) if pubmed_parser.is_parsed_file(k, config["format"])]
+    docs = sum(pubmed_parser.read_parsed(config["parsed_folder"] + k, columns=["title"]).shape[0]
+               for k in parsed_files)
+    size = sum(os.path.getsize(config["parsed_folder"] + k) for k in parsed_files)
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        pubmed_parser.generate_dict(config["parsed_folder"], in_format=config["format"], workers=config["workers"])
+    return docs, size, time.time() - start
+
+
+STAGES = {"tokenize": bench_tokenize,
+          "tokenize_reference": bench_tokenize_reference,
+          "normalize": bench_normalize,
+          "parse": bench_parse,
+          "generate": bench_generate}
+
+
+def run_stage(stage, config):
+    docs, size, seconds = STAGES[stage](config)
+    seconds = max(seconds, 1e-9)
+    return {"docs": docs,
+            "mb": round(size / (1024.0 * 1024.0), 3),
+            "seconds": round(seconds, 3),
+            "docs_per_sec": round(docs / seconds, 1),
+            "mb_per_sec": round(size / (1024.0 * 1024.0) / seconds, 3),
+            "peak_rss_mb": peak_rss_mb()}
+
+
+def run_benchmarks(config, stages):
+    """Runs each stage in a fresh process, returns the results by stage"""
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for stage in stages:
+        with context.Pool(1) as pool:
+            results[stage] = pool.apply(run_stage, (stage, config))
+        print("%-20s %10.1f docs/s %8.3f MB/s %8s MB peak RSS" % (
+            stage, results[stage]["docs_per_sec"], results[stage]["mb_per_sec"], results[stage]["peak_rss_mb"]))
+    return results
+
+
+def compare_results(results, baseline, tolerance=0.1):
+    """Prints the throughput of each stage relative to the baseline, returns
+    the stages that are slower than the baseline by more than tolerance"""
+    regressions = []
+    print("--------------------")
+    print("%-20s %12s %12s %8s" % ("stage", "docs/s", "baseline", "ratio"))
+    for stage in results:
+        if stage not in baseline:
+            continue
+        current, previous = results[stage]["docs_per_sec"], baseline[stage]["docs_per_sec"]
+        ratio = current / previous if previous > 0 else float("inf")
+        flag = ""
+        if ratio < 1 - tolerance:
+            regressions.append(stage)
+            flag = "REGRESSION"
+        print("%-20s %12.1f %12.1f %8.2f %s" % (stage, current, previous, ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__)
+    parser.add_argument("--docs", type=int, default=5000,
+                        help="number of synthetic abstracts for the tokenize/normalize stages")
+    parser.add_argument("--xmlfiles", type=int, default=2, help="number of synthetic XML files to parse")
+    parser.add_argument("--xmldocs", type=int, default=5000, help="number of articles per synthetic XML file")
+    parser.add_argument("--format", choices=["tsv", "parquet"], default="tsv",
+                        help="format of the parsed abstracts")
+    parser.add_argument("--workers", type=int, default=1, help="number of workers for the generate stage")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic corpus")
+    parser.add_argument("--stages", type=str, default=",".join(STAGES),
+                        help="comma-separated list of stages to run")
+    parser.add_argument("--output", type=str, default="benchmark_results.json",
+                        help="JSON file to save the results to")
+    parser.add_argument("--baseline", type=str, help="JSON results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative throughput drop reported as a regression")
+    args = parser.parse_args()
+
+    requested = [k.strip() for k in args.stages.split(",") if len(k.strip()) > 0]
+    unknown = [k for k in requested if k not in STAGES]
+    if len(unknown) > 0:
+        print("Unknown stages", unknown, ", available stages are", list(STAGES))
+        return 2
+    # stages run in pipeline order, generate reading the output of parse
+    stages = [k for k in STAGES if k in requested]
+
+    temp_folder = tempfile.mkdtemp(prefix="pubmed_benchmark_")
+    try:
+        config = {"docs": args.docs, "seed": args.seed, "format": args.format, "workers": args.workers,
+                  "xml_folder": os.path.join(temp_folder, "xml") + os.sep,
+                  "parsed_folder": os.path.join(temp_folder, "xml") + os.sep}
+        os.makedirs(config["xml_folder"])
+        if "parse" in stages or "generate" in stages:
+            print("Generating", args.xmlfiles, "synthetic XML files with", args.xmldocs, "articles each")
+            for i in range(args.xmlfiles):
+                write_synthetic_xml(config["xml_folder"] + "pubmed00n%04d.xml" % (i + 1), args.xmldocs,
+                                    seed=args.seed + i, start_pmid=i * args.xmldocs + 1)
+        if "generate" in stages and "parse" not in stages:
+            run_stage("parse", config)
+        print("--------------------")
+        results = run_benchmarks(config, stages)
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+
+    config = {k: config[k] for k in ["docs", "seed", "format", "workers"]}
+    config.update({"xmlfiles": args.xmlfiles, "xmldocs": args.xmldocs})
+    report = {"config": config,
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "cpus": os.cpu_count(),
+              "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "stages": results}
+    with open(args.output, "w") as out_file:
+        json.dump(report, out_file, indent=2)
+    print("Results saved to", args.output)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_results(results, baseline["stages"], tolerance=args.tolerance)
+        if len(regressions) > 0:
+            print("Throughput regressions found in", regressions)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+"""Offline benchmark of the UMLS extraction steps.
+
+Generates a synthetic UMLS Metathesaurus fixture (MRCONSO, MRSTY, MRHIER
+and MRREL RRF files) and times each step of umls_extractor.UMLSExtractor
+(concepts, alternate labels, semantic types, hierarchies, relations), for
+the baseline implementation of the extractor (before, read from a git
+revision or a file) and the current one (after). The extracts of both runs
+are checked to hold the same values.
+
+Results are saved as JSON.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import importlib.util
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(os.path.join(parentdir, "umls_knowledge_graph"))
+
+EXTRACTOR_PATH = "umls_knowledge_graph/umls_extractor.py"
+
+VOCABS = ["SNOMEDCT_US", "ICD10CM", "MSH", "RXNORM", "LNC", "MDR", "NCI", "MEDCPT"]
+# No words start with a double quote, which the baseline (reading the RRF files with
+# the default CSV quoting) strips
+WORDS = ["acute", "chronic", "pain", "fracture", "of", "left", "right", "femur", "disorder", "syndrome",
+         "type", "2", "diabetes", "mellitus", "finding\"s\"", "NA", "null", "[X]", "réflexe", "#1"]
+RELAS = ["", "", "finding_site_of", "has_finding_site", "may_treat", "may_be_treated_by", "associated_with",
+         "causative_agent_of", "has_causative_agent", "mapped_to"]
+STEPS = ["concepts", "alternate_labels", "semantic_types", "hierarchies", "relations"]
+
+
+def term_string(rng):
+    return " ".join(rng.choice(WORDS) for i in range(rng.randint(1, 5)))
+
+
+def write_synthetic_rrf(folder, n_cuis, seed=0):
+    """Writes MRCONSO, MRSTY, MRHIER and MRREL RRF files for n_cuis concepts,
+    with a mix of languages, suppressed terms and terminologies"""
+    rng = random.Random(seed)
+    auis = {}
+    aui_count = 0
+    with open(os.path.join(folder, "MRCONSO.RRF"), "w", encoding="utf-8") as rrf_file:
+        for c in range(n_cuis):
+            cui = "C%07d" % c
+            for i in range(rng.randint(1, 8)):
+                aui_count += 1
+                aui = "A%08d" % aui_count
+                sab = rng.choice(VOCABS)
+                lat = "ENG" if rng.random() < 0.7 else rng.choice(["FRE", "SPA", "GER"])
+                suppress = "N" if rng.random() < 0.9 else rng.choice(["O", "E", "Y"])
+                # Codes are numbers without leading zeros, which the baseline (inferring the
+                # column types) reads back unchanged
+                code = str(rng.randint(1, 10 ** 6))
+                auis.setdefault(sab, []).append((cui, aui))
+                rrf_file.write("|".join([cui, lat, rng.choice("PS"), "L%07d" % c, rng.choice(["PF", "VO"]),
+                                         "S%08d" % aui_count, rng.choice("YN"), aui, "", code, "", sab,
+                                         rng.choice(["PT", "SY", "FN", "PN"]), code, term_string(rng), "0",
+                                         suppress, "256", ""]) + "\n")
+    with open(os.path.join(folder, "MRSTY.RRF"), "w", encoding="utf-8") as rrf_file:
+        for c in range(n_cuis):
+            for i in range(rng.randint(1, 2)):
+                tui = rng.randint(1, 130)
+                rrf_file.write("|".join(["C%07d" % c, "T%03d" % tui, "B1.2.%d" % tui, "Semantic type %d" % tui,
+                                         "AT%08d" % rng.randint(1, 10 ** 7), "256", ""]) + "\n")
+    with open(os.path.join(folder, "MRHIER.RRF"), "w", encoding="utf-8") as rrf_file:
+        for sab in sorted(auis):
+            for cui, aui in auis[sab]:
+                for i in range(rng.randint(1, 3)):
+                    parent = rng.choice(auis[sab])[1]
+                    rrf_file.write("|".join([cui, aui, str(i + 1), parent, sab, rng.choice(["isa", ""]),
+                                             "A0000001.%s.%s" % (parent, parent), "", "", ""]) + "\n")
+    with open(os.path.join(folder, "MRREL.RRF"), "w", encoding="utf-8") as rrf_file:
+        for i in range(n_cuis * 10):
+            sab = rng.choice(VOCABS)
+            cui1, aui1 = rng.choice(auis[sab])
+            cui2, aui2 = rng.choice(auis[sab])
+            rrf_file.write("|".join([cui1, aui1, "AUI", rng.choice(["RO", "RB", "RN", "PAR", "CHD", "SY"]),
+                                     cui2, aui2, "AUI", rng.choice(RELAS), "R%09d" % i, "", sab, sab,
+                                     str(rng.randint(0, 3)), "Y", "N", "", ""]) + "\n")
+
+
+def load_baseline_extractor(baseline, temp_folder):
+    """Imports the umls_extractor module of a git revision (or of a file) as the baseline"""
+    if os.path.isfile(baseline):
+        module_path = baseline
+    else:
+        source = subprocess.check_output(["git", "show", "%s:%s" % (baseline, EXTRACTOR_PATH)], cwd=parentdir)
+        module_path = os.path.join(temp_folder, "baseline_umls_extractor.py")
+        with open(module_path, "wb") as module_file:
+            module_file.write(source)
+    spec = importlib.util.spec_from_file_location("baseline_umls_extractor", module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def first_revision():
+    # The first commit of the repository, the original implementation of the extractor
+    revisions = subprocess.check_output(["git", "rev-list", "--max-parents=0", "HEAD"], cwd=parentdir)
+    return revisions.decode().split()[-1]
+
+
+def run_steps(extractor):
+    """Runs the extraction steps, returns the time of each step and the extracts"""
+    steps = [("concepts", extractor.extract_umls_concepts, "selected_vocab_terms"),
+             ("alternate_labels", extractor.extract_alternate_labels, "alternate_labels"),
+             ("semantic_types", extractor.extract_semantic_types, "semantic_types"),
+             ("hierarchies", extractor.extract_hierarchies, "hierarchies"),
+             ("relations", extractor.extract_relations, "relations")]
+    timings, extracts = {}, {}
+    for step, method, attribute in steps:
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            method()
+        timings[step] = time.time() - start
+        extracts[step] = getattr(extractor, attribute)
+    return timings, extracts
+
+
+def same_values(before, after):
+    # The current extractor reads all the columns as strings (the code columns as categoricals)
+    # and the baseline infers their types, so the extracts are compared as strings
+    return list(before.columns) == list(after.columns) and \
+        before.astype(str).reset_index(drop=True).equals(after.astype(str).reset_index(drop=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__)
+    parser.add_argument("--cuis", type=int, default=50000, help="number of concepts in the synthetic fixture")
+    parser.add_argument("--terminologies", type=str, default="SNOMEDCT_US,ICD10CM",
+                        help="comma-separated list of allowed terminologies")
+    parser.add_argument("--chunksize", type=int, default=1000000, help="number of rows read at a time")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic fixture")
+    parser.add_argument("--baseline", type=str,
+                        help="git revision (or file) of the umls_extractor.py to compare against, "
+                             "the first commit of the repository by default")
+    parser.add_argument("--output", type=str, default="umls_benchmark_results.json",
+                        help="JSON file to save the results to")
+    args = parser.parse_args()
+    allowed_vocabs = [k.strip().upper() for k in args.terminologies.split(",") if len(k.strip()) > 0]
+    baseline = args.baseline if args.baseline else first_revision()
+
+    temp_folder = tempfile.mkdtemp(prefix="umls_benchmark_")
+    try:
+        umls_folder = temp_folder + os.sep
+        print("Generating a synthetic UMLS fixture with", args.cuis, "concepts")
+        write_synthetic_rrf(umls_folder, args.cuis, seed=args.seed)
+        sizes = dict([(k, round(os.path.getsize(umls_folder + k) / (1024.0 * 1024.0), 3))
+                      for k in sorted(os.listdir(umls_folder))])
+        print("Fixture sizes (MB):", sizes)
+        print("--------------------")
+        baseline_extractor = load_baseline_extractor(baseline, temp_folder)
+        import umls_extractor
+        before, before_extracts = run_steps(baseline_extractor.UMLSExtractor(
+            umls_folder=umls_folder, allowed_vocabs=list(allowed_vocabs)))
+        after, after_extracts = run_steps(umls_extractor.UMLSExtractor(
+            umls_folder=umls_folder, allowed_vocabs=list(allowed_vocabs), chunksize=args.chunksize))
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+
+    results = {}
+    mismatches = []
+    print("%-20s %10s %10s %8s %10s" % ("step", "before (s)", "after (s)", "speedup", "rows"))
+    for step in STEPS:
+        identical = same_values(before_extracts[step], after_extracts[step])
+        if not identical:
+            mismatches.append(step)
+        results[step] = {"before_seconds": round(before[step], 3),
+                         "after_seconds": round(after[step], 3),
+                         "speedup": round(before[step] / max(after[step], 1e-9), 2),
+                         "rows": after_extracts[step].shape[0],
+                         "identical": identical}
+        print("%-20s %10.3f %10.3f %8.2f %10d %s" % (step, before[step], after[step], results[step]["speedup"],
+                                                    results[step]["rows"], "" if identical else "MISMATCH"))
+
+    report = {"config": {"cuis": args.cuis, "terminologies": allowed_vocabs, "chunksize": args.chunksize,
+                         "seed": args.seed, "baseline": baseline},
+              "fixture_mb": sizes,
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "steps": results}
+    with open(args.output, "w") as out_file:
+        json.dump(report, out_file, indent=2)
+    print("Results saved to", args.output)
+
+    if len(mismatches) > 0:
+        print("Extracts differ between the baseline and the current extractor in", mismatches)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,545 @@
+""" On-disk BM25 inverted index of the parsed PubMed abstracts, with MeSH
+descriptor filters.
+
+The titles and abstracts are tokenized with pubmed_parser.normalize, as for the
+word frequencies. The index is a folder of segments, each built from a batch of
+parsed files: a segment keeps the PMIDs and lengths of its documents, and the
+postings of its terms and MeSH descriptors. Postings list the documents of a
+term in order, as variable-byte encoded gaps, with the term frequencies encoded
+the same way, and are decoded with numpy at query time. Terms are looked up by
+a binary search of their 64-bit hashes. All the arrays are memory-mapped, so an
+index opens instantly and only the postings of the query terms are read.
+
+New (e.g. daily update) files are indexed into new segments. A PMID indexed
+again replaces its earlier version, which is marked as deleted in its segment,
+and the terms of the deleted documents are taken off the live document
+frequencies of the segment, found with the terms of each document.
+"""
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from multiprocessing import Pool
+from scipy import sparse
+
+from pubmed_parser import normalize, document_term_matrix, read_parsed, is_parsed_file, OUTPUT_FORMATS
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(os.path.join(parentdir, "umls_knowledge_graph"))
+
+from label_index import label_hash, save_strings, MappedStrings
+
+# Version of the on-disk layout, checked when an index is opened
+BM25_INDEX_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+# Number of postings of a block, the unit of the postings decoded to score the candidate documents
+BLOCK_SIZE = 128
+
+
+def vbyte_encode(values):
+    """ Variable-byte encodes non-negative integers, 7 bits per byte with the high
+    bit set on all but the last byte of each integer. Returns the bytes and the
+    number of bytes of each integer"""
+    values = np.asarray(values, dtype=np.int64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 9):
+        n_bytes += values >= 1 << (7 * k)
+    ends = np.cumsum(n_bytes)
+    encoded = np.zeros(ends[-1] if len(values) > 0 else 0, dtype=np.uint8)
+    starts = ends - n_bytes
+    for k in range(n_bytes.max() if len(values) > 0 else 0):
+        selected = n_bytes > k
+        continued = np.where(n_bytes[selected] > k + 1, 128, 0)
+        encoded[starts[selected] + k] = (values[selected] >> (7 * k)) & 127 | continued
+    return encoded, n_bytes
+
+
+def vbyte_decode(encoded):
+    """ Decodes variable-byte encoded integers"""
+    encoded = np.asarray(encoded)
+    ends = encoded < 128
+    if ends.all():
+        return encoded.astype(np.int64)
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    # Index of the integer of each byte, and the shift of the byte within the integer
+    integers = np.cumsum(ends) - ends
+    shifts = (np.arange(len(encoded)) - starts[integers]) * 7
+    return np.add.reduceat((encoded & 127).astype(np.int64) << shifts, starts)
+
+
+def gather_ranges(array, starts, ends):
+    """ Concatenates the ranges [start, end) of an array"""
+    lengths = ends - starts
+    index = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    return np.asarray(array[index])
+
+
+def save_postings(folder, name, keys, matrix, doc_len=None):
+    """ Saves the postings of the keys (terms or MeSH descriptors), the columns of
+    a documents by keys sparse matrix of frequencies. Keys are sorted by hash.
+    With the lengths of the documents, the frequencies are saved too, with the
+    blocks and the score bounds used to skip postings at query time, and the keys
+    of each document (their positions), to update the live document frequencies"""
+    encoded_keys = [k.encode("utf-8") for k in keys]
+    hashes = np.array([label_hash(k) for k in encoded_keys], dtype=np.uint64)
+    order = np.argsort(hashes, kind="stable")
+    matrix = sparse.csc_matrix(matrix)[:, order]
+    matrix.sort_indices()
+    indptr, docs = matrix.indptr, matrix.indices.astype(np.int64)
+    doc_freq = np.diff(indptr)
+    # Gaps between the documents of each key, the first document of a key is kept as is
+    gaps = docs.copy()
+    gaps[1:] -= docs[:-1]
+    firsts = indptr[:-1][doc_freq > 0]
+    gaps[firsts] = docs[firsts]
+    # The postings of the keys with more than BLOCK_SIZE documents are split in blocks of BLOCK_SIZE,
+    # that are decoded on their own from the last document of the previous block
+    keys_of_postings = np.repeat(np.arange(len(keys)), doc_freq)
+    block_starts = np.flatnonzero(((np.arange(len(docs)) - indptr[keys_of_postings]) % BLOCK_SIZE == 0) &
+                                  (doc_freq[keys_of_postings] > BLOCK_SIZE))
+    block_ends = np.minimum(block_starts + BLOCK_SIZE, indptr[keys_of_postings[block_starts] + 1])
+    block_offsets = np.zeros(len(keys) + 1, dtype=np.int32)
+    np.cumsum(np.where(doc_freq > BLOCK_SIZE, (doc_freq + BLOCK_SIZE - 1) // BLOCK_SIZE, 0), out=block_offsets[1:])
+    arrays = {"hashes": hashes[order], "doc_freq": doc_freq.astype(np.int32)}
+    streams = [("docs", gaps)]
+    if doc_len is not None:
+        streams.append(("tfs", matrix.data))
+        arrays["block_offsets"] = block_offsets
+        arrays["block_last"] = docs[block_ends - 1].astype(np.int32)
+        # Bounds of the BM25 scores of the key: its highest frequency and the length of its shortest document
+        arrays["max_tf"] = np.maximum.reduceat(matrix.data, indptr[:-1]) if len(docs) > 0 else doc_freq
+        arrays["min_len"] = np.minimum.reduceat(doc_len[docs], indptr[:-1]) if len(docs) > 0 else doc_freq
+        doc_keys = matrix.tocsr()
+        doc_keys.sort_indices()
+        arrays["doc_keys"] = doc_keys.indices.astype(np.int32)
+        arrays["doc_keys_offsets"] = doc_keys.indptr.astype(np.int64)
+    for stream, values in streams:
+        encoded, n_bytes = vbyte_encode(values)
+        byte_offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(n_bytes, out=byte_offsets[1:])
+        arrays[stream] = encoded
+        arrays[stream + "_offsets"] = byte_offsets[indptr]
+        if doc_len is not None:
+            arrays[stream + "_blocks"] = byte_offsets[block_starts]
+    for k, v in arrays.items():
+        np.save(os.path.join(folder, name + "_" + k + ".npy"), v)
+    save_strings([keys[k] for k in order], folder, name + "_keys")
+    return len(keys), len(docs)
+
+
+def load_array(folder, name):
+    return np.load(os.path.join(folder, name + ".npy"), mmap_mode="r")
+
+
+class PostingsTable(object):
+    # Memory-mapped postings of the terms or MeSH descriptors of a segment
+
+    def __init__(self, folder, name, with_tfs=True):
+        self.hashes = load_array(folder, name + "_hashes")
+        self.doc_freq = load_array(folder, name + "_doc_freq")
+        self.docs_offsets = load_array(folder, name + "_docs_offsets")
+        self.docs_bytes = load_array(folder, name + "_docs")
+        if with_tfs:
+            self.tfs_offsets = load_array(folder, name + "_tfs_offsets")
+            self.tfs_bytes = load_array(folder, name + "_tfs")
+            self.block_offsets = load_array(folder, name + "_block_offsets")
+            self.block_last = load_array(folder, name + "_block_last")
+            self.docs_blocks = load_array(folder, name + "_docs_blocks")
+            self.tfs_blocks = load_array(folder, name + "_tfs_blocks")
+            self.max_tf = load_array(folder, name + "_max_tf")
+            self.min_len = load_array(folder, name + "_min_len")
+            self.doc_keys = load_array(folder, name + "_doc_keys")
+            self.doc_keys_offsets = load_array(folder, name + "_doc_keys_offsets")
+        self.keys = MappedStrings(folder, name + "_keys")
+
+    def find(self, key):
+        # Position of the key (hash collisions are compared), -1 if not found
+        key = key.encode("utf-8")
+        key_hash = np.uint64(label_hash(key))
+        position = int(np.searchsorted(self.hashes, key_hash))
+        while position < len(self.hashes) and self.hashes[position] == key_hash:
+            if self.keys[position] == key:
+                return position
+            position += 1
+        return -1
+
+    def docs(self, position):
+        return np.cumsum(vbyte_decode(self.docs_bytes[self.docs_offsets[position]:self.docs_offsets[position + 1]]))
+
+    def tfs(self, position):
+        return vbyte_decode(self.tfs_bytes[self.tfs_offsets[position]:self.tfs_offsets[position + 1]])
+
+    def deleted_doc_freq(self, documents):
+        """ Returns the number of the given documents in the postings of each key"""
+        offsets = np.asarray(self.doc_keys_offsets)
+        keys = gather_ranges(self.doc_keys, offsets[documents], offsets[np.asarray(documents) + 1])
+        return np.bincount(keys, minlength=len(self.hashes))
+
+    def block_postings(self, position, documents):
+        """ Returns the documents and frequencies of the postings of the key at the
+        position, decoding only the blocks that may contain the given (sorted) documents"""
+        first, last = self.block_offsets[position], self.block_offsets[position + 1]
+        if first == last:
+            return self.docs(position), self.tfs(position)
+        block_last = np.asarray(self.block_last[first:last])
+        blocks = np.unique(np.searchsorted(block_last, documents))
+        blocks = blocks[blocks < len(block_last)]
+        sizes = np.minimum(BLOCK_SIZE, self.doc_freq[position] - blocks * BLOCK_SIZE)
+        # A block ends where the next block of the key starts, the last block where the postings of the key end
+        docs_starts = np.asarray(self.docs_blocks[first:last])
+        tfs_starts = np.asarray(self.tfs_blocks[first:last])
+        docs_ends = np.append(docs_starts[1:], self.docs_offsets[position + 1])
+        tfs_ends = np.append(tfs_starts[1:], self.tfs_offsets[position + 1])
+        gaps = vbyte_decode(gather_ranges(self.docs_bytes, docs_starts[blocks], docs_ends[blocks]))
+        tfs = vbyte_decode(gather_ranges(self.tfs_bytes, tfs_starts[blocks], tfs_ends[blocks]))
+        # The gaps are summed within each block, from the last document of the previous block
+        sums = np.cumsum(gaps)
+        block_ends = np.cumsum(sizes)
+        bases = np.where(blocks > 0, block_last[blocks - 1], 0) - np.append(0, sums[block_ends[:-1] - 1])
+        return sums + np.repeat(bases, sizes), tfs
+
+
+def mesh_descriptors(mesh):
+    """ Returns the descriptor UIs of the MeSH headings of a parsed article
+    (see pubmed_parser.parse_mesh)"""
+    if not isinstance(mesh, str):
+        return []
+    descriptors = []
+    for heading in mesh.split(":-:"):
+        for term in heading.split("||"):
+            fields = term.split("|")
+            if len(fields) >= 4 and fields[0] == "D":
+                descriptors.append(fields[-2])
+    return list(dict.fromkeys(descriptors))
+
+
+def index_file(file_path):
+    """ Map step of build_index: counts the normalized words of each title and
+    abstract of a parsed file, and lists its MeSH descriptors"""
+    a = read_parsed(file_path)
+    abstracts = a["abstract"].values if "abstract" in a.columns else [""] * a.shape[0]
+    words, matrix = document_term_matrix(a["title"].values, abstracts)
+    descriptors = [mesh_descriptors(k) for k in a["mesh"].values] if "mesh" in a.columns else [[]] * a.shape[0]
+    return os.path.basename(file_path), a["index"].values.astype(np.int64), words, matrix, descriptors
+
+
+def save_segment(folder, indexed_files):
+    """ Saves the documents of the indexed files as a segment. Returns the PMIDs,
+    the deleted documents (earlier versions of PMIDs found again in the files)
+    and the lengths of the documents"""
+    vocab, mesh_vocab = {}, {}
+    pmids, matrices, mesh_indices, mesh_indptr = [], [], [], [0]
+    for name, file_pmids, words, matrix, descriptors in indexed_files:
+        columns = np.array([vocab.setdefault(k, len(vocab)) for k in words], dtype=np.int32)
+        matrices.append((matrix.data, columns[matrix.indices], matrix.indptr))
+        pmids.append(file_pmids)
+        for k in descriptors:
+            mesh_indices.extend([mesh_vocab.setdefault(d, len(mesh_vocab)) for d in k])
+            mesh_indptr.append(len(mesh_indices))
+    terms = sparse.vstack([sparse.csr_matrix(k, shape=(len(k[2]) - 1, len(vocab))) for k in matrices], format="csr")
+    mesh = sparse.csr_matrix((np.ones(len(mesh_indices), dtype=np.int32), mesh_indices, mesh_indptr),
+                             shape=(terms.shape[0], len(mesh_vocab)))
+    pmids = np.concatenate(pmids)
+    doc_len = np.asarray(terms.sum(axis=1)).ravel().astype(np.int32)
+    # Only the last version of a PMID found several times is kept
+    _, last = np.unique(pmids[::-1], return_index=True)
+    deleted = np.ones(len(pmids), dtype=bool)
+    deleted[len(pmids) - 1 - last] = False
+    np.save(os.path.join(folder, "pmids.npy"), pmids)
+    np.save(os.path.join(folder, "doc_len.npy"), doc_len)
+    n_terms, n_postings = save_postings(folder, "terms", list(vocab), terms, doc_len=doc_len)
+    save_postings(folder, "mesh", list(mesh_vocab), mesh)
+    return pmids, deleted, doc_len, n_terms, n_postings
+
+
+def live_doc_freq(segment_folder, doc_freq, deleted):
+    """ Returns the document frequencies of the terms of a segment less the
+    given deleted documents"""
+    terms = PostingsTable(segment_folder, "terms")
+    return (np.asarray(doc_freq) - terms.deleted_doc_freq(np.flatnonzero(deleted))).astype(np.int32)
+
+
+def read_manifest(index_folder):
+    manifest_path = os.path.join(index_folder, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get("format_version") != BM25_INDEX_VERSION:
+        raise ValueError("Unsupported BM25 index version %s in %s (expected %d)" % (
+            manifest.get("format_version"), index_folder, BM25_INDEX_VERSION))
+    return manifest
+
+
+def add_segment(index_folder, manifest, indexed_files):
+    """ Saves the indexed files as a new segment, marks the earlier versions of
+    their PMIDs as deleted in the previous segments and saves the manifest. The
+    deleted documents and the live document frequencies of the terms are saved
+    in new files, replaced with the manifest"""
+    generation = manifest["next_segment"]
+    name = "segment_%06d" % generation
+    folder = os.path.join(index_folder, name)
+    # A segment left over by an interrupted run is not in the manifest
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    pmids, deleted, doc_len, n_terms, n_postings = save_segment(folder, indexed_files)
+    deleted_file = "deleted_%06d.npy" % generation
+    doc_freq_file = "live_doc_freq_%06d.npy" % generation
+    np.save(os.path.join(folder, deleted_file), deleted)
+    np.save(os.path.join(folder, doc_freq_file), live_doc_freq(folder, load_array(folder, "terms_doc_freq"), deleted))
+    live_pmids = pmids[~deleted]
+    updated = []
+    for entry in manifest["segments"]:
+        segment_folder = os.path.join(index_folder, entry["name"])
+        previous = np.load(os.path.join(segment_folder, entry["deleted"]))
+        replaced = np.isin(load_array(segment_folder, "pmids"), live_pmids) & ~previous
+        if replaced.any():
+            np.save(os.path.join(segment_folder, deleted_file), previous | replaced)
+            doc_freq = np.load(os.path.join(segment_folder, entry["doc_freq"]))
+            np.save(os.path.join(segment_folder, doc_freq_file), live_doc_freq(segment_folder, doc_freq, replaced))
+            entry["deleted"] = deleted_file
+            entry["doc_freq"] = doc_freq_file
+            entry["live_documents"] -= int(replaced.sum())
+            entry["live_length"] -= int(load_array(segment_folder, "doc_len")[replaced].sum())
+            updated.append(segment_folder)
+    manifest["segments"].append({"name": name, "files": [k[0] for k in indexed_files], "documents": len(pmids),
+                                 "live_documents": int((~deleted).sum()),
+                                 "live_length": int(doc_len[~deleted].sum()), "terms": n_terms,
+                                 "postings": n_postings, "deleted": deleted_file, "doc_freq": doc_freq_file})
+    manifest["next_segment"] = generation + 1
+    manifest_path = os.path.join(index_folder, MANIFEST_FILE)
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    for segment_folder in updated:
+        for k in os.listdir(segment_folder):
+            if k.startswith(("deleted_", "live_doc_freq_")) and k not in (deleted_file, doc_freq_file):
+                os.remove(os.path.join(segment_folder, k))
+    return manifest["segments"][-1]
+
+
+def build_index(folder, index_folder=None, in_format="tsv", workers=1, files_per_segment=20):
+    """ Indexes the parsed files of a folder that are not indexed yet, in segments
+    of up to files_per_segment files. Files are indexed in order of their names,
+    so that update files replace the earlier versions of their PMIDs"""
+    index_folder = index_folder if index_folder else folder + "bm25_index/"
+    if not os.path.exists(index_folder):
+        os.makedirs(index_folder)
+    manifest = read_manifest(index_folder)
+    if manifest is None:
+        manifest = {"format_version": BM25_INDEX_VERSION, "segments": [], "next_segment": 0}
+    indexed = set([k for entry in manifest["segments"] for k in entry["files"]])
+    parsed_files = sorted([k for k in os.listdir(folder) if is_parsed_file(k, in_format) and k not in indexed])
+    print("-----------------------------")
+    print("Indexing", len(parsed_files), "new files in", folder, "using", workers, "workers,",
+          len(indexed), "files already indexed")
+    tasks = [folder + k for k in parsed_files]
+    pool = Pool(workers) if workers > 1 else None
+    results = pool.imap(index_file, tasks) if pool else map(index_file, tasks)
+    batch = []
+    try:
+        for i, indexed_file in enumerate(results):
+            batch.append(indexed_file)
+            print("Documents found", len(indexed_file[1]), "in", indexed_file[0])
+            if len(batch) == files_per_segment or i == len(tasks) - 1:
+                start = time.time()
+                entry = add_segment(index_folder, manifest, batch)
+                print("Saved", entry["name"], "of", entry["documents"], "documents,", entry["terms"], "terms and",
+                      entry["postings"], "postings in", round(time.time() - start, 1), "seconds")
+                print("-----------------------------")
+                batch = []
+    finally:
+        if pool:
+            pool.terminate()
+    return BM25Index(index_folder) if len(manifest["segments"]) > 0 else None
+
+
+class Segment(object):
+    # Memory-mapped documents and postings of a segment
+
+    def __init__(self, index_folder, entry):
+        folder = os.path.join(index_folder, entry["name"])
+        self.pmids = load_array(folder, "pmids")
+        self.doc_len = load_array(folder, "doc_len")
+        self.deleted = np.load(os.path.join(folder, entry["deleted"]), mmap_mode="r")
+        self.doc_freq = np.load(os.path.join(folder, entry["doc_freq"]), mmap_mode="r")
+        self.terms = PostingsTable(folder, "terms")
+        self.mesh = PostingsTable(folder, "mesh", with_tfs=False)
+
+    def mesh_documents(self, descriptors):
+        # Documents with all the descriptors
+        documents = None
+        for k in descriptors:
+            position = self.mesh.find(k)
+            if position < 0:
+                return np.zeros(0, dtype=np.int64)
+            docs = self.mesh.docs(position)
+            documents = docs if documents is None else np.intersect1d(documents, docs, assume_unique=True)
+        return documents
+
+    def term_scores(self, idf, docs, tfs, k1, b, avg_length):
+        norm = k1 * (1 - b + b * self.doc_len[docs] / avg_length)
+        return idf * (k1 + 1) * tfs / (tfs + norm)
+
+    def score(self, positions, idfs, k, threshold, k1, b, avg_length, documents=None):
+        """ Returns the live documents of the segment that may be in the k best
+        documents, those matching any of the terms at the positions with a BM25
+        score not lower than the threshold (the k-th best score found so far).
+        With documents, only those documents are matched.
+
+        Terms are scored by decreasing upper bound of their scores (MaxScore).
+        Once the bounds of the remaining terms add up to less than the threshold,
+        a document they match cannot be in the k best unless it matched the terms
+        already scored, so they are only decoded in the blocks of those documents"""
+        terms = [(idf * (k1 + 1) * self.terms.max_tf[p] / (self.terms.max_tf[p] + k1 * (
+            1 - b + b * self.terms.min_len[p] / avg_length)), idf, p) for p, idf in zip(positions, idfs) if p >= 0]
+        terms.sort(key=lambda t: -t[0])
+        remaining = np.cumsum([t[0] for t in terms][::-1])[::-1].tolist() + [0]
+        matched_docs, matched_scores = [], []
+        i = 0
+        while i < len(terms) and remaining[i] >= threshold:
+            docs, tfs = self.terms.docs(terms[i][2]), self.terms.tfs(terms[i][2])
+            if documents is not None:
+                kept = np.isin(docs, documents, assume_unique=True)
+                docs, tfs = docs[kept], tfs[kept]
+            scores = self.term_scores(terms[i][1], docs, tfs, k1, b, avg_length)
+            # The k-th best score of a term is a lower bound of the k-th best score of the query
+            live_scores = scores[~self.deleted[docs]]
+            if len(live_scores) >= k:
+                threshold = max(threshold, np.partition(live_scores, len(live_scores) - k)[len(live_scores) - k])
+            matched_docs.append(docs)
+            matched_scores.append(scores)
+            i += 1
+        if len(matched_docs) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        if len(matched_docs) == 1:
+            docs, scores = matched_docs[0], matched_scores[0]
+        elif sum(len(t) for t in matched_docs) * 8 < len(self.pmids):
+            # Few postings: the scores of each document are summed after sorting them
+            docs, inverse = np.unique(np.concatenate(matched_docs), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(matched_scores))
+        else:
+            # Many postings: the scores are summed in an array of all the documents of the segment
+            scores = np.bincount(np.concatenate(matched_docs), weights=np.concatenate(matched_scores),
+                                 minlength=len(self.pmids))
+            docs = np.flatnonzero(scores)
+            scores = scores[docs]
+        live = ~self.deleted[docs]
+        docs, scores = docs[live], scores[live]
+        for bound, idf, position in terms[i:]:
+            if len(scores) >= k:
+                threshold = max(threshold, np.partition(scores, len(scores) - k)[len(scores) - k])
+            kept = scores + remaining[i] >= threshold
+            docs, scores = docs[kept], scores[kept]
+            if len(docs) == 0:
+                break
+            block_docs, block_tfs = self.terms.block_postings(position, docs)
+            found = np.searchsorted(docs, block_docs)
+            matched = found < len(docs)
+            matched[matched] = docs[found[matched]] == block_docs[matched]
+            scores[found[matched]] += self.term_scores(idf, block_docs[matched], block_tfs[matched], k1, b,
+                                                       avg_length)
+            i += 1
+        return docs, scores
+
+
+class BM25Index(object):
+    """ BM25 index of the parsed PubMed abstracts, saved in a folder by build_index.
+
+    The statistics of the live documents (their number and average length) are
+    kept in the manifest, and the live document frequencies of the query terms
+    are summed over the segments, so that the scores do not depend on how the
+    documents are split in segments, nor on the documents replaced. Pickling an index only pickles its folder."""
+
+    def __init__(self, index_folder, k1=1.2, b=0.75):
+        self.index_folder = index_folder
+        self.k1, self.b = k1, b
+        self.manifest = read_manifest(index_folder)
+        if self.manifest is None:
+            raise IOError("No BM25 index saved in " + index_folder)
+        self.segments = [Segment(index_folder, k) for k in self.manifest["segments"]]
+        self.n_documents = sum(k["live_documents"] for k in self.manifest["segments"])
+        self.avg_length = sum(k["live_length"] for k in self.manifest["segments"]) / max(self.n_documents, 1)
+
+    def __getstate__(self):
+        return {"index_folder": self.index_folder, "k1": self.k1, "b": self.b}
+
+    def __setstate__(self, state):
+        self.__init__(state["index_folder"], k1=state["k1"], b=state["b"])
+
+    def idf(self, doc_freq):
+        return np.log(1 + (self.n_documents - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def search(self, query, k=10, mesh=None):
+        """ Returns the PMIDs and BM25 scores of the k best documents for the query,
+        normalized like the abstracts. With mesh, a list of MeSH descriptor UIs
+        (e.g. D006801), only the documents with all the descriptors are ranked"""
+        terms = list(dict.fromkeys(normalize(query).split()))
+        positions = [[segment.terms.find(t) for t in terms] for segment in self.segments]
+        doc_freqs = np.zeros(len(terms))
+        for segment, segment_positions in zip(self.segments, positions):
+            for i, position in enumerate(segment_positions):
+                if position >= 0:
+                    doc_freqs[i] += segment.doc_freq[position]
+        idfs = self.idf(doc_freqs)
+        pmids, scores = [], []
+        threshold = -np.inf
+        for segment, segment_positions in zip(self.segments, positions):
+            documents = segment.mesh_documents(mesh) if mesh else None
+            if documents is not None and len(documents) == 0:
+                continue
+            docs, doc_scores = segment.score(segment_positions, idfs, k, threshold, self.k1, self.b, self.avg_length,
+                                             documents)
+            if len(docs) > k:
+                best = np.argpartition(-doc_scores, k - 1)[:k]
+                docs, doc_scores = docs[best], doc_scores[best]
+            pmids.append(segment.pmids[docs])
+            scores.append(doc_scores)
+            # The k-th best score so far, that the documents of the next segments have to reach
+            best_scores = np.concatenate(scores)
+            if len(best_scores) >= k:
+                threshold = np.partition(best_scores, len(best_scores) - k)[len(best_scores) - k]
+        pmids = np.concatenate(pmids) if pmids else np.zeros(0, dtype=np.int64)
+        scores = np.concatenate(scores) if scores else np.zeros(0)
+        order = np.lexsort((pmids, -scores))[:k]
+        return pd.DataFrame({"pmid": pmids[order], "score": scores[order]})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument("--folder", help="folder of the parsed PubMed files to index")
+    parser.add_argument("--indexfolder", help="folder of the index, <folder>/bm25_index/ by default")
+    parser.add_argument("--format", choices=sorted(OUTPUT_FORMATS), default="tsv",
+                        help="format of the parsed abstracts")
+    parser.add_argument("--filespersegment", type=int, default=20,
+                        help="number of parsed files indexed in each segment")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes used to index the files")
+    parser.add_argument("--query", help="query to search the index with, instead of indexing the folder")
+    parser.add_argument("--mesh", nargs="*", help="MeSH descriptor UIs the documents found must all have")
+    parser.add_argument("--top", type=int, default=10, help="number of documents returned by the query")
+    args = parser.parse_args()
+
+    if args.query:
+        if not args.indexfolder and not args.folder:
+            print("Please provide the folder of the index to search")
+        else:
+            index = BM25Index(args.indexfolder if args.indexfolder else args.folder + "bm25_index/")
+            start = time.time()
+            results = index.search(args.query, k=args.top, mesh=args.mesh)
+            print(results.to_string(index=False))
+            print("Found", results.shape[0], "documents in", round((time.time() - start) * 1000, 1), "ms")
+    elif args.folder:
+        build_index(args.folder, index_folder=args.indexfolder, in_format=args.format, workers=args.workers,
+                    files_per_segment=args.filespersegment)
+    else:
+        print("Please provide the folder of parsed files to index, or a query")
@@ -0,0 +1,253 @@
+""" Annotates parsed PubMed abstracts with the UMLS concepts (CUIs) whose labels
+they mention.
+
+The preferred and alternate labels of the UMLS knowledge graph (see
+umls_knowledge_graph/umls_graph_creator.py) are normalized like the abstracts
+(pubmed_parser.normalize) and compiled into a token trie. Each normalized title
+and abstract is then scanned once from left to right, keeping the longest label
+starting at each position and resuming after it (leftmost-longest matching).
+The parsed files of a folder are annotated in parallel, and the mentions of each
+file are saved as a TSV file of PMID, field, token positions, CUI and label.
+"""
+import pandas as pd
+import argparse
+import os
+import pickle
+import sys
+import time
+from multiprocessing import Pool
+
+from pubmed_parser import normalize_batch, read_parsed, is_parsed_file, OUTPUT_FORMATS
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(os.path.join(parentdir, "umls_knowledge_graph"))
+
+import graph_store
+
+FIELDS = ["title", "abstract"]
+MENTION_COLUMNS = ["pmid", "field", "start", "end", "cui", "label"]
+# Transitions of the trie are keyed by state << TOKEN_BITS | token id
+TOKEN_BITS = 32
+
+
+def graph_labels(graph_path):
+    """ Returns the (label, CUI) pairs of the knowledge graph saved by
+    umls_graph_creator: the folder of its node and edge tables, read without
+    building the graph, or the file of the pickled graph (saved without
+    pyarrow). Model 1 nodes are CUIs, Model 2 labels are on terminology codes
+    linked to their CUIs by HAS_CUI edges, and the labels of codes without a
+    CUI are left out"""
+    node_labels = {}
+    code_cuis = {}
+    if os.path.isfile(graph_path):
+        with open(graph_path, "rb") as graph_file:
+            umls_G = pickle.load(graph_file)
+        for name, attributes in umls_G.nodes(data=True):
+            node_labels[name] = sorted(attributes.get("preflabels", [])) + sorted(attributes.get("altlabels", []))
+        for code, cui, edge_type in umls_G.edges(data="edge_type"):
+            if edge_type == "HAS_CUI":
+                code_cuis.setdefault(code, set()).add(cui)
+        # Only Model 2 graphs link codes to CUIs
+        model_type = "model2" if len(code_cuis) > 0 else "model1"
+    else:
+        if graph_store.read_manifest(graph_path) is None:
+            raise IOError("No knowledge graph saved in " + graph_path + ", expected the folder of the graph "
+                          "tables (<model>_umls_graph/, saved with pyarrow) or the pickled graph "
+                          "(<model>_umls_G.pickle) of umls_graph_creator.py")
+        manifest, tables = graph_store.load_graph_tables(graph_path)
+        model_type = manifest["model_type"]
+        for nodes, edges in tables:
+            names = nodes.column("node").to_pylist()
+            preflabels = nodes.column("preflabels").to_pylist()
+            altlabels = nodes.column("altlabels").to_pylist()
+            for name, pref, alt in zip(names, preflabels, altlabels):
+                node_labels[name] = (pref or []) + (alt or [])
+            edges = edges.select(["source", "target", "edge_type"]).to_pandas()
+            edges = edges[edges["edge_type"] == "HAS_CUI"]
+            for code, cui in zip(edges["source"].values, edges["target"].values):
+                code_cuis.setdefault(code, set()).add(cui)
+    pairs = []
+    for name, labels in node_labels.items():
+        if model_type == "model2":
+            cuis = sorted(code_cuis.get(name, []))
+        else:
+            cuis = [name]
+        for label in labels:
+            for cui in cuis:
+                pairs.append((label, cui))
+    return pairs
+
+
+class ConceptAnnotator(object):
+    """ Token trie of normalized concept labels. States are integers, the
+    transitions are a single dict keyed by (state, token id) packed into an int,
+    and the states ending a label keep the ids of the concepts of that label"""
+    def __init__(self):
+        self.tokens = {}
+        self.transitions = {}
+        self.outputs = {}
+        self.labels = {}
+        self.concepts = []
+        self.concept_ids = {}
+        self.n_states = 1
+
+    @classmethod
+    def from_labels(cls, pairs, min_length=3, jobs=1):
+        """ Builds the trie from (label, CUI) pairs. Labels are normalized like the
+        abstracts, and labels shorter than min_length characters once normalized
+        are left out"""
+        pairs = list(pairs)
+        annotator = cls()
+        unique_labels = list(dict.fromkeys([k[0] for k in pairs]))
+        normalized = dict(zip(unique_labels, normalize_batch(unique_labels, jobs=jobs)))
+        for label, cui in pairs:
+            label = normalized[label]
+            if len(label) >= min_length:
+                annotator.add(label, cui)
+        return annotator
+
+    @classmethod
+    def from_graph(cls, graph_path, min_length=3, jobs=1):
+        """ Builds the trie from the labels of the saved knowledge graph (see graph_labels)"""
+        return cls.from_labels(graph_labels(graph_path), min_length=min_length, jobs=jobs)
+
+    def add(self, label, cui):
+        state = 0
+        for token in label.split():
+            token_id = self.tokens.setdefault(token, len(self.tokens))
+            key = state << TOKEN_BITS | token_id
+            next_state = self.transitions.get(key)
+            if next_state is None:
+                next_state = self.n_states
+                self.transitions[key] = next_state
+                self.n_states += 1
+            state = next_state
+        concept_id = self.concept_ids.setdefault(cui, len(self.concepts))
+        if concept_id == len(self.concepts):
+            self.concepts.append(cui)
+        if concept_id not in self.outputs.get(state, ()):
+            self.outputs[state] = self.outputs.get(state, ()) + (concept_id,)
+        self.labels[state] = label
+
+    def number_of_labels(self):
+        return len(self.outputs)
+
+    def match(self, text):
+        """ Yields the (start, end, CUIs, label) mentions in a normalized text, with
+        start and end the positions of the first and past the last matched token"""
+        token_ids = [self.tokens.get(k, -1) for k in text.split()]
+        n_tokens = len(token_ids)
+        transitions, outputs = self.transitions, self.outputs
+        i = 0
+        while i < n_tokens:
+            state, j, last = 0, i, None
+            while j < n_tokens and token_ids[j] >= 0:
+                state = transitions.get(state << TOKEN_BITS | token_ids[j])
+                if state is None:
+                    break
+                j += 1
+                if state in outputs:
+                    last = (j, state)
+            if last is None:
+                i += 1
+                continue
+            yield i, last[0], [self.concepts[k] for k in outputs[last[1]]], self.labels[last[1]]
+            i = last[0]
+
+    def annotate(self, pmids, fields):
+        """ Returns the mentions of normalized fields, a dict of field name to the
+        list of normalized texts of the PMIDs"""
+        mentions = []
+        for field, texts in fields.items():
+            for pmid, text in zip(pmids, texts):
+                for start, end, cuis, label in self.match(text):
+                    for cui in cuis:
+                        mentions.append((pmid, field, start, end, cui, label))
+        return pd.DataFrame(mentions, columns=MENTION_COLUMNS)
+
+
+annotator = None
+
+
+def set_annotator(shared_annotator):
+    # Pool initializer: with fork, the trie is shared by the workers instead of being pickled per task
+    global annotator
+    annotator = shared_annotator
+
+
+def get_output_file(file_path, output_folder):
+    name = os.path.basename(file_path)
+    for extension in sorted([k for v in OUTPUT_FORMATS.values() for k in v], key=len, reverse=True):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            break
+    return os.path.join(output_folder, name + ".concepts.tsv")
+
+
+def annotate_file(task):
+    """ Annotates the titles and abstracts of a parsed file, and saves the mentions"""
+    file_path, output_folder = task
+    start = time.time()
+    a = read_parsed(file_path, columns=["index"] + FIELDS)
+    pmids = a["index"].astype(str).values.tolist()
+    fields = dict([(k, normalize_batch(a[k].values)) for k in FIELDS])
+    mentions = annotator.annotate(pmids, fields)
+    mentions.to_csv(get_output_file(file_path, output_folder), sep="\t", index=None)
+    return file_path, a.shape[0], mentions.shape[0], time.time() - start
+
+
+def annotate_folder(folder, concept_annotator, output_folder=None, in_format="tsv", workers=1):
+    """ Annotates all the parsed files in the folder using a pool of worker
+    processes, saving the mentions of each file in the output folder (a concepts
+    subfolder by default, so that they are not read back as parsed files)"""
+    output_folder = output_folder if output_folder else os.path.join(folder, "concepts")
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    parsed_files = sorted([k for k in os.listdir(folder) if is_parsed_file(k, in_format)])
+    print("-----------------------------")
+    print("Annotating", len(parsed_files), "files in", folder, "using", workers, "workers")
+    tasks = [(os.path.join(folder, k), output_folder) for k in parsed_files]
+    set_annotator(concept_annotator)
+    pool = Pool(workers, initializer=set_annotator, initargs=(concept_annotator,)) if workers > 1 else None
+    results = pool.imap_unordered(annotate_file, tasks) if pool else map(annotate_file, tasks)
+    n_abstracts, n_mentions = 0, 0
+    try:
+        for file_path, abstracts, mentions, seconds in results:
+            n_abstracts += abstracts
+            n_mentions += mentions
+            print("Annotated", abstracts, "abstracts with", mentions, "mentions in", os.path.basename(file_path),
+                  "in", round(seconds, 1), "seconds")
+    finally:
+        if pool:
+            pool.terminate()
+    print("Annotated", n_abstracts, "abstracts with", n_mentions, "mentions")
+    print("-----------------------------")
+    return n_abstracts, n_mentions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument("--graphfolder", required=True,
+                        help="folder of the saved UMLS knowledge graph, e.g. ../umls_knowledge_graph/tempdata/model1_umls_graph/, "
+                             "or the pickled graph saved without pyarrow, e.g. "
+                             "../umls_knowledge_graph/tempdata/model1_umls_G.pickle")
+    parser.add_argument("--folder", required=True, help="folder of the parsed PubMed files to annotate")
+    parser.add_argument("--outputfolder", help="folder to save the mentions to, <folder>/concepts/ by default")
+    parser.add_argument("--format", choices=sorted(OUTPUT_FORMATS), default="tsv",
+                        help="format of the parsed abstracts")
+    parser.add_argument("--minlength", type=int, default=3,
+                        help="minimum number of characters of the normalized labels that are matched")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes used to normalize the labels and annotate the files")
+    args = parser.parse_args()
+
+    start = time.time()
+    concept_annotator = ConceptAnnotator.from_graph(args.graphfolder, min_length=args.minlength, jobs=args.workers)
+    print("Compiled", concept_annotator.number_of_labels(), "labels of", len(concept_annotator.concepts),
+          "concepts in", round(time.time() - start, 1), "seconds")
+    annotate_folder(args.folder, concept_annotator, output_folder=args.outputfolder, in_format=args.format,
+                    workers=args.workers)
@@ -36,11 +36,8 @@ do
             echo $PUBMED_URL$fname
             curl $PUBMED_URL$fname > $fname
             mv $fname $INPUT_FOLDER
-            gzip -d $INPUT_FOLDER$fname
-            zipfile=$(echo $INPUT_FOLDER$fname | sed 's/.\{3\}$//')
-            python pubmed_parser.py --file $zipfile --mode parse --abstract true --mesh true
+            python pubmed_parser.py --file $INPUT_FOLDER$fname --mode parse --abstract true --mesh true
             rm $INPUT_FOLDER$fname
-            rm $zipfile
         fi
     fi
     ((i=i+1))
@@ -0,0 +1,267 @@
+""" Counts the n-grams (e.g. bigrams and trigrams, for phrase mining) of the
+normalized titles and abstracts of the parsed PubMed files in a folder, with
+bounded memory.
+
+Unlike the word frequencies of pubmed_parser.generate_dict, the n-gram counts do
+not fit in a dictionary for the whole corpus. Each worker counts the n-grams of
+a file in memory until it holds max_entries distinct n-grams, then spills them
+to disk as a run sorted by n-gram, and the runs are merged externally. The
+merge streams the summed counts of the n-grams in order: all of them are saved
+as the counts of the folder, merged with the runs of new files on the next run,
+and only those found at least min_freq times are kept for ngram_freq.tsv, so
+memory use is bounded by max_entries per process.
+
+Titles and abstracts are counted separately, so n-grams do not span them.
+"""
+import argparse
+import heapq
+import os
+import shutil
+import time
+from collections import Counter
+from multiprocessing import Pool
+
+from pubmed_parser import normalize, read_parsed, is_parsed_file, OUTPUT_FORMATS, MIN_FREQ
+
+NGRAM_FOLDER = "ngrams/"
+RUN_FOLDER = NGRAM_FOLDER + "runs/"
+COUNTS_FILE = NGRAM_FOLDER + "ngram_counts.run"
+# Maximum number of runs merged at once, more runs are first merged in several passes
+MERGE_FAN_IN = 64
+
+
+def file_ngrams(texts, orders):
+    """ Yields the n-grams of the given orders of normalized texts"""
+    for text in texts:
+        tokens = text.split()
+        for n in orders:
+            yield from map(" ".join, zip(*[tokens[i:] for i in range(n)]))
+
+
+def write_run(items, run_file, header=None):
+    """ Writes sorted (n-gram, count) pairs as a run, to a temporary file first
+    and then moved in place. Returns the number of n-grams written"""
+    n_items = 0
+    with open(run_file + ".tmp", "w", encoding="utf-8") as run_out:
+        if header is not None:
+            run_out.write("#" + "\t".join(header) + "\n")
+        for ngram, count in items:
+            run_out.write("{}\t{}\n".format(ngram, count))
+            n_items += 1
+    os.replace(run_file + ".tmp", run_file)
+    return n_items
+
+
+def read_header(run_file):
+    """ Returns the header fields of a run, or None if it has no header"""
+    with open(run_file, encoding="utf-8") as run_in:
+        line = run_in.readline()
+    return line[1:].rstrip("\n").split("\t") if line.startswith("#") else None
+
+
+def read_run(run_file):
+    """ Yields the (n-gram, count) pairs of a run, skipping its header"""
+    with open(run_file, encoding="utf-8") as run_in:
+        line = run_in.readline()
+        if line and not line.startswith("#"):
+            ngram, count = line.rstrip("\n").split("\t")
+            yield ngram, int(count)
+        for line in run_in:
+            ngram, count = line.rstrip("\n").split("\t")
+            yield ngram, int(count)
+
+
+def merge_runs(run_files):
+    """ Merges sorted runs, yielding each n-gram once with its summed count, in order"""
+    current, total = None, 0
+    for ngram, count in heapq.merge(*[read_run(k) for k in run_files]):
+        if ngram != current:
+            if current is not None:
+                yield current, total
+            current, total = ngram, 0
+        total += count
+    if current is not None:
+        yield current, total
+
+
+def count_ngrams(task):
+    """ Map step of generate_ngrams: counts the n-grams of a parsed file, spilling
+    a sorted run whenever max_entries distinct n-grams are held in memory. The
+    runs of the file are listed in a <file>.runs file written last, so that a
+    file whose runs were not all written is counted again"""
+    file_path, run_folder, orders, max_entries = task
+    start = time.time()
+    name = os.path.basename(file_path)
+    a = read_parsed(file_path, columns=["title", "abstract"])
+    counts = Counter()
+    run_files = []
+
+    def spill():
+        run_file = run_folder + "{}.{}.run".format(name, len(run_files))
+        write_run(sorted(counts.items()), run_file)
+        run_files.append(run_file)
+        counts.clear()
+
+    for title, abstract in zip(a["title"].values, a["abstract"].values):
+        counts.update(file_ngrams([normalize(title), normalize(abstract)], orders))
+        if len(counts) >= max_entries:
+            spill()
+    if len(counts) > 0 or len(run_files) == 0:
+        spill()
+    # The first line of the list is the orders of the n-grams counted
+    with open(run_folder + name + ".runs.tmp", "w", encoding="utf-8") as runs_out:
+        runs_out.write(",".join(map(str, orders)) + "\n")
+        runs_out.write("".join(os.path.basename(k) + "\n" for k in run_files))
+    os.replace(run_folder + name + ".runs.tmp", run_folder + name + ".runs")
+    return name, a.shape[0], run_files, time.time() - start
+
+
+def get_pending_runs(run_folder, orders, merged_files):
+    """ Returns the run files of the files counted but not yet merged, removing
+    the runs of files that were merged or whose runs are incomplete"""
+    pending = {}
+    orders = ",".join(map(str, orders))
+    for k in os.listdir(run_folder):
+        if k.endswith(".runs"):
+            with open(run_folder + k, encoding="utf-8") as runs_in:
+                lines = [line.strip() for line in runs_in if len(line.strip()) > 0]
+            name = k[:-len(".runs")]
+            if lines[0] == orders and name not in merged_files:
+                pending[name] = [run_folder + line for line in lines[1:]]
+    kept = set([os.path.basename(k) for v in pending.values() for k in v] + [k + ".runs" for k in pending])
+    for k in os.listdir(run_folder):
+        if k not in kept:
+            if os.path.isdir(run_folder + k):
+                shutil.rmtree(run_folder + k)
+            else:
+                os.remove(run_folder + k)
+    return pending
+
+
+def merge_folder_runs(folder, run_files, header, min_freq):
+    """ Merges the runs into the counts of the folder, in several passes of at
+    most MERGE_FAN_IN runs, and returns the n-grams found at least min_freq
+    times. The cutoff is applied as the counts are streamed out of the final
+    merge, so only the frequent n-grams are held in memory"""
+    merge_folder = folder + RUN_FOLDER + "merge/"
+    if not os.path.exists(merge_folder):
+        os.makedirs(merge_folder)
+    run_files = list(run_files)
+    n_merges = 0
+    while len(run_files) > MERGE_FAN_IN:
+        merged_file = merge_folder + "{}.run".format(n_merges)
+        write_run(merge_runs(run_files[:MERGE_FAN_IN]), merged_file)
+        run_files = run_files[MERGE_FAN_IN:] + [merged_file]
+        n_merges += 1
+    frequent = []
+
+    def frequent_counts(items):
+        for ngram, count in items:
+            if count >= min_freq:
+                frequent.append((ngram, count))
+            yield ngram, count
+
+    n_ngrams = write_run(frequent_counts(merge_runs(run_files)), folder + COUNTS_FILE, header=header)
+    shutil.rmtree(merge_folder)
+    return n_ngrams, frequent
+
+
+def save_ngram_freq(frequent, folder):
+    """ Saves the frequent n-grams by decreasing frequency, as ngram_freq.tsv"""
+    frequent.sort(key=lambda k: -k[1])
+    with open(folder + "ngram_freq.tsv.tmp", "w", encoding="utf-8") as freq_out:
+        freq_out.write("ngram\tfreq\n")
+        freq_out.writelines("{}\t{}\n".format(ngram, count) for ngram, count in frequent)
+    os.replace(folder + "ngram_freq.tsv.tmp", folder + "ngram_freq.tsv")
+
+
+def load_ngram_counts(folder):
+    """ Yields the (n-gram, count) pairs of all the n-grams counted in the folder,
+    in n-gram order"""
+    if os.path.exists(folder + COUNTS_FILE):
+        yield from read_run(folder + COUNTS_FILE)
+
+
+def generate_ngrams(folder, orders=(2, 3), in_format="tsv", workers=1, max_entries=1000000, min_freq=MIN_FREQ):
+    """ Counts the n-grams of the given orders in the parsed files of a folder,
+    saving all the counts in <folder>/ngrams/ngram_counts.run and the n-grams
+    found at least min_freq times in <folder>/ngram_freq.tsv. Files already
+    merged into the counts, or whose runs were saved by an interrupted run, are
+    not counted again"""
+    orders = sorted(set(orders))
+    header = [",".join(map(str, orders))]
+    run_folder = folder + RUN_FOLDER
+    if not os.path.exists(run_folder):
+        os.makedirs(run_folder)
+    merged_files = []
+    if os.path.exists(folder + COUNTS_FILE):
+        saved_header = read_header(folder + COUNTS_FILE)
+        if saved_header[0] != header[0]:
+            print("The n-grams counted in", folder, "are of orders", saved_header[0],
+                  ", delete", folder + NGRAM_FOLDER, "to count other orders")
+            return None
+        merged_files = saved_header[1:]
+    pending = get_pending_runs(run_folder, orders, set(merged_files))
+    counted = set(merged_files) | set(pending)
+    tsv_files = sorted([k for k in os.listdir(folder) if is_parsed_file(k, in_format) and k not in counted])
+    print("-----------------------------")
+    print("Found", len(tsv_files), "new files in", folder, "using", workers, "workers,",
+          len(merged_files), "files already merged,", len(pending), "files already counted")
+    tasks = [(folder + k, run_folder, orders, max_entries) for k in tsv_files]
+    pool = Pool(workers) if workers > 1 else None
+    results = pool.imap_unordered(count_ngrams, tasks) if pool else map(count_ngrams, tasks)
+    try:
+        for name, n_abstracts, file_runs, seconds in results:
+            print("Counted the n-grams of", n_abstracts, "abstracts in", name, "into", len(file_runs), "runs in",
+                  round(seconds, 1), "seconds")
+            pending[name] = file_runs
+    finally:
+        if pool:
+            pool.terminate()
+    if len(pending) == 0 and os.path.exists(folder + COUNTS_FILE):
+        # min_freq may differ from the previous run, so the saved counts are filtered again
+        start = time.time()
+        frequent = [(ngram, count) for ngram, count in load_ngram_counts(folder) if count >= min_freq]
+        save_ngram_freq(frequent, folder)
+        print("No new files to merge,", len(frequent), "n-grams found at least", min_freq, "times, in",
+              round(time.time() - start, 1), "seconds")
+        print("-----------------------------")
+        return None
+
+    start = time.time()
+    run_files = [k for name in sorted(pending) for k in pending[name]]
+    if os.path.exists(folder + COUNTS_FILE):
+        run_files.append(folder + COUNTS_FILE)
+    # The merged files are recorded in the header of the counts, so the counts and
+    # the list of files they include are replaced at once
+    header += merged_files + sorted(pending)
+    n_ngrams, frequent = merge_folder_runs(folder, run_files, header, min_freq)
+    save_ngram_freq(frequent, folder)
+    for name in pending:
+        for k in pending[name] + [run_folder + name + ".runs"]:
+            os.remove(k)
+    print("Merged", len(run_files), "runs into", n_ngrams, "n-grams,", len(frequent), "found at least",
+          min_freq, "times, in", round(time.time() - start, 1), "seconds")
+    print("-----------------------------")
+    return n_ngrams, len(frequent)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument("--folder", required=True, help="folder of the parsed PubMed files")
+    parser.add_argument("--format", choices=sorted(OUTPUT_FORMATS), default="tsv",
+                        help="format of the parsed abstracts")
+    parser.add_argument("--orders", type=int, nargs="+", default=[2, 3],
+                        help="lengths of the n-grams to count")
+    parser.add_argument("--minfreq", type=int, default=MIN_FREQ,
+                        help="minimum frequency of the n-grams saved in ngram_freq.tsv")
+    parser.add_argument("--maxentries", type=int, default=1000000,
+                        help="number of distinct n-grams each worker counts in memory before spilling them to disk")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes used to count the files")
+    args = parser.parse_args()
+    generate_ngrams(args.folder, orders=args.orders, in_format=args.format, workers=args.workers,
+                    max_entries=args.maxentries, min_freq=args.minfreq)
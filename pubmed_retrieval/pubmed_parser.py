@@ -1,9 +1,21 @@
 import xml.etree.ElementTree as ET
+import numpy as np
 import pandas as pd
 import argparse
+import gzip
 import os
 import re
 import sys
+import time
+from collections import Counter
+from multiprocessing import Pool
+from scipy import sparse
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa, pq = None, None
 
 currentdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(currentdir)
@@ -13,6 +25,12 @@ from utilities import gtbtokenize
 from utilities.utils import MatrixIO
 
 TRUE_VALUES = set(["true", "on"])
+OUTPUT_FORMATS = {"tsv": (".tsv", ".tsv.gz"), "parquet": (".parquet",)}
+DOC_TERM_FOLDER = "doc_term/"
+# Minimum frequency of the words saved in word_freq.tsv
+MIN_FREQ = 50
+# Word frequencies and files counted so far by generate_dict, see save_checkpoint
+CHECKPOINT_FILE = "word_freq.checkpoint"
 
 def f(x):
     return re.sub(r'[^a-z]', " ", x)
@@ -26,6 +44,20 @@ def normalize(phrase):
         ap = ""
     return ap
 
+def normalize_batch(texts, jobs=1, chunksize=256):
+    """ Normalizes an iterable of texts, yielding the normalized texts in the
+    order of the input. With jobs > 1, chunks of texts are normalized in a
+    pool of worker processes, reading the input only a few chunks ahead
+    (see gtbtokenize.imap_bounded)"""
+    if jobs <= 1:
+        for text in texts:
+            yield normalize(text)
+        return
+    with Pool(jobs) as pool:
+        for normalized in gtbtokenize.imap_bounded(pool, normalize, texts, chunksize, 2 * jobs):
+            yield normalized
+
+
 def str_to_bool(string):
     """ Takes a string and returns a boolean value interpreted
     from that string"""
@@ -40,112 +72,481 @@ def parse_mesh(meshheading, is_qualifier=False):
     return info        
 
 
-def parse(file_arg, include_mesh=True, include_abstract=True, verbose=False):
+def parse_article(act, include_mesh=True, include_abstract=True, verbose=False):
+    """ Extracts the PMID and the record (title, abstract, mesh) from a
+    PubmedArticle element. Returns None if the article cannot be parsed"""
+    try:
+        cit = act.find('MedlineCitation')
+        pmid = cit.find('PMID').text
+        title = cit.find('Article').find('ArticleTitle').text
+        if include_abstract:
+            abstract = cit.find('Article').find(
+                'Abstract').find('AbstractText').text
+        if include_mesh:
+            mesh_list = cit.find('MeshHeadingList').findall('MeshHeading')
+            mesh_formatted_list = []
+            if verbose:
+                print("Mesh Headings found", len(mesh_list))
+            for k in mesh_list:
+                mesh_fm = []
+                descriptors = k.findall('DescriptorName')
+                for descriptor in descriptors:
+                    info = parse_mesh(descriptor)
+                    mesh_fm.append(info)
+                qualifiers = k.findall('QualifierName')
+                for qualifier in qualifiers:
+                    info = parse_mesh(qualifier, is_qualifier=True)
+                    mesh_fm.append(info)
+                mesh_formatted_list.append("||".join(mesh_fm))
+        if not pmid or len(str(pmid)) == 0:
+            return None
+        record = {"title": title}
+        if include_abstract:
+            record['abstract'] = abstract
+        if include_mesh:
+            record['mesh'] = ":-:".join(mesh_formatted_list)
+        if verbose:
+            print("Parsed", pmid)
+        return pmid, record
+    except:
+        if verbose:
+            print('Parsing error')
+        return None
+
+
+def open_file(file_arg, mode="rb"):
+    """ Opens plain or gzip-compressed (.gz) files transparently"""
+    text_args = {"encoding": "utf-8", "newline": ""} if "t" in mode else {}
+    if file_arg.endswith(".gz"):
+        return gzip.open(file_arg, mode, **text_args)
+    return open(file_arg, mode, **text_args)
+
+
+def get_output_file(file_arg, compress=False, out_format="tsv"):
+    """ pubmed21n0001.xml and pubmed21n0001.xml.gz are both parsed to
+    pubmed21n0001.xml.tsv (or pubmed21n0001.xml.tsv.gz if compressed), or to
+    pubmed21n0001.xml.parquet in the parquet format"""
+    if file_arg.endswith(".gz"):
+        file_arg = file_arg[:-3]
+    if out_format == "parquet":
+        return file_arg + ".parquet"
+    return file_arg + ".tsv" + (".gz" if compress else "")
+
+
+def iter_articles(file_arg):
+    """ Streams the PubmedArticle elements of the XML file using incremental
+    parsing. Each article is cleared from the tree once the caller is done
+    with it, so memory does not grow with the size of the file"""
+    with open_file(file_arg) as xml_file:
+        context = ET.iterparse(xml_file, events=("start", "end"))
+        root = None
+        for event, elem in context:
+            if root is None:
+                root = elem
+            if event == "end" and elem.tag == 'PubmedArticle':
+                yield elem
+                # drop the processed article (and any DeleteCitation siblings)
+                root.clear()
+
+
+class AbstractWriter(object):
+    """ Writes batches of parsed abstracts to a TSV or a Parquet file. Each batch
+    becomes a row group in the Parquet file, so readers can load only the
+    columns they need"""
+    def __init__(self, out_path, columns, out_format="tsv", compress=False):
+        self.columns = columns
+        self.out_format = out_format
+        self.written = 0
+        if out_format == "parquet":
+            if pq is None:
+                raise ImportError("pyarrow is required for the parquet format")
+            self.schema = pa.schema([(k, pa.string()) for k in columns])
+            self.out_file = pq.ParquetWriter(
+                out_path, self.schema, compression="gzip" if compress else "snappy")
+        else:
+            self.out_file = open_file(out_path, "wt")
+
+    def write(self, abstracts):
+        abstracts_df = pd.DataFrame.from_dict(abstracts, orient="index")
+        abstracts_df = abstracts_df.reset_index().reindex(columns=self.columns)
+        if self.out_format == "parquet":
+            self.out_file.write_table(pa.Table.from_pandas(
+                abstracts_df, schema=self.schema, preserve_index=False))
+        else:
+            abstracts_df.to_csv(self.out_file, sep="\t", index=None, header=self.written == 0)
+        self.written += abstracts_df.shape[0]
+        return abstracts_df.shape[0]
+
+    def close(self):
+        self.out_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def replace_records(out_path, records, columns, out_format="tsv", compress=False):
+    """ Replaces the records of PMIDs already written to a parsed file, when a
+    PMID is found again after its first record was written in an earlier batch.
+    The file is rewritten to a temporary file first and then moved in place"""
+    if out_format == "parquet":
+        written = pd.read_parquet(out_path)
+    else:
+        written = pd.read_csv(out_path, sep="\t", dtype=str, keep_default_na=False)
+    written = written.set_index("index", drop=True)
+    abstracts = written.to_dict(orient="index")
+    abstracts.update(records)
+    tmp_path = out_path + ".tmp" + (".gz" if out_path.endswith(".gz") else "")
+    with AbstractWriter(tmp_path, columns, out_format=out_format, compress=compress) as out_file:
+        out_file.write(abstracts)
+    os.replace(tmp_path, out_path)
+
+
+def parse(file_arg, include_mesh=True, include_abstract=True, verbose=False, batch_size=5000, compress=False,
+          out_format="tsv"):
     print("-----------------------------")
     print("Parsing", file_arg, "with mesh", include_mesh, "and abstract", include_abstract)
     abstracts = {}
-    tree = ET.parse(file_arg)
-    root = tree.getroot()
-    pubmed_articles = root.findall('PubmedArticle')
-    print("Found abstracts", len(pubmed_articles))
-    for act in pubmed_articles:
-        try:
-            cit = act.find('MedlineCitation')
-            pmid = cit.find('PMID').text
-            title = cit.find('Article').find('ArticleTitle').text
-            if include_abstract:
-                abstract = cit.find('Article').find(
-                    'Abstract').find('AbstractText').text
-            if include_mesh:
-                mesh_list = cit.find('MeshHeadingList').findall('MeshHeading')
-                mesh_formatted_list = []
-                if verbose:
-                    print("Mesh Headings found", len(mesh_list))
-                for k in mesh_list:
-                    mesh_fm = []
-                    descriptors = k.findall('DescriptorName')
-                    for descriptor in descriptors:
-                        info = parse_mesh(descriptor)
-                        mesh_fm.append(info)
-                    qualifiers = k.findall('QualifierName')
-                    for qualifier in qualifiers:
-                        info = parse_mesh(qualifier, is_qualifier=True)
-                        mesh_fm.append(info)
-                    mesh_formatted_list.append("||".join(mesh_fm))
-            if not pmid:
+    written_pmids = set()
+    late_records = {}
+    found = 0
+    columns = ["index", "title"] + (["abstract"] if include_abstract else []) + (["mesh"] if include_mesh else [])
+    out_path = get_output_file(file_arg, compress=compress, out_format=out_format)
+    with AbstractWriter(out_path, columns, out_format=out_format, compress=compress) as out_file:
+        for act in iter_articles(file_arg):
+            found += 1
+            parsed = parse_article(act, include_mesh=include_mesh,
+                                   include_abstract=include_abstract, verbose=verbose)
+            if parsed is None:
                 continue
-            if len(str(pmid)) > 0:
-                abstracts[pmid] = {"title": title}
-                if include_abstract:
-                    abstracts[pmid]['abstract'] = abstract
-                if include_mesh:
-                    abstracts[pmid]['mesh'] = ":-:".join(mesh_formatted_list)
-                if verbose: 
-                    print("Parsed", pmid)
-        except:
-            if verbose:
-                print('Parsing error')
-            continue
-    abstracts_df = pd.DataFrame.from_dict(abstracts, orient="index")
-    abstracts_df = abstracts_df.reset_index()
-    abstracts_df.to_csv(file_arg + ".tsv", sep="\t", index=None)
-    print("Extracted abstracts", abstracts_df.shape[0])
+            # As in a single dict of all the records, a PMID found again keeps its
+            # first position and its last record
+            if parsed[0] in written_pmids:
+                late_records[parsed[0]] = parsed[1]
+                continue
+            abstracts[parsed[0]] = parsed[1]
+            if len(abstracts) >= batch_size:
+                out_file.write(abstracts)
+                written_pmids.update(abstracts)
+                abstracts = {}
+        if len(abstracts) > 0 or out_file.written == 0:
+            out_file.write(abstracts)
+        extracted = out_file.written
+    if len(late_records) > 0:
+        replace_records(out_path, late_records, columns, out_format=out_format, compress=compress)
+    print("Found abstracts", found)
+    print("Extracted abstracts", extracted)
     print("-----------------------------")
+    return found, extracted
+
+
+def is_pubmed_xml(filename):
+    return filename.lower().endswith((".xml", ".xml.gz"))
+
+
+def parse_task(task):
+    """ Parses a file of parse_folder. Errors (e.g. a truncated XML or gzip file)
+    are returned with the file instead of aborting the other files, and the
+    partial output of the file is removed"""
+    file_arg, kwargs = task
+    start = time.time()
+    try:
+        found, extracted = parse(file_arg, **kwargs)
+    except Exception as e:
+        print("Error parsing", file_arg, ":", repr(e))
+        # A partial output would be counted by generate_dict as a parsed file
+        out_path = get_output_file(file_arg, compress=kwargs.get("compress", False),
+                                   out_format=kwargs.get("out_format", "tsv"))
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        return file_arg, 0, 0, time.time() - start, "error", repr(e)
+    return file_arg, found, extracted, time.time() - start, "ok", ""
 
 
-def save_file(tfdict, folder):
+def parse_folder(folder, workers=1, **kwargs):
+    """ Parses all the PubMed XML files in the folder using a pool of worker
+    processes. Files are handed out largest first, so that the run does not end
+    waiting on a single large file, and a manifest with the per-file record
+    counts and timings is saved in the folder. Files that fail to parse are
+    recorded in the manifest with their error, and the manifest is saved even
+    if the run is interrupted"""
+    # Only the files at the top of the folder are parsed, not those of its subfolders
+    # (e.g. doc_term/ or ngrams/)
+    file_sizes = dict([(k, os.path.getsize(folder + k)) for k in os.listdir(folder)
+                       if is_pubmed_xml(k) and os.path.isfile(folder + k)])
+    xml_files = sorted(file_sizes, key=lambda x: file_sizes[x], reverse=True)
+    print("Found", len(xml_files), "XML files in", folder, "using", workers, "workers")
+    tasks = [(folder + k, kwargs) for k in xml_files]
+    manifest = []
+    start = time.time()
+    try:
+        with Pool(workers) as pool:
+            for file_arg, found, extracted, seconds, status, error in pool.imap_unordered(parse_task, tasks):
+                xml_file = os.path.basename(file_arg)
+                manifest.append([xml_file, file_sizes[xml_file], found, extracted, round(seconds, 3), status, error])
+    finally:
+        manifest_df = pd.DataFrame(manifest, columns=["file", "size", "found", "extracted", "seconds", "status",
+                                                      "error"])
+        manifest_df = manifest_df.sort_values("file")
+        manifest_df.to_csv(folder + "parse_manifest.tsv", sep="\t", index=None)
+    n_errors = (manifest_df["status"] == "error").sum()
+    print("Parsed", len(manifest) - n_errors, "files,", manifest_df["extracted"].sum(),
+          "abstracts extracted in", round(time.time() - start, 1), "seconds")
+    if n_errors > 0:
+        print(n_errors, "files could not be parsed, see the error column of", folder + "parse_manifest.tsv")
+    return manifest_df
+
+
+def is_parsed_file(filename, in_format="tsv"):
+    return "pubmed" in filename.lower() and filename.endswith(OUTPUT_FORMATS[in_format])
+
+
+def read_parsed(file_path, columns=None):
+    """ Reads a parsed TSV or Parquet file, loading only the given columns"""
+    if file_path.endswith(".parquet"):
+        return pd.read_parquet(file_path, columns=columns)
+    return pd.read_csv(file_path, sep="\t", usecols=columns)
+
+
+def save_checkpoint(checkpoint, folder):
+    """ Saves the checkpoint of generate_dict: the word frequencies ("counts"),
+    the files counted so far ("files") and, once a document-term matrix is
+    built, its state ("doc_term", see DocTermMatrix.state), as a single pickled
+    file (word_freq.checkpoint). It is written to a temporary file first and
+    then moved in place, so the counts and the files they include are replaced
+    at once, and an interrupted run always leaves the last complete checkpoint
+    behind"""
+    mfio = MatrixIO()
+    mfio.save_matrix(checkpoint, folder + CHECKPOINT_FILE + ".tmp")
+    os.replace(folder + CHECKPOINT_FILE + ".tmp", folder + CHECKPOINT_FILE)
+
+
+def save_file(tfdict, folder, checkpoint=None):
+    """ Saves the word frequencies (word_freq.dict) and the words found at least
+    MIN_FREQ times (word_freq.tsv), after the checkpoint if it is given"""
+    if checkpoint is not None:
+        save_checkpoint(checkpoint, folder)
     mfio = MatrixIO()
-    mfio.save_matrix(tfdict, folder + "word_freq.dict")
+    mfio.save_matrix(tfdict, folder + "word_freq.dict.tmp")
+    os.replace(folder + "word_freq.dict.tmp", folder + "word_freq.dict")
     tfdict_df = pd.DataFrame.from_dict(tfdict, orient="index")
     tfdict_df = tfdict_df.reset_index()
     tfdict_df.columns = ["word", "freq"]
     tfdict_df = tfdict_df.sort_values("freq", ascending=False)
-    tfdict_df = tfdict_df[tfdict_df["freq"] >= 50]
+    tfdict_df = tfdict_df[tfdict_df["freq"] >= MIN_FREQ]
     tfdict_df.to_csv(folder + "word_freq.tsv", sep="\t", index=None)
 
 
+def load_checkpoint(folder):
+    """ Returns the checkpoint saved in the folder by a previous run (see
+    save_checkpoint), so that only new files are counted and merged into it"""
+    if os.path.exists(folder + CHECKPOINT_FILE):
+        return MatrixIO().load_matrix(folder + CHECKPOINT_FILE)
+    return {"counts": {}, "files": []}
+
+
+def get_counted_files(folder):
+    """ Returns the files already counted in the word frequencies saved in the
+    folder, or an empty list if there is no checkpoint"""
+    return load_checkpoint(folder)["files"]
+
+
 def get_freq_dict(folder):
-    # This needs to be filled out for later in an automated run when dictionary exists in the folder
-    return {}
+    """ Returns the word frequencies saved in the folder by a previous run"""
+    return load_checkpoint(folder)["counts"]
+
+
+def count_words(file_path):
+    """ Map step of generate_dict: counts the normalized words of the titles and
+    abstracts in a single parsed file"""
+    a = read_parsed(file_path, columns=["title", "abstract"])
+    partial = Counter()
+    for title, abstract in zip(a["title"].values, a["abstract"].values):
+        text = "{} {}".format(normalize(title), normalize(abstract))
+        partial.update(text.split())
+    return a.shape[0], partial
 
 
-def generate_dict(folder):
-    tsv_files = [a for a in os.listdir(folder) if "pubmed" in a.lower()]
-    tfdict = get_freq_dict(folder)
+def count_document_words(file_path):
+    """ Map step of generate_dict with the document-term matrix: counts the
+    normalized words of each title and abstract in a single parsed file. The
+    counts are returned as a CSR matrix of PMID rows and columns indexing the
+    words of the file in order of first occurrence, and the overall counts of
+    the file are the column sums of the matrix"""
+    a = read_parsed(file_path, columns=["index", "title", "abstract"])
+    words, matrix = document_term_matrix(a["title"].values, a["abstract"].values)
+    partial = dict(zip(words, np.asarray(matrix.sum(axis=0)).ravel().tolist()))
+    return a.shape[0], partial, (a["index"].astype(str).values.tolist(), words, matrix)
+
+
+def document_term_matrix(titles, abstracts):
+    """ Returns the words in order of first occurrence and the CSR matrix of the
+    counts of the normalized words of each title and abstract"""
+    words = {}
+    indptr, indices, data = [0], [], []
+    for title, abstract in zip(titles, abstracts):
+        text = "{} {}".format(normalize(title), normalize(abstract))
+        doc_counts = Counter([words.setdefault(k, len(words)) for k in text.split()])
+        indices.extend(doc_counts.keys())
+        data.extend(doc_counts.values())
+        indptr.append(len(indices))
+    matrix = sparse.csr_matrix((np.array(data, dtype=np.int32), np.array(indices, dtype=np.int32),
+                                np.array(indptr, dtype=np.int64)), shape=(len(indptr) - 1, len(words)))
+    return list(words), matrix
+
+
+class DocTermMatrix(object):
+    """ Sparse document-term matrix of the parsed files in a folder, saved with
+    MatrixIO in a doc_term subfolder as one shard per file (a CSR matrix of the
+    PMIDs of the file by the words of the vocabulary). Words are added to the
+    vocabulary in the order they are found, so the columns of the saved shards
+    do not change as new files are added, and earlier shards only have fewer
+    columns. The vocabulary, the document frequencies (number of documents
+    containing each word) and the files with a shard are saved in the
+    generate_dict checkpoint, so they always match the saved shards"""
+    def __init__(self, folder, state=None):
+        self.folder = folder + DOC_TERM_FOLDER
+        self.mfio = MatrixIO()
+        if state is None:
+            state = {"vocab": [], "doc_freq": np.zeros(0, dtype=np.int64), "files": []}
+        self.vocab = list(state["vocab"])
+        self.doc_freq = state["doc_freq"]
+        self.files = list(state["files"])
+        self.word_ids = dict([(k, i) for i, k in enumerate(self.vocab)])
+
+    def state(self):
+        return {"vocab": self.vocab, "doc_freq": self.doc_freq, "files": self.files}
+
+    def shard_file(self, file_name):
+        return self.folder + file_name + ".csr"
+
+    def add(self, file_name, pmids, words, matrix):
+        """ Maps the columns of a file's matrix to the vocabulary, updates the
+        document frequencies and saves the shard of the file"""
+        word_ids = self.word_ids
+        for k in words:
+            if k not in word_ids:
+                word_ids[k] = len(self.vocab)
+                self.vocab.append(k)
+        columns = np.array([word_ids[k] for k in words], dtype=np.int32)
+        shard = sparse.csr_matrix((matrix.data, columns[matrix.indices], matrix.indptr),
+                                  shape=(matrix.shape[0], len(self.vocab)))
+        shard.sort_indices()
+        doc_freq = np.zeros(len(self.vocab), dtype=np.int64)
+        doc_freq[:len(self.doc_freq)] = self.doc_freq
+        doc_freq += np.bincount(shard.indices, minlength=len(self.vocab))
+        self.doc_freq = doc_freq
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.mfio.save_matrix({"pmids": pmids, "matrix": shard}, self.shard_file(file_name) + ".tmp")
+        os.replace(self.shard_file(file_name) + ".tmp", self.shard_file(file_name))
+        self.files.append(file_name)
+
+    def load(self):
+        """ Returns the PMIDs and the stacked document-term matrix of the shards
+        of the files, with the columns of the whole vocabulary"""
+        pmids, matrices = [], []
+        for k in self.files:
+            shard = self.mfio.load_matrix(self.shard_file(k))
+            matrix = shard["matrix"]
+            pmids.extend(shard["pmids"])
+            matrices.append(sparse.csr_matrix((matrix.data, matrix.indices, matrix.indptr),
+                                              shape=(matrix.shape[0], len(self.vocab))))
+        if len(matrices) == 0:
+            return pmids, sparse.csr_matrix((0, len(self.vocab)), dtype=np.int32)
+        return pmids, sparse.vstack(matrices, format="csr")
+
+
+def load_doc_term_matrix(folder):
+    """ Returns the PMIDs, the document-term matrix, the vocabulary and the
+    document frequencies saved by generate_dict with the document-term matrix.
+    Files counted by a run without the matrix are left out until a run with the
+    matrix adds them"""
+    checkpoint = load_checkpoint(folder)
+    if "doc_term" not in checkpoint:
+        raise IOError("No document-term matrix saved in " + folder)
+    doc_term = DocTermMatrix(folder, checkpoint["doc_term"])
+    missing = len(set(checkpoint["files"]) - set(doc_term.files))
+    if missing > 0:
+        print(missing, "files counted in", folder, "are not in the document-term matrix,",
+              "run generate_dict with the matrix to add them")
+    pmids, matrix = doc_term.load()
+    return pmids, matrix, doc_term.vocab, doc_term.doc_freq
+
+
+def merge_counts(tfdict, partial):
+    """ Reduce step of generate_dict: adds the partial counts of a file to the
+    overall counts. Partial counts are merged in the order of the files, so the
+    words end up in the same order as when the files are counted one by one"""
+    for d, count in partial.items():
+        tfdict[d] = tfdict.get(d, 0) + count
+    return tfdict
+
+
+def generate_dict(folder, in_format="tsv", workers=1, doc_term_matrix=False):
+    checkpoint = load_checkpoint(folder)
+    counted_files, tfdict = checkpoint["files"], checkpoint["counts"]
+    doc_term = DocTermMatrix(folder, checkpoint.get("doc_term")) if doc_term_matrix else None
+    already_counted = set(counted_files)
+    tsv_files = [a for a in os.listdir(folder) if is_parsed_file(a, in_format) and not a in already_counted]
+    # Files counted by runs without the document-term matrix only get their shards
+    missing_shards = [k for k in counted_files if k not in set(doc_term.files)] if doc_term else []
     tcount = 0
     print("-----------------------------")
-    print("Found", len(tsv_files), "in", folder)
-    for k in tsv_files:
-        a = pd.read_csv(folder + k, sep="\t")
-        print("Abstracts found", a.shape[0], "in", k)
-        a = a.set_index("index").to_dict(orient="index")
-        for pmid in a:
-            text = "{} {}".format(
-                normalize(a[pmid]["title"]), normalize(a[pmid]["abstract"]))
-            text_parts = text.split()
-            for d in text_parts:
-                if not d in tfdict:
-                    tfdict[d] = 0
-                tfdict[d] += 1
-        print("Words found so far", len(tfdict), ", Completed file", tcount)
-        tcount += 1
-        print("----------------------------")
-        if tcount % 10 == 0:
-            save_file(tfdict, folder)
-    save_file(tfdict, folder)
+    print("Found", len(tsv_files), "new files in", folder, "using", workers, "workers,",
+          len(counted_files), "files already counted")
+    if len(missing_shards) > 0:
+        print("Adding", len(missing_shards), "files already counted to the document-term matrix")
+    tasks = [folder + k for k in missing_shards + tsv_files]
+    # With the document-term matrix, the words of each document are counted in the same pass
+    count_function = count_document_words if doc_term else count_words
+    pool = Pool(workers) if workers > 1 else None
+    partial_counts = pool.imap(count_function, tasks) if pool else map(count_function, tasks)
+    try:
+        for i, (k, counts) in enumerate(zip(missing_shards + tsv_files, partial_counts)):
+            n_abstracts, partial = counts[0], counts[1]
+            if doc_term:
+                doc_term.add(k, *counts[2])
+                checkpoint["doc_term"] = doc_term.state()
+            if i < len(missing_shards):
+                print("Document-term matrix of", n_abstracts, "abstracts added for", k)
+            else:
+                print("Abstracts found", n_abstracts, "in", k)
+                merge_counts(tfdict, partial)
+                counted_files.append(k)
+                print("Words found so far", len(tfdict), ", Completed file", tcount)
+                tcount += 1
+            print("----------------------------")
+            if (i + 1) % 10 == 0:
+                save_checkpoint(checkpoint, folder)
+    finally:
+        if pool:
+            pool.terminate()
+    save_file(tfdict, folder, checkpoint)
 
 
 def init_main(args):
     if args.mode == "parse":
-        if not args.file:
-            print("Please provide the XML file to parse as input")
+        parse_args = {"include_abstract": str_to_bool(args.abstract),
+                      "include_mesh": str_to_bool(args.mesh),
+                      "batch_size": args.batchsize,
+                      "compress": str_to_bool(args.compress),
+                      "out_format": args.format}
+        if args.file:
+            parse(args.file, **parse_args)
+        elif args.folder and os.path.isdir(args.folder):
+            parse_folder(args.folder, workers=args.workers, **parse_args)
+        else:
+            print("Please provide the XML file or the folder of XML files to parse as input")
             return None
-        parse(args.file, include_abstract=str_to_bool(args.abstract), include_mesh=str_to_bool(args.mesh))
     elif args.mode == "generate":
         if not args.folder:
             print("Please provide the folder from which to generate the dictionary")
             return None
-        generate_dict(args.folder)
+        generate_dict(args.folder, in_format=args.format, workers=args.workers,
+                      doc_term_matrix=str_to_bool(args.matrix))
     else:
         print("Please provide parse or generate mode")
         return None
@@ -157,11 +558,20 @@ if __name__ == "__main__":
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description=__doc__
     )
-    parser.add_argument("--file", help="pubmed XML file")
+    parser.add_argument("--file", help="pubmed XML file (plain or .xml.gz)")
     parser.add_argument("--mode", help="parse or generate")
     parser.add_argument("--mesh", help="include Mesh headers", default="true")
     parser.add_argument("--abstract", help="include Abstract", default="true")
+    parser.add_argument("--format", choices=sorted(OUTPUT_FORMATS), default="tsv",
+                        help="format of the parsed abstracts written in parse mode and read in generate mode")
+    parser.add_argument("--compress", help="gzip the parsed output", default="false")
+    parser.add_argument("--batchsize", type=int, default=5000,
+                        help="number of parsed abstracts written to the output at a time")
+    parser.add_argument("--matrix", default="false",
+                        help="in generate mode, also save the document-term matrix and document frequencies")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes used to parse a folder of XML files or to generate the dictionary")
     parser.add_argument(
-        "--folder", help="If mode is generate, please provide the folder from which to generate dictionary")
+        "--folder", help="If mode is parse, the folder of XML files to parse. If mode is generate, please provide the folder from which to generate dictionary")
     args = parser.parse_args()
     init_main(args)
@@ -0,0 +1,72 @@
+import os
+import random
+import sys
+
+import numpy as np
+import pandas as pd
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(os.path.join(parentdir, "pubmed_retrieval"))
+
+from bm25_index import build_index
+from pubmed_parser import normalize
+
+WORDS = ["cancer", "cell", "protein", "gene", "mutation", "brca1", "breast", "tumor", "mice", "therapy",
+         "expression", "receptor", "the", "of", "and"]
+QUERIES = ["brca1 mutation", "breast cancer therapy", "protein expression of the receptor", "mice", "the"]
+
+
+def random_text(rng):
+    return " ".join(rng.choice(WORDS) for i in range(rng.randint(3, 30)))
+
+
+def write_parsed(file_path, documents):
+    pd.DataFrame([(pmid, title, abstract, "") for pmid, (title, abstract) in documents],
+                 columns=["index", "title", "abstract", "mesh"]).to_csv(file_path, sep="\t", index=None)
+
+
+def brute_force(documents, query, k1=1.2, b=0.75):
+    # BM25 scores of the documents matching the query terms
+    tokens = dict([(pmid, normalize(title).split() + normalize(abstract).split())
+                   for pmid, (title, abstract) in documents.items()])
+    avg_length = sum(len(k) for k in tokens.values()) / len(tokens)
+    scores = {}
+    for term in dict.fromkeys(normalize(query).split()):
+        doc_freq = sum(term in k for k in tokens.values())
+        idf = np.log(1 + (len(tokens) - doc_freq + 0.5) / (doc_freq + 0.5))
+        for pmid, words in tokens.items():
+            tf = words.count(term)
+            if tf > 0:
+                norm = k1 * (1 - b + b * len(words) / avg_length)
+                scores[pmid] = scores.get(pmid, 0) + idf * (k1 + 1) * tf / (tf + norm)
+    return scores
+
+
+def test_replaced_documents(tmp_path):
+    rng = random.Random(0)
+    updated_folder, fresh_folder = str(tmp_path / "updated") + os.sep, str(tmp_path / "fresh") + os.sep
+    os.makedirs(updated_folder)
+    os.makedirs(fresh_folder)
+    live = {}
+    # Each file replaces some of the PMIDs of the earlier files, and of its own
+    for f in range(4):
+        documents = [(pmid, (random_text(rng), random_text(rng)))
+                     for pmid in rng.sample(range(1, 200), 120) + rng.sample(range(1, 200), 10)]
+        write_parsed(updated_folder + "pubmed%02d.xml.tsv" % f, documents)
+        live.update(documents)
+    write_parsed(fresh_folder + "pubmed00.xml.tsv", sorted(live.items()))
+
+    updated = build_index(updated_folder, files_per_segment=1)
+    fresh = build_index(fresh_folder)
+    assert len(updated.segments) == 4
+    assert updated.n_documents == fresh.n_documents == len(live)
+    for query in QUERIES:
+        expected = brute_force(live, query)
+        for index in [updated, fresh]:
+            results = index.search(query, k=len(live))
+            assert sorted(results["pmid"].tolist()) == sorted(expected)
+            np.testing.assert_allclose(results["score"].values,
+                                       [expected[k] for k in results["pmid"].tolist()], rtol=1e-9)
+            best = sorted(expected, key=lambda k: (-expected[k], k))[:5]
+            assert index.search(query, k=5)["pmid"].tolist() == best
@@ -0,0 +1,43 @@
+import os
+import pickle
+import sys
+
+import networkx as nx
+import pytest
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(os.path.join(parentdir, "pubmed_retrieval"))
+
+import graph_store
+from concept_annotator import graph_labels
+
+
+def model2_graph():
+    umls_G = nx.DiGraph()
+    umls_G.add_node("C0011849", node_type="UMLS_CUI")
+    umls_G.add_node("73211009", node_type="SNOMEDCT_US", preflabels=set(["diabetes mellitus"]),
+                    altlabels=set(["dm", "diabetes"]))
+    umls_G.add_node("E11", node_type="ICD10CM", preflabels=set(["type 2 diabetes mellitus"]))
+    umls_G.add_edge("73211009", "C0011849", edge_type="HAS_CUI")
+    umls_G.add_edge("E11", "73211009", edge_type="IS_SUBCLASS_OF")
+    return umls_G
+
+
+def test_pickled_graph_labels(tmp_path):
+    umls_G = model2_graph()
+    pickle_path = str(tmp_path / "model2_umls_G.pickle")
+    with open(pickle_path, "wb") as graph_file:
+        pickle.dump(umls_G, graph_file)
+    # The labels of E11, without a CUI, are left out
+    expected = [("diabetes mellitus", "C0011849"), ("diabetes", "C0011849"), ("dm", "C0011849")]
+    assert sorted(graph_labels(pickle_path)) == sorted(expected)
+    if graph_store.pa is not None:
+        graph_folder = str(tmp_path / "model2_umls_graph") + os.sep
+        graph_store.save_graph_stage(umls_G, graph_folder, "labels", "model2")
+        assert sorted(graph_labels(graph_folder)) == sorted(expected)
+
+
+def test_missing_graph(tmp_path):
+    with pytest.raises(IOError, match="umls_G.pickle"):
+        graph_labels(str(tmp_path) + os.sep)
@@ -0,0 +1,73 @@
+import itertools
+import os
+import random
+import sys
+
+import pytest
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+from utilities import gtbtokenize
+
+OPTIONS = ['ptb_escaping', 'use_single_quotes_only', 'escape_token_internal_parens']
+
+TEXTS = [
+    "",
+    " ",
+    "The protein(s) bind to IL-2 and TNF-alpha.",
+    "Patients (n = 12) were treated with 5 mg/kg [see Table 1].",
+    "He said \"no\" and 'yes', didn't he? It's 3:45 p.m., isn't it...",
+    "Values were 1,000.5 +/- 0.3%; p<0.05 & r>0.9 -- see {Fig. 2}!",
+    "Tab\tseparated\twords\tand\ttrailing tab\t",
+    "Carriage\rreturns\r\nand line\nbreaks\n\n",
+    "Quotes ``like this'' and \"nested 'quotes' here\" (\"start\")",
+    "Mixed\t(\"tab\")\r[quoted]\t{braces}\r\n",
+    "U.S.A. e.g. i.e. Dr. Smith's cells' growth cannot gonna wanna",
+    "Café α-helix – “unicode quotes” µM 37°C",
+]
+
+ALPHABET = "ab AB 01 .,;:!?'\"()[]{}<>-/+=%$#@&*`~\t\réα–"
+
+
+def random_texts(n, seed=0):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 40))) for _ in range(n)]
+
+
+@pytest.mark.parametrize('text', TEXTS + random_texts(500))
+def test_fast_core_matches_reference(text):
+    # The cores take the text with a leading and a trailing space and without newlines
+    s = ' ' + text.replace('\n', ' ') + ' '
+    assert gtbtokenize._tokenize_fast(s) == gtbtokenize._tokenize(s)
+
+
+@pytest.mark.parametrize('values', list(itertools.product([False, True], repeat=len(OPTIONS))))
+def test_fast_tokenization_matches_reference(values):
+    kwargs = dict(zip(OPTIONS, values))
+    n, mismatches = gtbtokenize.check_fast_tokenization(TEXTS + random_texts(300, seed=1), **kwargs)
+    assert n == len(TEXTS) + 300
+    assert mismatches == []
+
+
+@pytest.mark.parametrize('values', list(itertools.product([False, True], repeat=len(OPTIONS))))
+def test_token_spans(values):
+    kwargs = dict(zip(OPTIONS, values))
+    for text in TEXTS + random_texts(300, seed=2) + ["a ,1'\n ", ";;\n ", "end.\n\n"]:
+        tokens, spans = gtbtokenize.tokenize_spans(text, **kwargs)
+        assert tokens == gtbtokenize.tokenize(text, **kwargs).split()
+        assert len(spans) == 2 * len(tokens)
+        previous_end = 0
+        for k in range(len(tokens)):
+            start, end = spans[2 * k], spans[2 * k + 1]
+            assert previous_end <= start < end <= len(text)
+            assert text[start:end].strip() == text[start:end]
+            previous_end = end
+
+
+def test_token_spans_batch():
+    texts = TEXTS + random_texts(50, seed=3)
+    expected = [gtbtokenize.tokenize_spans(k) for k in texts]
+    assert list(gtbtokenize.tokenize_batch(texts, spans=True)) == expected
+    assert list(gtbtokenize.tokenize_batch(texts, jobs=2, chunksize=8, spans=True)) == expected
@@ -0,0 +1,78 @@
+import os
+import random
+import sys
+
+import networkx as nx
+import pytest
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(os.path.join(parentdir, "umls_knowledge_graph"))
+
+from hierarchy_index import HierarchyIndex, HIERARCHY_EDGE_TYPE
+
+
+def add_edge(umls_G, child, parent):
+    umls_G.add_edge(child, parent, edge_type=HIERARCHY_EDGE_TYPE)
+
+
+def check_index(index, umls_G):
+    # The descendants of a node are the nodes with a path to it, its ancestors the nodes it reaches
+    for name in umls_G.nodes:
+        assert index.descendants(name) == nx.ancestors(umls_G, name), name
+        assert index.ancestors(name) == nx.descendants(umls_G, name), name
+
+
+def test_removed_node_added_again():
+    umls_G = nx.DiGraph()
+    add_edge(umls_G, 'A', 'B')
+    add_edge(umls_G, 'C', 'D')
+    index = HierarchyIndex.from_graph(umls_G)
+    umls_G.remove_node('A')
+    index.update(umls_G, [('A', 'B')])
+    assert not index.has_node('A')
+    add_edge(umls_G, 'A', 'D')
+    index.update(umls_G, [('A', 'D')])
+    assert index.descendants('D') == set(['C', 'A'])
+    assert index.ancestors('A') == set(['D'])
+    assert index.descendants('B') == set([])
+
+
+def test_missing_changed_edges():
+    umls_G = nx.DiGraph()
+    add_edge(umls_G, 'A', 'B')
+    index = HierarchyIndex.from_graph(umls_G)
+    add_edge(umls_G, 'C', 'A')
+    add_edge(umls_G, 'D', 'A')
+    with pytest.raises(KeyError):
+        index.update(umls_G, [('D', 'A')])
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_update_matches_networkx(seed):
+    rng = random.Random(seed)
+    names = ['N%d' % k for k in range(40)]
+    umls_G = nx.DiGraph()
+    for _ in range(60):
+        child, parent = rng.sample(names, 2)
+        add_edge(umls_G, child, parent)
+    index = HierarchyIndex.from_graph(umls_G)
+    check_index(index, umls_G)
+    for _ in range(30):
+        operation = rng.random()
+        if operation < 0.4:
+            changed = [tuple(rng.sample(names, 2)) for _ in range(rng.randint(1, 3))]
+            for child, parent in changed:
+                add_edge(umls_G, child, parent)
+        elif operation < 0.7 and umls_G.number_of_edges() > 0:
+            changed = rng.sample(list(umls_G.edges), min(umls_G.number_of_edges(), rng.randint(1, 3)))
+            umls_G.remove_edges_from(changed)
+        elif umls_G.number_of_nodes() > 0:
+            # removed nodes are often added again by the following updates
+            name = rng.choice(list(umls_G.nodes))
+            changed = list(umls_G.in_edges(name)) + list(umls_G.out_edges(name))
+            umls_G.remove_node(name)
+        else:
+            continue
+        index.update(umls_G, changed)
+        check_index(index, umls_G)
@@ -0,0 +1,20 @@
+import os
+import sys
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(os.path.join(parentdir, "pubmed_retrieval"))
+
+from ngram_counter import write_run, read_run, read_header, merge_runs
+
+
+def test_runs_are_utf8(tmp_path):
+    # Runs are read and written as UTF-8 whatever the locale
+    first, second = str(tmp_path / "first.run"), str(tmp_path / "second.run")
+    write_run([("müller cells", 2), ("α-helix", 1)], first, header=["2", "pubmed_ä.xml.tsv"])
+    write_run([("müller cells", 3), ("β-catenin", 4)], second)
+    with open(first, "rb") as run_in:
+        assert run_in.read() == "#2\tpubmed_ä.xml.tsv\nmüller cells\t2\nα-helix\t1\n".encode("utf-8")
+    assert read_header(first) == ["2", "pubmed_ä.xml.tsv"]
+    assert list(read_run(first)) == [("müller cells", 2), ("α-helix", 1)]
+    assert list(merge_runs([first, second])) == [("müller cells", 5), ("α-helix", 1), ("β-catenin", 4)]
@@ -0,0 +1,62 @@
+import os
+import sys
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(os.path.join(parentdir, "pubmed_retrieval"))
+
+import pubmed_parser
+
+XML = ('<?xml version="1.0" ?>\n<PubmedArticleSet>\n'
+       '<PubmedArticle><MedlineCitation Status="MEDLINE"><PMID Version="1">%d</PMID>'
+       '<Article><ArticleTitle>Title %d</ArticleTitle>'
+       '<Abstract><AbstractText>Abstract of the article.</AbstractText></Abstract></Article>'
+       '<MeshHeadingList><MeshHeading><DescriptorName UI="D006801" MajorTopicYN="N">Humans</DescriptorName>'
+       '</MeshHeading></MeshHeadingList></MedlineCitation></PubmedArticle>\n</PubmedArticleSet>\n')
+
+
+def write_xml(file_path, pmid):
+    with open(file_path, "w", encoding="utf-8") as xml_file:
+        xml_file.write(XML % (pmid, pmid))
+
+
+def test_parse_folder_with_subfolders(tmp_path):
+    folder = str(tmp_path) + os.sep
+    write_xml(folder + "pubmed21n0001.xml", 1)
+    write_xml(folder + "pubmed21n0002.xml", 2)
+    # Subfolders (e.g. doc_term/ of generate_dict) and their files are not parsed
+    os.makedirs(folder + "doc_term")
+    os.makedirs(folder + "nested.xml")
+    write_xml(folder + "doc_term/pubmed21n0003.xml", 3)
+
+    manifest = pubmed_parser.parse_folder(folder, workers=1)
+    assert sorted(manifest["file"]) == ["pubmed21n0001.xml", "pubmed21n0002.xml"]
+    assert list(manifest["status"]) == ["ok", "ok"]
+    assert list(manifest["extracted"]) == [1, 1]
+    assert os.path.exists(folder + "pubmed21n0001.xml.tsv")
+    assert os.path.exists(folder + "pubmed21n0002.xml.tsv")
+    assert not os.path.exists(folder + "doc_term/pubmed21n0003.xml.tsv")
+
+
+def test_generate_dict_checkpoint(tmp_path):
+    folder = str(tmp_path) + os.sep
+    for pmid in [1, 2]:
+        write_xml(folder + "pubmed21n000%d.xml" % pmid, pmid)
+    pubmed_parser.parse_folder(folder, workers=1)
+
+    pubmed_parser.generate_dict(folder)
+    checkpoint = pubmed_parser.load_checkpoint(folder)
+    assert sorted(checkpoint) == ["counts", "files"]
+    assert sorted(checkpoint["files"]) == ["pubmed21n0001.xml.tsv", "pubmed21n0002.xml.tsv"]
+    assert checkpoint["counts"]["abstract"] == 2
+
+    # The files already counted get their document-term shards without being counted again
+    pubmed_parser.generate_dict(folder, doc_term_matrix=True)
+    checkpoint = pubmed_parser.load_checkpoint(folder)
+    assert sorted(checkpoint) == ["counts", "doc_term", "files"]
+    assert sorted(checkpoint["doc_term"]["files"]) == sorted(checkpoint["files"])
+    assert checkpoint["counts"]["abstract"] == 2
+    pmids, matrix, vocab, doc_freq = pubmed_parser.load_doc_term_matrix(folder)
+    assert sorted(pmids) == ["1", "2"]
+    assert matrix.shape == (2, len(vocab))
+    assert doc_freq[vocab.index("abstract")] == 2
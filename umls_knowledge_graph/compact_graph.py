@@ -0,0 +1,264 @@
+import numpy as np
+import pandas as pd
+import networkx as nx
+
+EDGE_TYPES = ['IS_SUBCLASS_OF', 'HAS_CUI']
+
+# Terminology membership is stored as a bitmask, one bit per terminology
+MAX_VOCABS = 64
+
+
+class StringPool(object):
+    # Interned strings with integer ids, in order of insertion
+
+    def __init__(self):
+        self.strings = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getstate__(self):
+        # The index is rebuilt on load, which is faster than pickling the dict
+        return {'strings': self.strings}
+
+    def __setstate__(self, state):
+        self.strings = state['strings']
+        self.index = dict([(k, i) for i, k in enumerate(self.strings)])
+
+    def intern(self, values):
+        # Returns the ids of the values, adding the new values to the pool
+        codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+        unique_ids = np.empty(len(uniques), dtype=np.int64)
+        for i, k in enumerate(uniques):
+            j = self.index.get(k)
+            if j is None:
+                j = len(self.strings)
+                self.index[k] = j
+                self.strings.append(k)
+            unique_ids[i] = j
+        return unique_ids[codes]
+
+    def lookup(self, values):
+        # Returns the ids of the values, -1 for the values not in the pool
+        return np.array([self.index.get(k, -1) for k in values], dtype=np.int64)
+
+
+def csr(rows, values, n_rows):
+    # Offsets and values of a compressed sparse row layout of (row, value) pairs
+    order = np.argsort(rows, kind='stable')
+    offsets = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=offsets[1:])
+    return offsets, values[order]
+
+
+def unique_pairs(rows, values):
+    pairs = pd.DataFrame({'row': rows, 'value': values}).drop_duplicates()
+    return pairs['row'].values, pairs['value'].values
+
+
+class CompactUMLSGraph(object):
+    """Array-backed UMLS knowledge graph, an alternative to the networkx DiGraph
+    built by UMLSGraphCreator with the same nodes, edges and attributes.
+
+    Nodes have integer ids, their names (CUIs/codes) are interned in node_names.
+    Labels and vocabulary codes are ids into a shared label pool, stored per node
+    in CSR layout (offsets into an id array). Edges are stored in CSR layout by
+    source node, with their type and, for model1, a bitmask of the terminologies
+    asserting them. Nodes also have a bitmask of the terminologies of their terms.
+    """
+
+    def __init__(self, model_type="model1"):
+        self.model_type = model_type
+        self.node_names = StringPool()
+        self.node_type_names = StringPool()
+        self.labels = StringPool()
+        self.vocabs = StringPool()
+        self.node_types = np.zeros(0, dtype=np.int16)
+        self.node_vocabs = np.zeros(0, dtype=np.uint64)
+        self.has_labels = np.zeros(0, dtype=bool)
+        empty = (np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32))
+        self.preflabels, self.altlabels, self.vocabcodes = empty, empty, empty
+        self.edge_offsets = np.zeros(1, dtype=np.int64)
+        self.edge_targets = np.zeros(0, dtype=np.int32)
+        self.edge_types = np.zeros(0, dtype=np.int8)
+        self.edge_vocabs = np.zeros(0, dtype=np.uint64)
+
+    @classmethod
+    def from_tables(cls, umls_terms, alternate_labels, hierarchy_edges, model_type="model1"):
+        """Builds the graph from the selected terms and alternate labels extracted by
+        UMLSExtractor, and the hierarchical edges of umls_graph_creator.hierarchy_edge_table"""
+        graph = cls(model_type=model_type)
+        terms = umls_terms[['CUI', 'TS', 'AUI', 'SAB', 'CODE', 'STR']].astype(str)
+        graph.add_vocabs(pd.concat([terms['SAB'], hierarchy_edges['SAB'].astype(str)]))
+        term_vocab_bits = graph.vocab_bits(terms['SAB'])
+
+        # Model 1 nodes are CUIs, with the labels and codes of all their terms.
+        # Model 2 nodes are CUIs and terminology codes, the codes having the labels of their terms
+        if model_type == 'model1':
+            label_nodes = graph.add_nodes(terms['CUI'], pd.Series('UMLS_CUI', index=terms.index), True)
+            vocab_nodes = [label_nodes]
+        else:
+            cui_nodes = graph.add_nodes(terms['CUI'], pd.Series('UMLS_CUI', index=terms.index), False)
+            label_nodes = graph.add_nodes(terms['CODE'], terms['SAB'], True)
+            vocab_nodes = [cui_nodes, label_nodes]
+        for nodes in vocab_nodes:
+            np.bitwise_or.at(graph.node_vocabs, nodes, term_vocab_bits)
+
+        is_pref = (terms['TS'] == 'P').values
+        is_alt = (terms['TS'] == 'S').values
+        label_ids = graph.labels.intern(terms['STR'].str.lower())
+        pref_nodes, pref_ids = label_nodes[is_pref], label_ids[is_pref]
+        alt_nodes, alt_ids = label_nodes[is_alt], label_ids[is_alt]
+        if model_type == 'model1':
+            # alternate labels from the other terminologies, for the CUIs of the graph
+            alternate_labels = alternate_labels.astype(str)
+            alternate_nodes = graph.node_names.lookup(alternate_labels['CUI'])
+            found = alternate_nodes >= 0
+            alt_nodes = np.concatenate([alt_nodes, alternate_nodes[found]])
+            alt_ids = np.concatenate(
+                [alt_ids, graph.labels.intern(alternate_labels['STR'].str.lower())[found]])
+            vocabcodes = graph.labels.intern(terms['SAB'] + ": " + terms['CODE'])
+            graph.vocabcodes = graph.label_csr(label_nodes, vocabcodes)
+        graph.preflabels = graph.label_csr(pref_nodes, pref_ids)
+        graph.altlabels = graph.label_csr(alt_nodes, alt_ids)
+
+        hierarchy_edges = hierarchy_edges.astype(str)
+        sources = graph.node_names.lookup(hierarchy_edges['source'])
+        targets = graph.node_names.lookup(hierarchy_edges['target'])
+        edge_types = np.zeros(len(sources), dtype=np.int8)
+        edge_vocab_bits = graph.vocab_bits(hierarchy_edges['SAB'])
+        if model_type == 'model2':
+            edge_vocab_bits[:] = 0
+            # HAS_CUI edges come first, so that they are kept over hierarchical edges between the same nodes
+            sources = np.concatenate([label_nodes, sources])
+            targets = np.concatenate([cui_nodes, targets])
+            edge_types = np.concatenate(
+                [np.full(len(label_nodes), EDGE_TYPES.index('HAS_CUI'), dtype=np.int8), edge_types])
+            edge_vocab_bits = np.concatenate([np.zeros(len(label_nodes), dtype=np.uint64), edge_vocab_bits])
+        graph.set_edges(sources, targets, edge_types, edge_vocab_bits)
+        return graph
+
+    def add_vocabs(self, sabs):
+        self.vocabs.intern(pd.unique(sabs))
+        if len(self.vocabs) > MAX_VOCABS:
+            raise ValueError("At most %d terminologies are supported, found %d" % (MAX_VOCABS, len(self.vocabs)))
+
+    def vocab_bits(self, sabs):
+        return np.left_shift(np.uint64(1), self.vocabs.intern(sabs).astype(np.uint64))
+
+    def vocab_mask(self, sabs):
+        """Bitmask of the given terminologies, to test node_vocabs/edge_vocabs"""
+        ids = self.vocabs.lookup(sabs)
+        return np.bitwise_or.reduce(np.left_shift(np.uint64(1), ids[ids >= 0].astype(np.uint64)),
+                                    initial=np.uint64(0))
+
+    def add_nodes(self, names, node_types, has_labels):
+        # Interns the node names, new nodes taking the node type of their first occurrence
+        first_new = len(self.node_names)
+        ids = self.node_names.intern(names)
+        n_new = len(self.node_names) - first_new
+        if n_new > 0:
+            new_ids, first_rows = np.unique(ids, return_index=True)
+            is_new = new_ids >= first_new
+            type_ids = self.node_type_names.intern(np.asarray(node_types, dtype=object)[first_rows[is_new]])
+            node_types = np.zeros(n_new, dtype=np.int16)
+            node_types[new_ids[is_new] - first_new] = type_ids
+            self.node_types = np.concatenate([self.node_types, node_types])
+            self.node_vocabs = np.concatenate([self.node_vocabs, np.zeros(n_new, dtype=np.uint64)])
+            self.has_labels = np.concatenate([self.has_labels, np.full(n_new, has_labels)])
+        return ids
+
+    def label_csr(self, nodes, label_ids):
+        nodes, label_ids = unique_pairs(nodes, label_ids)
+        return csr(nodes, label_ids.astype(np.int32), len(self.node_names))
+
+    def set_edges(self, sources, targets, edge_types, edge_vocab_bits):
+        # Merges the duplicate edges (first edge type, union of the terminologies) into a CSR layout
+        order = np.lexsort((targets, sources))
+        sources, targets = sources[order], targets[order]
+        edge_types, edge_vocab_bits = edge_types[order], edge_vocab_bits[order]
+        starts = np.flatnonzero(np.concatenate(
+            [[True], (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])])) if len(order) > 0 else order
+        self.edge_offsets, self.edge_targets = csr(
+            sources[starts], targets[starts].astype(np.int32), len(self.node_names))
+        self.edge_types = edge_types[starts].astype(np.int8)
+        self.edge_vocabs = np.bitwise_or.reduceat(edge_vocab_bits, starts) if len(starts) > 0 \
+            else np.zeros(0, dtype=np.uint64)
+
+    def number_of_nodes(self):
+        return len(self.node_names)
+
+    def number_of_edges(self):
+        return len(self.edge_targets)
+
+    def has_node(self, name):
+        return name in self.node_names.index
+
+    def node_id(self, name):
+        return self.node_names.index[name]
+
+    def successor_ids(self, node):
+        return self.edge_targets[self.edge_offsets[node]:self.edge_offsets[node + 1]]
+
+    def successors(self, name):
+        return [self.node_names.strings[k] for k in self.successor_ids(self.node_id(name))]
+
+    def edge_index(self, source, target):
+        # Position of an edge in the edge arrays, -1 if not found (targets are sorted per source)
+        start, end = self.edge_offsets[source], self.edge_offsets[source + 1]
+        position = start + np.searchsorted(self.edge_targets[start:end], target)
+        if position < end and self.edge_targets[position] == target:
+            return position
+        return -1
+
+    def has_edge(self, u, v):
+        if not self.has_node(u) or not self.has_node(v):
+            return False
+        return self.edge_index(self.node_id(u), self.node_id(v)) >= 0
+
+    def vocab_set(self, bits):
+        return set([k for i, k in enumerate(self.vocabs.strings) if int(bits) >> i & 1])
+
+    def label_set(self, layout, node):
+        offsets, ids = layout
+        return set([self.labels.strings[k] for k in ids[offsets[node]:offsets[node + 1]]])
+
+    def node_attributes(self, name):
+        """Node attributes, as in the networkx graph"""
+        node = self.node_id(name)
+        attributes = {'node_type': self.node_type_names.strings[self.node_types[node]]}
+        if self.has_labels[node]:
+            if self.model_type == 'model1':
+                attributes['vocabcodes'] = self.label_set(self.vocabcodes, node)
+            attributes['preflabels'] = self.label_set(self.preflabels, node)
+            attributes['altlabels'] = self.label_set(self.altlabels, node)
+        return attributes
+
+    def edge_attributes(self, u, v):
+        """Edge attributes, as in the networkx graph"""
+        position = self.edge_index(self.node_id(u), self.node_id(v))
+        if position < 0:
+            raise KeyError((u, v))
+        attributes = {'edge_type': EDGE_TYPES[self.edge_types[position]]}
+        if self.model_type == 'model1':
+            attributes['vocab'] = self.vocab_set(self.edge_vocabs[position])
+        return attributes
+
+    def to_networkx(self):
+        """Exports the graph to a networkx DiGraph, with the same nodes, edges and attributes
+        as the graph built by UMLSGraphCreator"""
+        umls_G = nx.DiGraph()
+        for name in self.node_names.strings:
+            umls_G.add_node(name, **self.node_attributes(name))
+        names = self.node_names.strings
+        sources = np.repeat(np.arange(len(names)), np.diff(self.edge_offsets))
+        vocab_sets = {}
+        for source, target, edge_type, bits in zip(sources, self.edge_targets, self.edge_types, self.edge_vocabs):
+            attributes = {'edge_type': EDGE_TYPES[edge_type]}
+            if self.model_type == 'model1':
+                if bits not in vocab_sets:
+                    vocab_sets[bits] = self.vocab_set(bits)
+                attributes['vocab'] = set(vocab_sets[bits])
+            umls_G.add_edge(names[source], names[target], **attributes)
+        return umls_G
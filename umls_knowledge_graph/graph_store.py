@@ -0,0 +1,228 @@
+"""Columnar storage of the UMLS knowledge graph (networkx DiGraph).
+
+A graph is saved in a folder as a manifest and Arrow IPC (Feather) tables of
+nodes and edges, one node table and one edge table per stage (labels,
+hierarchies, relations). A stage only saves the nodes and edges it added or
+modified, and loading replays the stages in order. Set attributes are saved
+as list columns, missing attributes as nulls. Uncompressed tables are
+memory-mapped when loaded, and can be queried without building the graph
+(see load_graph_tables).
+"""
+
+import gc
+import json
+import os
+from contextlib import contextmanager
+import networkx as nx
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:
+    pa, feather = None, None
+
+# Version of the on-disk layout, checked when a graph is loaded
+GRAPH_FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+
+NODE_SET_ATTRIBUTES = ['vocabcodes', 'preflabels', 'altlabels']
+EDGE_SET_ATTRIBUTES = ['vocab', 'relas']
+
+
+@contextmanager
+def paused_gc():
+    # Pauses the garbage collector while the graph (or its tables) is built in bulk: the
+    # collections triggered by the many containers allocated would repeatedly scan the
+    # growing graph, while no reference cycles are created
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def check_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required to save and load the columnar knowledge graph")
+
+
+def string_array(values):
+    # Node names are strings, other names (e.g. numeric codes) are saved as their string
+    try:
+        return pa.array(values, pa.string())
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([str(k) for k in values], pa.string())
+
+
+def node_table(nodes):
+    # Table of (node, attributes) pairs
+    names, node_types = [], []
+    sets = dict([(k, []) for k in NODE_SET_ATTRIBUTES])
+    for n, attributes in nodes:
+        names.append(n)
+        node_types.append(attributes.get('node_type'))
+        for k in NODE_SET_ATTRIBUTES:
+            sets[k].append(sorted(attributes[k]) if k in attributes else None)
+    columns = {'node': string_array(names),
+               'node_type': pa.array(node_types, pa.string()).dictionary_encode()}
+    for k in NODE_SET_ATTRIBUTES:
+        columns[k] = pa.array(sets[k], pa.list_(pa.string()))
+    return pa.table(columns)
+
+
+def edge_table(edges):
+    # Table of (source, target, attributes) triples
+    sources, targets, edge_types = [], [], []
+    sets = dict([(k, []) for k in EDGE_SET_ATTRIBUTES])
+    for m, n, attributes in edges:
+        sources.append(m)
+        targets.append(n)
+        edge_types.append(attributes.get('edge_type'))
+        for k in EDGE_SET_ATTRIBUTES:
+            sets[k].append(sorted(attributes[k]) if k in attributes else None)
+    columns = {'source': string_array(sources),
+               'target': string_array(targets),
+               'edge_type': pa.array(edge_types, pa.string()).dictionary_encode()}
+    for k in EDGE_SET_ATTRIBUTES:
+        columns[k] = pa.array(sets[k], pa.list_(pa.string()))
+    return pa.table(columns)
+
+
+def read_manifest(graph_folder):
+    manifest_path = os.path.join(graph_folder, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('format_version') != GRAPH_FORMAT_VERSION:
+        raise ValueError("Unsupported knowledge graph format version %s in %s (expected %d)" % (
+            manifest.get('format_version'), graph_folder, GRAPH_FORMAT_VERSION))
+    return manifest
+
+
+def save_graph_stage(umls_G, graph_folder, stage, model_type, nodes=None, edges=None, reset=False,
+                     compression='uncompressed'):
+    """Saves a stage of the graph: the given nodes and edges (all of them when None).
+    With reset, the previously saved stages are discarded, otherwise the stage replaces
+    the saved stage with the same name and the stages after it"""
+    check_pyarrow()
+    if not os.path.exists(graph_folder):
+        os.makedirs(graph_folder)
+    manifest = None if reset else read_manifest(graph_folder)
+    if manifest is None or manifest['model_type'] != model_type:
+        manifest = {'format_version': GRAPH_FORMAT_VERSION, 'model_type': model_type, 'stages': []}
+    stage_names = [k['name'] for k in manifest['stages']]
+    kept_stages = manifest['stages'][:stage_names.index(stage)] if stage in stage_names else manifest['stages']
+    kept_files = set([f for k in kept_stages for f in (k['nodes'], k['edges'])])
+
+    with paused_gc():
+        # The attributes of the given nodes and edges are looked up in the adjacency dictionaries
+        # (Graph.adjacency), as the lookups through the graph views are much slower
+        if nodes is None:
+            nodes = list(umls_G.nodes(data=True))
+        else:
+            node_data = dict(umls_G.nodes(data=True))
+            nodes = [(n, node_data[n]) for n in nodes]
+        if edges is None:
+            edges = list(umls_G.edges(data=True))
+        else:
+            successors = dict(umls_G.adjacency())
+            edges = [(m, n, successors[m][n]) for m, n in edges]
+        # A stage is saved under file names not used in the folder, the manifest switches to them
+        version = 0
+        while os.path.exists(os.path.join(graph_folder, '%s_nodes.%d.feather' % (stage, version))) or \
+                os.path.exists(os.path.join(graph_folder, '%s_edges.%d.feather' % (stage, version))):
+            version += 1
+        entry = {'name': stage, 'nodes': '%s_nodes.%d.feather' % (stage, version),
+                 'edges': '%s_edges.%d.feather' % (stage, version),
+                 'node_count': len(nodes), 'edge_count': len(edges), 'compression': compression}
+        tables = [(entry['nodes'], node_table(nodes)), (entry['edges'], edge_table(edges))]
+    # The saved stages are not modified: the manifest, replaced last, lists the tables of the
+    # new stage, and the tables no longer listed are then removed
+    for file_name, table in tables:
+        feather.write_feather(table, os.path.join(graph_folder, file_name), compression=compression)
+    manifest['stages'] = kept_stages + [entry]
+    manifest['total_nodes'] = umls_G.number_of_nodes()
+    manifest['total_edges'] = umls_G.number_of_edges()
+    manifest_path = os.path.join(graph_folder, MANIFEST_FILE)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    for file_name in os.listdir(graph_folder):
+        if file_name.endswith('.feather') and file_name not in kept_files and \
+                file_name not in (entry['nodes'], entry['edges']):
+            os.remove(os.path.join(graph_folder, file_name))
+
+
+def load_graph_tables(graph_folder):
+    """Returns the manifest and the (node table, edge table) pyarrow Tables of each stage,
+    memory-mapped from the files"""
+    check_pyarrow()
+    manifest = read_manifest(graph_folder)
+    if manifest is None:
+        raise IOError("No knowledge graph saved in " + graph_folder)
+    tables = []
+    for stage in manifest['stages']:
+        tables.append((feather.read_table(os.path.join(graph_folder, stage['nodes']), memory_map=True),
+                       feather.read_table(os.path.join(graph_folder, stage['edges']), memory_map=True)))
+    return manifest, tables
+
+
+def to_list(column):
+    # Converting through numpy is much faster than ChunkedArray.to_pylist for large columns
+    column = column.combine_chunks()
+    if pa.types.is_dictionary(column.type):
+        return column.dictionary.to_numpy(zero_copy_only=False)[column.indices.to_numpy(
+            zero_copy_only=False)].tolist() if column.null_count == 0 else column.dictionary_decode().to_pylist()
+    return column.to_numpy(zero_copy_only=False).tolist()
+
+
+def to_sets(column):
+    # Sets of a list<string> column, None for null rows
+    column = column.combine_chunks()
+    values = column.flatten().to_numpy(zero_copy_only=False).tolist()
+    offsets = column.offsets.to_numpy()
+    offsets = (offsets - offsets[0]).tolist()
+    valid = column.is_valid().to_numpy(zero_copy_only=False).tolist()
+    return [set(values[offsets[i]:offsets[i + 1]]) if valid[i] else None for i in range(len(valid))]
+
+
+def load_graph(graph_folder):
+    """Loads a saved graph into a networkx DiGraph, replaying its stages in order"""
+    manifest, tables = load_graph_tables(graph_folder)
+    umls_G = nx.DiGraph()
+    with paused_gc():
+        for nodes, edges in tables:
+            add_stage(umls_G, nodes, edges)
+    return umls_G
+
+
+def add_stage(umls_G, nodes, edges):
+    # Adds (or updates) the nodes and edges of a saved stage
+    names = to_list(nodes.column('node'))
+    node_types = to_list(nodes.column('node_type'))
+    sets = [(k, to_sets(nodes.column(k))) for k in NODE_SET_ATTRIBUTES]
+    node_attributes = []
+    for i in range(len(names)):
+        attributes = {'node_type': node_types[i]}
+        for k, values in sets:
+            if values[i] is not None:
+                attributes[k] = values[i]
+        node_attributes.append((names[i], attributes))
+    umls_G.add_nodes_from(node_attributes)
+
+    sources = to_list(edges.column('source'))
+    targets = to_list(edges.column('target'))
+    edge_types = to_list(edges.column('edge_type'))
+    sets = [(k, to_sets(edges.column(k))) for k in EDGE_SET_ATTRIBUTES]
+    edge_attributes = []
+    for i in range(len(sources)):
+        attributes = {'edge_type': edge_types[i]}
+        for k, values in sets:
+            if values[i] is not None:
+                attributes[k] = values[i]
+        edge_attributes.append((sources[i], targets[i], attributes))
+    umls_G.add_edges_from(edge_attributes)
@@ -0,0 +1,330 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from compact_graph import StringPool, csr
+
+HIERARCHY_EDGE_TYPE = 'IS_SUBCLASS_OF'
+
+
+def merge_intervals(starts, ends):
+    # Merges overlapping and adjacent [start, end] intervals, returns sorted starts and ends
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    merged_starts, merged_ends = [], []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        if merged_ends and start <= merged_ends[-1] + 1:
+            if end > merged_ends[-1]:
+                merged_ends[-1] = end
+        else:
+            merged_starts.append(start)
+            merged_ends.append(end)
+    return np.array(merged_starts, dtype=np.int64), np.array(merged_ends, dtype=np.int64)
+
+
+class HierarchyIndex(object):
+    """Reachability index of the hierarchical (IS_SUBCLASS_OF) edges of the UMLS knowledge graph,
+    answering descendant/ancestor queries without walking the graph.
+
+    Cycles are collapsed into their strongly connected components. The components are numbered
+    in DFS post-order from the roots of the hierarchy (children before their parents), and each
+    component keeps the intervals of post-order numbers of its descendants (compressed transitive
+    closure): its subtree in the DFS spanning tree is a single interval, and only the descendants
+    reached through other parents add intervals. "Is X a descendant of Y" is a binary search in
+    the intervals of Y.
+    """
+
+    def __init__(self):
+        self.node_names = StringPool()
+        self.node_components = np.zeros(0, dtype=np.int64)
+        self.alive = np.zeros(0, dtype=bool)
+        self.post_order = np.zeros(0, dtype=np.int64)
+        self.post_components = np.zeros(0, dtype=np.int64)
+        self.member_offsets, self.members = np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        self.interval_offsets = np.zeros(1, dtype=np.int64)
+        self.interval_starts = np.zeros(0, dtype=np.int64)
+        self.interval_ends = np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def from_edges(cls, children, parents):
+        """Builds the index from the (child, parent) pairs of the hierarchical edges"""
+        index = cls()
+        index.build(index.node_names.intern(children), index.node_names.intern(parents))
+        return index
+
+    @classmethod
+    def from_graph(cls, umls_G):
+        """Builds the index from the hierarchical edges of a networkx knowledge graph"""
+        edges = [(m, n) for m, n, edge_type in umls_G.edges(data='edge_type') if edge_type == HIERARCHY_EDGE_TYPE]
+        return cls.from_edges([m for m, n in edges], [n for m, n in edges])
+
+    def number_of_nodes(self):
+        return int(self.alive.sum())
+
+    def number_of_intervals(self):
+        return len(self.interval_starts)
+
+    def build(self, child_ids, parent_ids):
+        n_nodes = len(self.node_names)
+        child_ids = np.asarray(child_ids, dtype=np.int64)
+        parent_ids = np.asarray(parent_ids, dtype=np.int64)
+        graph = csr_matrix((np.ones(len(child_ids), dtype=np.int8), (parent_ids, child_ids)),
+                           shape=(n_nodes, n_nodes))
+        n_components, components = connected_components(graph, directed=True, connection='strong')
+        self.node_components = components.astype(np.int64)
+        self.alive = np.ones(n_nodes, dtype=bool)
+        self.member_offsets, self.members = csr(self.node_components, np.arange(n_nodes, dtype=np.int64),
+                                                n_components)
+
+        # Edges between components, from parent to child
+        component_parents = self.node_components[parent_ids]
+        component_children = self.node_components[child_ids]
+        between = component_parents != component_children
+        pairs = np.unique(np.stack([component_parents[between], component_children[between]]), axis=1) \
+            if between.any() else np.zeros((2, 0), dtype=np.int64)
+        child_offsets, child_components = csr(pairs[0], pairs[1], n_components)
+        has_parent = np.bincount(pairs[1], minlength=n_components) > 0
+
+        # Iterative DFS from the roots: low is the first post-order number of the subtree of a component
+        child_offsets, child_components = child_offsets.tolist(), child_components.tolist()
+        post_order = [-1] * n_components
+        low = [0] * n_components
+        visited = [False] * n_components
+        counter = 0
+        for root in np.flatnonzero(~has_parent).tolist():
+            visited[root] = True
+            low[root] = counter
+            stack = [(root, child_offsets[root])]
+            while stack:
+                component, position = stack[-1]
+                if position < child_offsets[component + 1]:
+                    stack[-1] = (component, position + 1)
+                    child = child_components[position]
+                    if not visited[child]:
+                        visited[child] = True
+                        low[child] = counter
+                        stack.append((child, child_offsets[child]))
+                else:
+                    stack.pop()
+                    post_order[component] = counter
+                    counter += 1
+
+        # Intervals of the descendants, merged bottom-up (children are numbered before their parents)
+        post_components = [0] * n_components
+        for component, post in enumerate(post_order):
+            post_components[post] = component
+        intervals = [None] * n_components
+        for component in post_components:
+            starts, ends = [low[component]], [post_order[component]]
+            for child in child_components[child_offsets[component]:child_offsets[component + 1]]:
+                child_starts, child_ends = intervals[child]
+                # the intervals within the subtree of the component are already covered
+                for start, end in zip(child_starts, child_ends):
+                    if start < low[component] or end > post_order[component]:
+                        starts.append(start)
+                        ends.append(end)
+            if len(starts) == 1:
+                intervals[component] = (starts, ends)
+            else:
+                merged_starts, merged_ends = merge_intervals(np.array(starts), np.array(ends))
+                intervals[component] = (merged_starts.tolist(), merged_ends.tolist())
+
+        self.post_order = np.array(post_order, dtype=np.int64)
+        self.post_components = np.array(post_components, dtype=np.int64)
+        self.set_intervals(intervals)
+
+    def set_intervals(self, intervals):
+        # Stores a list of (starts, ends) per component in CSR layout
+        lengths = np.array([len(k[0]) for k in intervals], dtype=np.int64)
+        self.interval_offsets = np.zeros(len(intervals) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.interval_offsets[1:])
+        self.interval_starts = np.array([s for k in intervals for s in k[0]], dtype=np.int64)
+        self.interval_ends = np.array([e for k in intervals for e in k[1]], dtype=np.int64)
+
+    def intervals(self, component):
+        start, end = self.interval_offsets[component], self.interval_offsets[component + 1]
+        return self.interval_starts[start:end], self.interval_ends[start:end]
+
+    def node_id(self, name):
+        # Id of a node of the index, -1 if not found
+        node = self.node_names.index.get(name, -1)
+        return node if node >= 0 and self.alive[node] else -1
+
+    def component(self, name):
+        # Component of a node of the index, for the nodes the index must have
+        node = self.node_id(name)
+        if node < 0:
+            raise KeyError("Node %s is not in the hierarchy index, the changed edges given to update "
+                           "are missing some hierarchical edges of the graph" % (name,))
+        return int(self.node_components[node])
+
+    def has_node(self, name):
+        return self.node_id(name) >= 0
+
+    def is_descendant(self, name, ancestor):
+        """True if there is a path of hierarchical edges from the node to the ancestor"""
+        node, ancestor_node = self.node_id(name), self.node_id(ancestor)
+        if node < 0 or ancestor_node < 0 or node == ancestor_node:
+            return False
+        starts, ends = self.intervals(self.node_components[ancestor_node])
+        post = self.post_order[self.node_components[node]]
+        position = np.searchsorted(starts, post, side='right') - 1
+        return bool(position >= 0 and post <= ends[position])
+
+    def is_ancestor(self, name, descendant):
+        return self.is_descendant(descendant, name)
+
+    def component_nodes(self, components, excluded):
+        nodes = self.members[np.concatenate(
+            [np.arange(self.member_offsets[k], self.member_offsets[k + 1]) for k in components])] \
+            if len(components) > 0 else self.members[:0]
+        nodes = nodes[self.alive[nodes] & (nodes != excluded)]
+        return set([self.node_names.strings[k] for k in nodes.tolist()])
+
+    def descendants(self, name):
+        """Nodes with a path of hierarchical edges to the node"""
+        node = self.node_id(name)
+        if node < 0:
+            return set([])
+        starts, ends = self.intervals(self.node_components[node])
+        posts = np.concatenate([np.arange(s, e + 1) for s, e in zip(starts.tolist(), ends.tolist())])
+        return self.component_nodes(self.post_components[posts], node)
+
+    def ancestors(self, name):
+        """Nodes reached from the node by a path of hierarchical edges"""
+        node = self.node_id(name)
+        if node < 0:
+            return set([])
+        post = self.post_order[self.node_components[node]]
+        found = np.flatnonzero((self.interval_starts <= post) & (self.interval_ends >= post))
+        components = np.unique(np.searchsorted(self.interval_offsets, found, side='right') - 1)
+        return self.component_nodes(components, node)
+
+    def update(self, umls_G, changed_edges):
+        """Updates the index after the hierarchical edges between the given (child, parent) pairs
+        were added to or removed from the graph (nodes without edges in the graph are removed).
+        The descendant intervals of the parents and their ancestors are recomputed from their
+        children in the graph. Falls back to a full rebuild when the components change
+        (a cycle is created or an edge within a cycle is removed). Returns False if rebuilt"""
+        changed_edges = list(changed_edges)
+
+        def is_hierarchy_edge(m, n):
+            return umls_G.has_edge(m, n) and umls_G[m][n].get('edge_type') == HIERARCHY_EDGE_TYPE
+
+        # New nodes are added as single-node components, numbered after the existing ones.
+        # Removed nodes are marked, a removed node within a cycle changes the components.
+        # Removed nodes added again are revived in their (single-node) component
+        names = set([m for m, n in changed_edges]).union([n for m, n in changed_edges])
+        new_names = [k for k in names if k not in self.node_names.index and umls_G.has_node(k)]
+        revived = [k for k in names if k in self.node_names.index and not self.alive[self.node_names.index[k]]
+                   and umls_G.has_node(k)]
+        for k in names:
+            node = self.node_id(k)
+            if node >= 0 and not umls_G.has_node(k):
+                if self.component_size(self.node_components[node]) > 1:
+                    return self.rebuild(umls_G)
+                self.alive[node] = False
+        for m, n in changed_edges:
+            node_m, node_n = self.node_id(m), self.node_id(n)
+            if node_m >= 0 and node_n >= 0 and node_m != node_n and \
+                    self.node_components[node_m] == self.node_components[node_n] and not is_hierarchy_edge(m, n):
+                return self.rebuild(umls_G)
+        self.add_nodes(new_names)
+        self.alive[[self.node_names.index[k] for k in revived]] = True
+
+        # Components whose descendants may have changed: the parents of the changed edges, the revived
+        # nodes (their intervals are from before they were removed) and their ancestors
+        affected_nodes = set([n for m, n in changed_edges if self.node_id(n) >= 0]).union(revived)
+        queue = list(affected_nodes)
+        while queue:
+            m = queue.pop()
+            for n, edge_type in umls_G.succ[m].items():
+                if edge_type.get('edge_type') == HIERARCHY_EDGE_TYPE and n not in affected_nodes:
+                    affected_nodes.add(n)
+                    queue.append(n)
+        affected = set([self.component(m) for m in affected_nodes])
+
+        # Children components in the graph, and the affected components in topological order (children first)
+        children = {}
+        for component in affected:
+            children[component] = set([])
+            for m in self.component_names(component):
+                for k, attributes in umls_G.pred[m].items():
+                    if attributes.get('edge_type') == HIERARCHY_EDGE_TYPE:
+                        child = self.component(k)
+                        if child != component:
+                            children[component].add(child)
+        waiting = dict([(k, len([c for c in children[k] if c in affected])) for k in affected])
+        parents = {}
+        for component in affected:
+            for child in children[component]:
+                if child in affected:
+                    parents.setdefault(child, []).append(component)
+        ready = [k for k, count in waiting.items() if count == 0]
+        new_intervals = {}
+        while ready:
+            component = ready.pop()
+            starts, ends = [self.post_order[component]], [self.post_order[component]]
+            for child in children[component]:
+                child_starts, child_ends = new_intervals[child] if child in new_intervals else self.intervals(child)
+                starts.extend(np.asarray(child_starts).tolist())
+                ends.extend(np.asarray(child_ends).tolist())
+            new_intervals[component] = merge_intervals(np.array(starts, dtype=np.int64),
+                                                       np.array(ends, dtype=np.int64))
+            for parent in parents.get(component, []):
+                waiting[parent] -= 1
+                if waiting[parent] == 0:
+                    ready.append(parent)
+        if len(new_intervals) < len(affected):
+            # the added edges created a cycle
+            return self.rebuild(umls_G)
+        self.replace_intervals(new_intervals)
+        return True
+
+    def component_size(self, component):
+        return self.member_offsets[component + 1] - self.member_offsets[component]
+
+    def component_names(self, component):
+        nodes = self.members[self.member_offsets[component]:self.member_offsets[component + 1]]
+        return [self.node_names.strings[k] for k in nodes.tolist() if self.alive[k]]
+
+    def add_nodes(self, names):
+        # Adds nodes as single-node components, with their own post-order number as interval
+        if len(names) == 0:
+            return
+        first_node, first_component = len(self.node_names), len(self.post_order)
+        nodes = self.node_names.intern(names)
+        components = first_component + nodes - first_node
+        posts = np.arange(len(self.post_components), len(self.post_components) + len(names), dtype=np.int64)
+        self.node_components = np.concatenate([self.node_components, components])
+        self.alive = np.concatenate([self.alive, np.ones(len(names), dtype=bool)])
+        self.members = np.concatenate([self.members, nodes])
+        self.member_offsets = np.concatenate(
+            [self.member_offsets, self.member_offsets[-1] + np.arange(1, len(names) + 1)])
+        self.post_order = np.concatenate([self.post_order, posts])
+        self.post_components = np.concatenate([self.post_components, components])
+        self.interval_starts = np.concatenate([self.interval_starts, posts])
+        self.interval_ends = np.concatenate([self.interval_ends, posts])
+        self.interval_offsets = np.concatenate(
+            [self.interval_offsets, self.interval_offsets[-1] + np.arange(1, len(names) + 1)])
+
+    def replace_intervals(self, new_intervals):
+        # Replaces the intervals of some components, keeping the CSR layout
+        lengths = np.diff(self.interval_offsets)
+        keep = np.ones(len(self.interval_starts), dtype=bool)
+        for component in new_intervals:
+            keep[self.interval_offsets[component]:self.interval_offsets[component + 1]] = False
+            lengths[component] = len(new_intervals[component][0])
+        owners = np.repeat(np.arange(len(lengths)), np.diff(self.interval_offsets))[keep]
+        new_components = np.array(sorted(new_intervals), dtype=np.int64)
+        owners = np.concatenate([owners, np.repeat(new_components, lengths[new_components])])
+        starts = np.concatenate([self.interval_starts[keep]] + [new_intervals[k][0] for k in new_components.tolist()])
+        ends = np.concatenate([self.interval_ends[keep]] + [new_intervals[k][1] for k in new_components.tolist()])
+        order = np.lexsort((starts, owners))
+        self.interval_starts, self.interval_ends = starts[order], ends[order]
+        self.interval_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.interval_offsets[1:])
+
+    def rebuild(self, umls_G):
+        rebuilt = HierarchyIndex.from_graph(umls_G)
+        self.__dict__.update(rebuilt.__dict__)
+        return False
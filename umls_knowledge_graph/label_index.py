@@ -0,0 +1,258 @@
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import mmap
+import os
+import shutil
+import sys
+import zlib
+from umls_extractor import read_table
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(os.path.join(parentdir, "pubmed_retrieval"))
+
+from pubmed_parser import normalize, normalize_batch
+
+# Version of the on-disk layout, checked when an index is opened
+LABEL_INDEX_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+# Exact labels (lowercased, as in the knowledge graph) and normalized labels (pubmed_parser.normalize)
+LABEL_TABLES = ['exact', 'normalized']
+
+
+def label_hash(label):
+    # 64-bit hash of the UTF-8 encoded label, stable across processes (unlike hash())
+    return zlib.crc32(label) << 32 | zlib.adler32(label)
+
+
+def load_array(folder, name):
+    # Memory-mapped array, as a memoryview: indexing it returns Python ints,
+    # much faster than indexing a numpy memmap element by element
+    return memoryview(np.load(os.path.join(folder, name + '.npy'), mmap_mode='r').view(np.ndarray))
+
+
+def save_strings(strings, folder, name):
+    # Saves UTF-8 encoded strings as a single blob with their offsets
+    encoded = [k.encode('utf-8') for k in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(k) for k in encoded], out=offsets[1:])
+    np.save(os.path.join(folder, name + '_offsets.npy'), offsets)
+    with open(os.path.join(folder, name + '.bin'), 'wb') as blob_file:
+        blob_file.write(b''.join(encoded))
+    return encoded
+
+
+class MappedStrings(object):
+    # Strings saved by save_strings, memory-mapped: the i-th string is a slice of the blob
+
+    def __init__(self, folder, name):
+        self.offsets = load_array(folder, name + '_offsets')
+        with open(os.path.join(folder, name + '.bin'), 'rb') as blob_file:
+            self.blob = mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ) \
+                if os.path.getsize(blob_file.name) > 0 else b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]]
+
+
+def save_label_table(keys, cui_ids, folder, table):
+    """Saves the (key, CUI id) pairs of a table: the keys sorted by hash with the ids
+    of their CUIs, and the lexicographic order of the keys for the prefix search"""
+    pairs = pd.DataFrame({'key': keys, 'cui': cui_ids}).drop_duplicates()
+    key_codes, unique_keys = pd.factorize(pairs['key'])
+    encoded = [k.encode('utf-8') for k in unique_keys]
+    hashes = np.array([label_hash(k) for k in encoded], dtype=np.uint64)
+    order = np.argsort(hashes, kind='stable')
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+
+    posting_keys = ranks[key_codes]
+    posting_order = np.lexsort((pairs['cui'].values, posting_keys))
+    posting_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(posting_keys, minlength=len(order)), out=posting_offsets[1:])
+    np.save(os.path.join(folder, table + '_hashes.npy'), hashes[order])
+    np.save(os.path.join(folder, table + '_postings_offsets.npy'), posting_offsets)
+    np.save(os.path.join(folder, table + '_postings.npy'), pairs['cui'].values[posting_order].astype(np.int32))
+    sorted_keys = save_strings([unique_keys[k] for k in order], folder, table + '_keys')
+    lexicographic = sorted(range(len(sorted_keys)), key=sorted_keys.__getitem__)
+    np.save(os.path.join(folder, table + '_lexicographic.npy'), np.array(lexicographic, dtype=np.int64))
+    return len(order), len(posting_order)
+
+
+def build_label_index(data_folder, index_folder, jobs=1):
+    """Builds the label index of the terms and alternate labels extracted by UMLSExtractor.
+    The index is built in a temporary folder moved in place of the index folder once
+    complete, so an existing index stays whole (and usable by the processes mapping it)
+    until it is replaced"""
+    print ('Building the label index of the UMLS concepts')
+    build_folder = os.path.normpath(index_folder) + '.tmp'
+    if os.path.exists(build_folder):
+        shutil.rmtree(build_folder)
+    os.makedirs(build_folder)
+    umls_terms = read_table(data_folder, 'selected_vocab_terms.tsv', columns=['CUI', 'STR'])
+    alternate_labels = read_table(data_folder, 'alternate_labels.tsv', columns=['CUI', 'STR'])
+    # Missing labels are left out, rather than indexed as "nan"
+    labels = pd.concat([umls_terms, alternate_labels]).dropna().astype(str)
+    labels['STR'] = labels['STR'].str.lower()
+    labels = labels.drop_duplicates()
+    print ("Read in", labels.shape[0], "UMLS concept labels")
+
+    cui_codes, cuis = pd.factorize(labels['CUI'])
+    save_strings(list(cuis), build_folder, 'cuis')
+    unique_labels = pd.unique(labels['STR'])
+    normalized = dict(zip(unique_labels, normalize_batch(unique_labels, jobs=jobs)))
+    manifest = {'format_version': LABEL_INDEX_VERSION, 'cuis': len(cuis), 'tables': {}}
+    for table, keys in [('exact', labels['STR'].values),
+                        ('normalized', labels['STR'].map(normalized).values)]:
+        found = np.array([len(k) > 0 for k in keys], dtype=bool)
+        n_keys, n_postings = save_label_table(keys[found], cui_codes[found], build_folder, table)
+        manifest['tables'][table] = {'keys': n_keys, 'postings': n_postings}
+        print (table, "labels:", n_keys, ", label-concept pairs:", n_postings)
+    # The manifest is written last, an index without it is incomplete
+    with open(os.path.join(build_folder, MANIFEST_FILE), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    if os.path.exists(index_folder):
+        old_folder = os.path.normpath(index_folder) + '.old'
+        if os.path.exists(old_folder):
+            shutil.rmtree(old_folder)
+        os.rename(index_folder, old_folder)
+        os.rename(build_folder, index_folder)
+        shutil.rmtree(old_folder)
+    else:
+        os.rename(build_folder, index_folder)
+    print("--------------------")
+    return LabelIndex(index_folder)
+
+
+class LabelTable(object):
+    # Memory-mapped keys of a label table, with their CUI ids
+
+    def __init__(self, folder, table):
+        self.hashes = load_array(folder, table + '_hashes')
+        self.posting_offsets = load_array(folder, table + '_postings_offsets')
+        self.postings = load_array(folder, table + '_postings')
+        self.lexicographic = load_array(folder, table + '_lexicographic')
+        self.keys = MappedStrings(folder, table + '_keys')
+
+    def find(self, key, key_hash, position):
+        # Position of the key, from the first position of its hash (hash collisions are compared), -1 if not found
+        hashes, offsets, blob = self.hashes, self.keys.offsets, self.keys.blob
+        while position < len(hashes) and hashes[position] == key_hash:
+            if blob[offsets[position]:offsets[position + 1]] == key:
+                return position
+            position += 1
+        return -1
+
+    def cui_ids(self, position):
+        return self.postings[self.posting_offsets[position]:self.posting_offsets[position + 1]]
+
+    def lower_bound(self, key):
+        # First position of the lexicographic order of the keys not less than the key
+        lo, hi = 0, len(self.lexicographic)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.keys[self.lexicographic[mid]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def prefix_range(self, prefix):
+        # Range of the lexicographic order of the keys starting with the prefix
+        # (0xff never occurs in UTF-8, so it sorts after all the keys starting with the prefix)
+        return self.lower_bound(prefix), self.lower_bound(prefix + b'\xff')
+
+
+class LabelIndex(object):
+    """Label to CUI index of the UMLS concepts, saved in a folder by build_label_index.
+
+    Labels are looked up exactly (lowercased, as the labels of the knowledge graph),
+    in their normalized form (pubmed_parser.normalize) or by prefix. Each table keeps
+    its keys sorted by a 64-bit hash, so that a lookup is a binary search of the hash
+    followed by a comparison with the saved key. All the arrays and strings are
+    memory-mapped, so the index is loaded lazily and shared by the processes using it
+    through the page cache. Pickling an index only pickles its folder."""
+
+    def __init__(self, index_folder):
+        self.index_folder = index_folder
+        with open(os.path.join(index_folder, MANIFEST_FILE)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        if self.manifest.get('format_version') != LABEL_INDEX_VERSION:
+            raise ValueError("Unsupported label index version %s in %s (expected %d)" % (
+                self.manifest.get('format_version'), index_folder, LABEL_INDEX_VERSION))
+        self.cui_names = MappedStrings(index_folder, 'cuis')
+        self.tables = dict([(k, LabelTable(index_folder, k)) for k in LABEL_TABLES])
+
+    def __getstate__(self):
+        return {'index_folder': self.index_folder}
+
+    def __setstate__(self, state):
+        self.__init__(state['index_folder'])
+
+    def cui_list(self, ids):
+        return [self.cui_names[k].decode('utf-8') for k in ids]
+
+    def find_many(self, labels, table='exact'):
+        """Positions of the labels in a table (-1 for the labels not found), to get their CUIs
+        with cuis(). The hashes of all the labels are searched at once"""
+        label_table = self.tables[table]
+        keys = [k.encode('utf-8') for k in labels]
+        hashes = [label_hash(k) for k in keys]
+        positions = np.searchsorted(np.asarray(label_table.hashes), np.array(hashes, dtype=np.uint64)).tolist()
+        find = label_table.find
+        return [find(key, key_hash, position) for key, key_hash, position in zip(keys, hashes, positions)]
+
+    def cuis(self, position, table='exact'):
+        """CUIs of the label at a position of a table"""
+        return self.cui_list(self.tables[table].cui_ids(position)) if position >= 0 else []
+
+    def lookup_many(self, labels, table='exact'):
+        """CUIs of each label (empty lists for the labels not found)"""
+        return [self.cuis(k, table) for k in self.find_many(labels, table)]
+
+    def lookup(self, label):
+        """CUIs of the label (lowercased)"""
+        return self.lookup_many([label.lower()])[0]
+
+    def lookup_normalized(self, text):
+        """CUIs of the labels with the same normalized form as the text"""
+        return self.lookup_many([normalize(text)], table='normalized')[0]
+
+    def lookup_normalized_many(self, texts, jobs=1):
+        return self.lookup_many(list(normalize_batch(texts, jobs=jobs)), table='normalized')
+
+    def prefix(self, prefix, limit=100, table='exact'):
+        """Labels starting with the prefix (lowercased), in lexicographic order, with their CUIs"""
+        label_table = self.tables[table]
+        start, end = label_table.prefix_range(prefix.lower().encode('utf-8'))
+        results = []
+        for i in range(start, min(end, start + limit)):
+            position = label_table.lexicographic[i]
+            results.append((label_table.keys[position].decode('utf-8'),
+                            self.cui_list(label_table.cui_ids(position))))
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datafolder', type=str, required=False,
+                        help='Folder path to the files extracted by umls_extractor.py')
+    parser.add_argument('--indexfolder', type=str, required=False,
+                        help='Folder path to save the label index to, <datafolder>/label_index/ by default')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes used to normalize the labels')
+    args = parser.parse_args()
+
+    data_folder = args.datafolder if args.datafolder and len(
+        args.datafolder) > 0 else 'tempdata/'
+    index_folder = args.indexfolder if args.indexfolder else data_folder + 'label_index/'
+    build_label_index(data_folder, index_folder, jobs=args.workers)
+
+
+if __name__ == "__main__":
+    main()
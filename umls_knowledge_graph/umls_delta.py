@@ -0,0 +1,151 @@
+import pandas as pd
+import argparse
+import json
+import os
+from umls_extractor import read_table, save_table
+from umls_graph_creator import hierarchy_edge_table, relation_node_lookup, relation_edge_table
+
+# Extracted tables compared between releases, with the columns identifying a row across releases
+# (a row with the same key and different values is reported as changed). Hierarchical relations
+# have no identifier in UMLS, so they are only added or removed
+DELTA_TABLES = [('concepts', 'selected_vocab_terms.tsv', ['AUI']),
+                ('labels', 'alternate_labels.tsv', ['CUI', 'STR']),
+                ('hierarchies', 'hierarchies.tsv', None),
+                ('relations', 'relations_selected.tsv', ['RUI'])]
+
+
+def diff_tables(old_table, new_table, key_columns=None):
+    # Returns the added, removed and changed (new values) rows between two versions of a table,
+    # and all the old and new rows that differ. Values are compared as strings
+    columns = list(new_table.columns)
+    key_columns = key_columns if key_columns else columns
+    old_table = old_table[columns].astype(str).drop_duplicates()
+    new_table = new_table[columns].astype(str).drop_duplicates()
+    merged = old_table.merge(new_table, how='outer', indicator=True)
+    old_rows = merged[merged['_merge'] == 'left_only'][columns]
+    new_rows = merged[merged['_merge'] == 'right_only'][columns]
+    changed_old = pd.MultiIndex.from_frame(old_rows[key_columns]).isin(
+        pd.MultiIndex.from_frame(new_rows[key_columns]))
+    changed_new = pd.MultiIndex.from_frame(new_rows[key_columns]).isin(
+        pd.MultiIndex.from_frame(old_rows[key_columns]))
+    return new_rows[~changed_new], old_rows[~changed_old], new_rows[changed_new], old_rows, new_rows
+
+
+class UMLSReleaseDelta():
+
+    def __init__(self, old_folder="tempdata/2022AA/", new_folder="tempdata/2022AB/", delta_folder="tempdata/delta/"):
+        self.old_folder = old_folder
+        self.new_folder = new_folder
+        self.delta_folder = delta_folder
+
+    def compute_save_all(self):
+        self.compute_table_deltas()
+        self.compute_affected_nodes()
+        self.compute_hierarchy_edge_deltas()
+        self.compute_relation_edge_deltas()
+
+    def compute_table_deltas(self):
+        print("Comparing the extracted UMLS releases", self.old_folder, "and", self.new_folder)
+        self.old_tables, self.new_tables, self.changed_rows = {}, {}, {}
+        summary = {}
+        for name, file_name, key_columns in DELTA_TABLES:
+            self.old_tables[name] = read_table(self.old_folder, file_name)
+            self.new_tables[name] = read_table(self.new_folder, file_name)
+            added, removed, changed, old_rows, new_rows = diff_tables(
+                self.old_tables[name], self.new_tables[name], key_columns)
+            self.changed_rows[name] = (old_rows, new_rows)
+            save_table(added, self.delta_folder, name + '_added.tsv')
+            save_table(removed, self.delta_folder, name + '_removed.tsv')
+            if key_columns:
+                save_table(changed, self.delta_folder, name + '_changed.tsv')
+            summary[name] = {'added': added.shape[0], 'removed': removed.shape[0], 'changed': changed.shape[0]}
+            print(name, "- added:", added.shape[0], ", removed:", removed.shape[0], ", changed:", changed.shape[0])
+        with open(self.delta_folder + 'delta_summary.json', 'w') as summary_file:
+            json.dump({'old_folder': self.old_folder, 'new_folder': self.new_folder, 'tables': summary},
+                      summary_file, indent=2)
+        print("--------------------")
+
+    def compute_affected_nodes(self):
+        # The CUIs (model1 nodes) and codes (model2 nodes) whose terms or alternate labels differ,
+        # with all their terms and alternate labels in the new release, to rebuild their labels
+        print("Determining the concepts affected by the release changes")
+        old_terms, new_terms = self.changed_rows['concepts']
+        old_labels, new_labels = self.changed_rows['labels']
+        affected_cuis = set(old_terms['CUI']).union(new_terms['CUI'], old_labels['CUI'], new_labels['CUI'])
+        affected_codes = set(old_terms['CODE']).union(new_terms['CODE'])
+        affected_nodes = pd.DataFrame([(k, 'CUI') for k in sorted(affected_cuis)] +
+                                      [(k, 'CODE') for k in sorted(affected_codes)], columns=['node', 'node_kind'])
+
+        umls_terms = self.new_tables['concepts']
+        affected_terms = umls_terms[umls_terms['CUI'].astype(str).isin(affected_cuis) |
+                                    umls_terms['CODE'].astype(str).isin(affected_codes)].astype(str)
+        alternate_labels = self.new_tables['labels']
+        affected_alternate_labels = alternate_labels[alternate_labels['CUI'].astype(str).isin(
+            affected_cuis)].astype(str)
+        save_table(affected_nodes, self.delta_folder, 'affected_nodes.tsv')
+        save_table(affected_terms, self.delta_folder, 'affected_terms.tsv')
+        save_table(affected_alternate_labels, self.delta_folder, 'affected_alternate_labels.tsv')
+        print("Affected CUIs:", len(affected_cuis), ", affected codes:", len(affected_codes))
+        print("--------------------")
+
+    def compute_hierarchy_edge_deltas(self):
+        # Hierarchical edges of the knowledge graph added/removed between the releases, for both models
+        print("Comparing the hierarchical edges of the knowledge graph models")
+        self.hierarchy_changed_pairs = {}
+        for model_type in ['model1', 'model2']:
+            old_edges = hierarchy_edge_table(
+                self.old_tables['concepts'], self.old_tables['hierarchies'], model_type)
+            new_edges = hierarchy_edge_table(
+                self.new_tables['concepts'], self.new_tables['hierarchies'], model_type)
+            # model2 edges do not record the terminology
+            if model_type == 'model2':
+                old_edges = old_edges[['source', 'target']]
+                new_edges = new_edges[['source', 'target']]
+            added, removed = diff_tables(old_edges, new_edges)[:2]
+            self.hierarchy_changed_pairs[model_type] = pd.concat([added, removed])[['source', 'target']]
+            save_table(added, self.delta_folder, 'hierarchy_edges_' + model_type + '_added.tsv')
+            save_table(removed, self.delta_folder, 'hierarchy_edges_' + model_type + '_removed.tsv')
+            print(model_type, "hierarchical edges - added:", added.shape[0], ", removed:", removed.shape[0])
+        print("--------------------")
+
+    def compute_relation_edge_deltas(self):
+        # Node pairs whose associative edges differ between the releases, with their relations in
+        # the new release, for both models. Pairs whose hierarchical edges changed are included,
+        # as the relation types are recorded on the hierarchical edges linking the same nodes
+        print("Comparing the associative edges of the knowledge graph models")
+        for model_type in ['model1', 'model2']:
+            old_edges = relation_edge_table(self.old_tables['relations'], relation_node_lookup(
+                self.old_tables['concepts'], model_type), model_type)
+            new_edges = relation_edge_table(self.new_tables['relations'], relation_node_lookup(
+                self.new_tables['concepts'], model_type), model_type)
+            old_rows, new_rows = diff_tables(old_edges, new_edges)[3:]
+            affected_pairs = pd.concat([old_rows[['source', 'target']], new_rows[['source', 'target']],
+                                        self.hierarchy_changed_pairs[model_type].astype(str)]).drop_duplicates()
+            new_edges = new_edges.astype(str)
+            affected_edges = new_edges[pd.MultiIndex.from_frame(new_edges[['source', 'target']]).isin(
+                pd.MultiIndex.from_frame(affected_pairs))]
+            save_table(affected_pairs, self.delta_folder, 'relation_edges_' + model_type + '_pairs.tsv')
+            save_table(affected_edges, self.delta_folder, 'relation_edges_' + model_type + '_affected.tsv')
+            print(model_type, "associative edges - affected node pairs:", affected_pairs.shape[0])
+        print("--------------------")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--oldfolder', type=str, required=True,
+                        help='Folder path to the files extracted from the previous UMLS release')
+    parser.add_argument('--newfolder', type=str, required=True,
+                        help='Folder path to the files extracted from the new UMLS release')
+    parser.add_argument('--deltafolder', type=str, required=True,
+                        help='Folder path to store the delta between the releases')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.deltafolder):
+        os.makedirs(args.deltafolder)
+    umls_release_delta = UMLSReleaseDelta(
+        old_folder=args.oldfolder, new_folder=args.newfolder, delta_folder=args.deltafolder)
+    umls_release_delta.compute_save_all()
+
+
+if __name__ == "__main__":
+    main()
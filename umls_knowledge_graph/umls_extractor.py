@@ -1,39 +1,251 @@
 import pandas as pd
+from pandas.api.types import union_categoricals
 import argparse
+import csv
+import json
+import os
+import time
+from multiprocessing import Pool
+
+try:
+    from pyarrow import feather
+except ImportError:
+    feather = None
+
+# Columns of the RRF files (each line ends with a '|', hence the trailing empty column)
+RRF_COLUMNS = {
+    'MRCONSO': ['CUI', 'LAT', 'TS', 'LUI', 'STT', 'SUI', 'ISPREF', 'AUI', 'SAUI', 'SCUI', 'SDUI', 'SAB',
+                'TTY', 'CODE', 'STR', 'SRL', 'SUPPRESS', 'CVF', '0'],
+    'MRSTY': ['CUI', 'STY', 'TUI', 'STYNAME', 'ATUI', 'CVF', '0'],
+    'MRHIER': ['CUI', 'AUI', 'CXN', 'PAUI', 'SAB', 'RELA', 'PTR', 'HCD', 'CVF', '0'],
+    'MRREL': ['CUI1', 'AUI1', 'STYPE1', 'REL', 'CUI2', 'AUI2', 'STYPE2', 'RELA', 'RUI', 'SRUI', 'SAB', 'SL',
+              'RG', 'DIR', 'SUPPRESS', 'CVF', '0']
+}
+
+# Low-cardinality code columns are read as categoricals, all the other columns as strings
+CATEGORICAL_COLUMNS = set(['LAT', 'TS', 'SAB', 'TTY', 'SUPPRESS', 'STY', 'STYNAME',
+                           'REL', 'RELA', 'STYPE1', 'STYPE2', 'SL'])
+
+RRF_TABLES = ['MRCONSO', 'MRSTY', 'MRHIER', 'MRREL']
+
+DEFAULT_CHUNKSIZE = 1000000
+
+# Records the RRF files and terminologies of the last complete extraction in the output folder
+EXTRACT_CACHE_FILE = 'extract_cache.json'
+
+# Extraction steps: (step, extraction method, extracted table attribute, output file).
+# The steps after the concepts only depend on the selected CUIs, not on each other
+EXTRACTION_STEPS = [('concepts', 'extract_umls_concepts', 'selected_vocab_terms', 'selected_vocab_terms.tsv'),
+                    ('alternate_labels', 'extract_alternate_labels',
+                     'alternate_labels', 'alternate_labels.tsv'),
+                    ('semantic_types', 'extract_semantic_types',
+                     'semantic_types', 'semantic_types.tsv'),
+                    ('hierarchies', 'extract_hierarchies',
+                     'hierarchies', 'hierarchies.tsv'),
+                    ('relations', 'extract_relations', 'relations', 'relations_selected.tsv')]
+
+
+def concat_chunks(chunks, columns):
+    # Concatenates the filtered chunks of a RRF file, keeping the categorical columns categorical
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=columns)
+    data = {}
+    for column in columns:
+        if isinstance(chunks[0][column].dtype, pd.CategoricalDtype):
+            data[column] = union_categoricals(
+                [chunk[column] for chunk in chunks], ignore_order=True)
+        else:
+            data[column] = pd.concat([chunk[column]
+                                     for chunk in chunks], ignore_index=True)
+    return pd.DataFrame(data, columns=columns)
+
+
+def binary_file_name(file_name):
+    return os.path.splitext(file_name)[0] + '.feather'
+
+
+def save_table(table, folder, file_name):
+    # Saves an extracted table as TSV and, when pyarrow is available, as a typed binary
+    # copy, uncompressed so that it can be memory-mapped when loaded. Without pyarrow, a
+    # binary copy left by an earlier save is removed, as it no longer matches the TSV
+    table.to_csv(folder + file_name, sep="\t", index=None)
+    binary_path = folder + binary_file_name(file_name)
+    if feather is not None:
+        feather.write_feather(table.reset_index(drop=True), binary_path, compression='uncompressed')
+    elif os.path.exists(binary_path):
+        os.remove(binary_path)
+
+
+def binary_copy(folder, file_name):
+    # Path of the binary copy of a table, or None if it is missing, can't be read or is
+    # older than the TSV (e.g. the TSV was saved again without pyarrow)
+    binary_path = folder + binary_file_name(file_name)
+    if feather is None or not os.path.exists(binary_path):
+        return None
+    if os.path.exists(folder + file_name) and os.path.getmtime(binary_path) < os.path.getmtime(folder + file_name):
+        return None
+    return binary_path
+
+
+def read_tsv(folder, file_name, columns=None, chunksize=None):
+    # Reads a table saved by save_table from its TSV with the types of its binary copy:
+    # the code columns as categoricals and all the others as strings, so that codes like
+    # "NA" are not read as missing and numeric looking codes stay strings
+    header = pd.read_csv(folder + file_name, sep='\t', nrows=0).columns
+    dtypes = dict([(k, 'category' if k in CATEGORICAL_COLUMNS else str)
+                   for k in header if columns is None or k in columns])
+    return pd.read_csv(folder + file_name, sep='\t', usecols=columns, dtype=dtypes,
+                       keep_default_na=False, chunksize=chunksize)
+
+
+def read_table(folder, file_name, columns=None):
+    # Loads (the given columns of) a table saved by save_table, memory-mapping its typed
+    # binary copy when available
+    binary_path = binary_copy(folder, file_name)
+    if binary_path is not None:
+        return feather.read_feather(binary_path, columns=columns, memory_map=True)
+    return read_tsv(folder, file_name, columns=columns)
+
+
+def iter_table(folder, file_name, columns=None, chunksize=DEFAULT_CHUNKSIZE):
+    # Streams (the given columns of) a table saved by save_table in chunks of rows. The binary
+    # copy is memory-mapped, only the current chunk is converted to a dataframe
+    binary_path = binary_copy(folder, file_name)
+    if binary_path is not None:
+        table = feather.read_table(binary_path, columns=columns, memory_map=True)
+        for start in range(0, table.num_rows, chunksize):
+            yield table.slice(start, chunksize).to_pandas()
+    else:
+        for chunk in read_tsv(folder, file_name, columns=columns, chunksize=chunksize):
+            yield chunk
+
+
+def extract_save_task(task):
+    # Runs an extraction step and saves its table, returns the number of rows and the time taken
+    umls_extractor, step = task
+    start = time.time()
+    step, method, attribute, file_name = [k for k in EXTRACTION_STEPS if k[0] == step][0]
+    getattr(umls_extractor, method)()
+    umls_extractor.save_extract(attribute, file_name)
+    return step, getattr(umls_extractor, attribute).shape[0], time.time() - start
 
 
 class UMLSExtractor():
 
-    def __init__(self, umls_folder="2022AA/META/", output_folder="output/", allowed_vocabs=["SNOMEDCT_US"]):
+    def __init__(self, umls_folder="2022AA/META/", output_folder="output/", allowed_vocabs=["SNOMEDCT_US"],
+                 chunksize=DEFAULT_CHUNKSIZE):
         self.umls_folder = umls_folder
         self.output_folder = output_folder
         self.allowed_vocabs = allowed_vocabs
+        self.requested_vocabs = list(allowed_vocabs)
+        self.chunksize = chunksize
+        # Extracted tables saved in the output folder but not kept in memory, loaded when first used
+        self.saved_extracts = set([])
+
+    def __getattr__(self, name):
+        # Only called for missing attributes: loads the tables extracted by worker processes
+        # or by an earlier run from the output folder
+        if name in self.__dict__.get('saved_extracts', ()):
+            file_name = [k[3] for k in EXTRACTION_STEPS if k[2] == name][0]
+            setattr(self, name, read_table(self.output_folder, file_name))
+            self.saved_extracts.discard(name)
+            return getattr(self, name)
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
 
-    def extract_save_all(self):
-        self.extract_umls_concepts()
-        self.extract_alternate_labels()
-        self.extract_semantic_types()
-        self.extract_hierarchies()
-        self.extract_relations()
-        self.save_extracts()
+    def read_rrf(self, table, columns):
+        # Streams the given columns of a RRF file in chunks of self.chunksize rows,
+        # so that the filters can be applied before the whole file is in memory
+        dtypes = dict([(k, 'category' if k in CATEGORICAL_COLUMNS else str)
+                      for k in columns])
+        return pd.read_csv(self.umls_folder + table + '.RRF', sep="|", header=None, names=RRF_COLUMNS[table],
+                           usecols=columns, dtype=dtypes, keep_default_na=False, quoting=csv.QUOTE_NONE,
+                           chunksize=self.chunksize)
+
+    def extract_save_all(self, workers=1, force=False):
+        # The concepts are extracted first, as the other steps filter on the selected CUIs.
+        # With workers > 1, the other steps are extracted and saved in parallel processes,
+        # and their tables are loaded from the output folder when first used
+        if not force and self.is_cached():
+            self.saved_extracts = set([k[2] for k in EXTRACTION_STEPS])
+            print("Extracted files are up to date with the UMLS files and terminologies, skipping extraction")
+            print("--------------------")
+            return
+        cache_path = self.output_folder + EXTRACT_CACHE_FILE
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        timings = {}
+        start = time.time()
+        extract_save_task((self, 'concepts'))
+        timings['concepts'] = time.time() - start
+        steps = [k[0] for k in EXTRACTION_STEPS[1:]]
+        if workers > 1:
+            worker_extractor = UMLSExtractor(umls_folder=self.umls_folder, output_folder=self.output_folder,
+                                             allowed_vocabs=self.allowed_vocabs, chunksize=self.chunksize)
+            worker_extractor.cui_list = self.cui_list
+            with Pool(min(workers, len(steps))) as pool:
+                for step, rows, seconds in pool.imap_unordered(extract_save_task,
+                                                               [(worker_extractor, k) for k in steps]):
+                    print("Extracted and saved", step, "-", rows, "rows")
+                    timings[step] = seconds
+            self.saved_extracts = set([k[2] for k in EXTRACTION_STEPS[1:]])
+        else:
+            for step in steps:
+                timings[step] = extract_save_task((self, step))[2]
+        print("Extraction timings (seconds):")
+        for step in [k[0] for k in EXTRACTION_STEPS]:
+            print("  %-20s %10.1f" % (step, timings[step]))
+        print("  %-20s %10.1f" % ('total', time.time() - start))
+        self.save_cache_key()
+        print("--------------------")
+
+    def cache_key(self):
+        # The extracts only depend on the RRF files (identified by size and modification
+        # time) and on the requested terminologies
+        sources = {}
+        for table in RRF_TABLES:
+            stat = os.stat(self.umls_folder + table + '.RRF')
+            sources[table] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        return {'sources': sources, 'allowed_vocabs': sorted(set(self.requested_vocabs))}
+
+    def extract_files(self):
+        file_names = [k[3] for k in EXTRACTION_STEPS]
+        if feather is not None:
+            file_names += [binary_file_name(k) for k in file_names]
+        return file_names
+
+    def is_cached(self):
+        cache_path = self.output_folder + EXTRACT_CACHE_FILE
+        if not os.path.exists(cache_path):
+            return False
+        with open(cache_path) as cache_file:
+            cached_key = json.load(cache_file)
+        if cached_key != self.cache_key():
+            return False
+        return all(os.path.exists(self.output_folder + k) for k in self.extract_files())
+
+    def save_cache_key(self):
+        cache_path = self.output_folder + EXTRACT_CACHE_FILE
+        with open(cache_path + '.tmp', 'w') as cache_file:
+            json.dump(self.cache_key(), cache_file, indent=2)
+        os.replace(cache_path + '.tmp', cache_path)
 
     def extract_umls_concepts(self):
         print("Extracting relevant UMLS concepts from the terminologies",
               self.allowed_vocabs)
-        umls_concepts = pd.read_csv(
-            self.umls_folder + 'MRCONSO.RRF', sep="|", header=None, keep_default_na=False)
-        umls_concepts.columns = ['CUI', 'LAT', 'TS', 'LUI', 'STT', 'SUI', 'ISPREF',
-                                 'AUI', 'SAUI', 'SCUI', 'SDUI', 'SAB',
-                                 'TTY', 'CODE', 'STR', 'SRL', 'SUPPRESS', 'CVF', '0']
-        del umls_concepts['0']
-        english_umls_terms = umls_concepts[umls_concepts['LAT'] == 'ENG']
-        self.english_umls_terms = english_umls_terms[english_umls_terms['SUPPRESS'] == 'N']
+        columns = ['CUI', 'TS', 'AUI', 'SAB', 'CODE', 'STR']
+        # SNOMEDCT_US terms are also kept, in case none of the allowed terminologies are found
+        candidate_vocabs = set(self.allowed_vocabs + ['SNOMEDCT_US'])
+        self.english_vocabs = set([])
+        chunks = []
+        for umls_concepts in self.read_rrf('MRCONSO', columns + ['LAT', 'SUPPRESS']):
+            english_umls_terms = umls_concepts[umls_concepts['LAT'] == 'ENG']
+            english_umls_terms = english_umls_terms[english_umls_terms['SUPPRESS'] == 'N']
+            self.english_vocabs.update(english_umls_terms['SAB'].unique())
+            chunks.append(english_umls_terms[english_umls_terms['SAB'].isin(candidate_vocabs)][columns])
+        candidate_vocab_terms = concat_chunks(chunks, columns)
 
         self.determine_relevant_vocabs()
-        selected_vocab_terms = self.english_umls_terms[self.english_umls_terms['SAB'].apply(
-            lambda x: x in self.allowed_vocabs)]
-        self.selected_vocab_terms = selected_vocab_terms[[
-            'CUI', 'TS', 'AUI', 'SAB', 'CODE', 'STR']]
+        self.selected_vocab_terms = candidate_vocab_terms[candidate_vocab_terms['SAB'].isin(self.allowed_vocabs)]
         self.cui_list = set(self.selected_vocab_terms['CUI'])
         print("Relevant UMLS concepts in selected terminologies found:",
               self.selected_vocab_terms.shape[0])
@@ -41,7 +253,7 @@ class UMLSExtractor():
 
     def determine_relevant_vocabs(self):
         print("Determining relevant terminologies")
-        unique_vocabs = set(self.english_umls_terms['SAB'])
+        unique_vocabs = self.english_vocabs
         relevant_vocabs = set(self.allowed_vocabs).intersection(unique_vocabs)
         if len(relevant_vocabs) == 0:
             print("No relevant terminologies found, reverting to SNOMEDCT_US")
@@ -53,67 +265,61 @@ class UMLSExtractor():
 
     def extract_alternate_labels(self):
         print("Extracting alternate labels")
-        selected_cui_list_alt = self.english_umls_terms[self.english_umls_terms['CUI'].apply(
-            lambda x: x in self.cui_list)]
-        selected_cui_list_alt = selected_cui_list_alt[selected_cui_list_alt['SAB'].apply(
-            lambda x: x not in self.allowed_vocabs)]
-        selected_cui_list_alt = selected_cui_list_alt[['CUI', 'TS', 'STR']]
-        self.alternate_labels = selected_cui_list_alt.drop_duplicates([
-                                                                      'CUI', 'STR'])
+        # Second pass over MRCONSO, as the alternate labels are filtered on the selected CUIs
+        columns = ['CUI', 'TS', 'STR']
+        chunks = []
+        for umls_concepts in self.read_rrf('MRCONSO', ['CUI', 'LAT', 'TS', 'SAB', 'STR', 'SUPPRESS']):
+            english_umls_terms = umls_concepts[umls_concepts['LAT'] == 'ENG']
+            english_umls_terms = english_umls_terms[english_umls_terms['SUPPRESS'] == 'N']
+            selected_cui_list_alt = english_umls_terms[english_umls_terms['CUI'].isin(self.cui_list)]
+            selected_cui_list_alt = selected_cui_list_alt[~selected_cui_list_alt['SAB'].isin(self.allowed_vocabs)]
+            chunks.append(selected_cui_list_alt[columns].drop_duplicates(['CUI', 'STR']))
+        self.alternate_labels = concat_chunks(chunks, columns).drop_duplicates([
+                                                                               'CUI', 'STR'])
         print("Alternate labels in other terminologies found:",
               self.alternate_labels.shape[0])
         print("--------------------")
 
     def extract_semantic_types(self):
         print("Extracting semantic types")
-        semantic_types = pd.read_csv(
-            self.umls_folder + 'MRSTY.RRF', sep="|", header=None, keep_default_na=False)
-        semantic_types.columns = ['CUI', 'STY',
-                                  'TUI', 'STYNAME', 'ATUI', 'CVF', '0']
-        semantic_types = semantic_types[['CUI', 'STY', 'STYNAME']]
-        self.semantic_types = semantic_types[semantic_types['CUI'].apply(
-            lambda x: x in self.cui_list)]
+        columns = ['CUI', 'STY', 'STYNAME']
+        chunks = []
+        for semantic_types in self.read_rrf('MRSTY', columns):
+            chunks.append(semantic_types[semantic_types['CUI'].isin(self.cui_list)])
+        self.semantic_types = concat_chunks(chunks, columns)
         print("Semantic types found:", self.semantic_types.shape[0])
         print("--------------------")
 
     def extract_hierarchies(self):
         print("Extracting hierarchical relations")
-        hierarchies = pd.read_csv(
-            self.umls_folder + 'MRHIER.RRF', sep="|", header=None, keep_default_na=False)
-        hierarchies.columns = ['CUI', 'AUI', 'CXN',
-                               'PAUI', 'SAB', 'RELA', 'PTR', 'HCD', 'CVF', '0']
-        hierarchies = hierarchies[hierarchies['SAB'].apply(
-            lambda x: x in self.allowed_vocabs)]
-        self.hierarchies = hierarchies[['CUI', 'AUI', 'PAUI', 'SAB', 'RELA']]
+        columns = ['CUI', 'AUI', 'PAUI', 'SAB', 'RELA']
+        chunks = []
+        for hierarchies in self.read_rrf('MRHIER', columns):
+            chunks.append(hierarchies[hierarchies['SAB'].isin(self.allowed_vocabs)])
+        self.hierarchies = concat_chunks(chunks, columns)
         print("Hierarchical relations found:", self.hierarchies.shape[0])
         print("--------------------")
 
     def extract_relations(self):
         print("Extracting associative relations")
-        relations = pd.read_csv(
-            self.umls_folder + 'MRREL.RRF', sep="|", header=None, keep_default_na=False)
-        relations = relations[relations[10].apply(
-            lambda x: x in self.allowed_vocabs)]
-        relations = relations[relations[7].apply(lambda x: len(str(x)) > 0)]
-        relations = relations[[0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 11]]
-        relations.columns = ['CUI1', 'AUI1', 'STYPE1', 'REL',
-                             'CUI2', 'AUI2', 'STYPE2', 'RELA', 'RUI', 'SAB', 'SL']
-        self.relations = relations
+        columns = ['CUI1', 'AUI1', 'STYPE1', 'REL',
+                   'CUI2', 'AUI2', 'STYPE2', 'RELA', 'RUI', 'SAB', 'SL']
+        chunks = []
+        for relations in self.read_rrf('MRREL', columns):
+            relations = relations[relations['SAB'].isin(self.allowed_vocabs)]
+            relations = relations[relations['RELA'] != '']
+            chunks.append(relations)
+        self.relations = concat_chunks(chunks, columns)
         print("Associative relations found:", self.relations.shape[0])
         print("--------------------")
 
+    def save_extract(self, attribute, file_name):
+        save_table(getattr(self, attribute), self.output_folder, file_name)
+
     def save_extracts(self):
         print("Saving extracted files")
-        self.selected_vocab_terms.to_csv(
-            self.output_folder + 'selected_vocab_terms.tsv', sep="\t", index=None)
-        self.alternate_labels.to_csv(
-            self.output_folder + 'alternate_labels.tsv', sep="\t", index=None)
-        self.semantic_types.to_csv(
-            self.output_folder + 'semantic_types.tsv', sep="\t", index=None)
-        self.hierarchies.to_csv(self.output_folder +
-                                'hierarchies.tsv', sep="\t", index=None)
-        self.relations.to_csv(self.output_folder +
-                              'relations_selected.tsv', sep="\t", index=None)
+        for step, method, attribute, file_name in EXTRACTION_STEPS:
+            self.save_extract(attribute, file_name)
 
 
 def main():
@@ -124,6 +330,13 @@ def main():
                         help='Folder path to store the extracted files')
     parser.add_argument('--terminologies', type=str, required=True,
                         help='Comma-separated list of allowed terminologies (e.g., SNOMEDCT_US,ICD10CM)')
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE,
+                        help='Number of rows of the RRF files read and filtered at a time')
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1),
+                        help='Number of processes extracting the semantic types, hierarchies, relations '
+                             'and alternate labels in parallel')
+    parser.add_argument('--force', action='store_true',
+                        help='Extract the files even if they are up to date with the UMLS files and terminologies')
     args = parser.parse_args()
 
     umls_folder = args.umlsfolder if len(
@@ -133,8 +346,9 @@ def main():
     allowed_vocabs = [k.strip().upper() for k in args.terminologies.split(
         ",")] if len(args.terminologies) > 0 else ['SNOMEDCT_US']
     umls_extractor = UMLSExtractor(
-        umls_folder=umls_folder, output_folder=output_folder, allowed_vocabs=allowed_vocabs)
-    umls_extractor.extract_save_all()
+        umls_folder=umls_folder, output_folder=output_folder, allowed_vocabs=allowed_vocabs,
+        chunksize=args.chunksize)
+    umls_extractor.extract_save_all(workers=args.workers, force=args.force)
 
 
 if __name__ == "__main__":
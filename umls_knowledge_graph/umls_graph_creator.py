@@ -1,32 +1,161 @@
 import pandas as pd
 import networkx as nx
 import argparse
+import os
+import pickle
+from umls_extractor import read_table, iter_table, DEFAULT_CHUNKSIZE
+from compact_graph import CompactUMLSGraph
+from hierarchy_index import HierarchyIndex
+import graph_store
+
+
+def hierarchy_edge_table(umls_terms, umls_hierarchy, model_type):
+    # Hierarchical edges (child, parent, SAB) between CUIs (model1) or terminology codes (model2),
+    # mapping the AUIs of the hierarchical relations to the CUIs/codes of the selected terms
+    node_column = 'CUI' if model_type == 'model1' else 'CODE'
+    lookup = umls_terms[['AUI', node_column]].drop_duplicates()
+    aui_index = pd.Index(lookup['AUI'])
+    if not aui_index.is_unique:
+        ap = umls_hierarchy[['AUI', 'PAUI', 'SAB']].drop_duplicates()
+        edges = ap.merge(lookup.rename(columns={node_column: 'source'}), on='AUI')
+        edges = edges.merge(lookup.rename(columns={'AUI': 'PAUI', node_column: 'target'}), on='PAUI')
+        return edges[['source', 'target', 'SAB']].drop_duplicates().reset_index(drop=True)
+
+    # AUIs are unique in the terms (as in MRCONSO), the join is done on integer positions
+    node_codes, nodes = pd.factorize(lookup[node_column])
+    child_rows = aui_index.get_indexer(umls_hierarchy['AUI'])
+    parent_rows = aui_index.get_indexer(umls_hierarchy['PAUI'])
+    found = (child_rows >= 0) & (parent_rows >= 0)
+    sab_codes, sabs = pd.factorize(umls_hierarchy['SAB'])
+    edges = pd.DataFrame({'source': node_codes[child_rows[found]], 'target': node_codes[parent_rows[found]],
+                          'SAB': sab_codes[found]}).drop_duplicates()
+    return pd.DataFrame({'source': nodes.take(edges['source'].values),
+                         'target': nodes.take(edges['target'].values),
+                         'SAB': sabs.take(edges['SAB'].values)})
+
+
+def relation_node_lookup(umls_terms, model_type):
+    # Maps the relation ends to the graph nodes: CUIs (model1), or AUIs to terminology codes (model2)
+    if model_type == 'model1':
+        nodes = pd.unique(umls_terms['CUI'])
+        return pd.Index(nodes), nodes
+    lookup = umls_terms[['AUI', 'CODE']].drop_duplicates('AUI')
+    return pd.Index(lookup['AUI']), lookup['CODE'].values
+
+
+def relation_edge_table(relations, node_lookup, model_type):
+    # Associative edges (source, target, RELA, SAB) between the graph nodes. In MRREL, REL/RELA is the
+    # relationship of the second concept/atom to the first, so edges go from CUI2/AUI2 to CUI1/AUI1
+    index, nodes = node_lookup
+    first, second = ('CUI1', 'CUI2') if model_type == 'model1' else ('AUI1', 'AUI2')
+    sources = index.get_indexer(relations[second])
+    targets = index.get_indexer(relations[first])
+    found = (sources >= 0) & (targets >= 0)
+    return pd.DataFrame({'source': nodes[sources[found]], 'target': nodes[targets[found]],
+                         'RELA': relations['RELA'].astype(str).values[found],
+                         'SAB': relations['SAB'].astype(str).values[found]}).drop_duplicates()
 
 
 class UMLSGraphCreator():
-    def __init__(self, data_folder="tempdata/", model_type="model1"):
+    def __init__(self, data_folder="tempdata/", model_type="model1", backend="networkx",
+                 include_relations=False, relation_types=None, chunksize=DEFAULT_CHUNKSIZE,
+                 compression='uncompressed', hierarchy_index=False):
         self.umls_G = nx.DiGraph()
         self.data_folder = data_folder
         self.umls_reverse_lookup = {}
         self.model_type = model_type
+        self.backend = backend
+        self.include_relations = include_relations
+        self.relation_types = relation_types
+        self.chunksize = chunksize
+        self.compression = compression
+        self.graph_folder = data_folder + model_type + "_umls_graph/"
+        self.hierarchy_index = hierarchy_index
+        self.hierarchy_index_file = data_folder + model_type + "_hierarchy_index.pickle"
 
     def main(self):
+        if self.backend == 'compact':
+            if self.include_relations:
+                raise ValueError("The compact backend does not support associative relations, "
+                                 "use the networkx backend to include them")
+            self.create_compact_graph()
+            return
         self.populate_labels()
         self.populate_hierarchy_edges()
-        # self.populate_relations_edges()
+        if self.include_relations:
+            self.populate_relations_edges()
+        if self.hierarchy_index:
+            self.create_hierarchy_index()
 
-    def save_temp_files(self):
+    def save_temp_files(self, stage='full', nodes=None, edges=None, reset=False):
+        # Saves the graph as columnar tables (see graph_store.py). A stage only saves the given nodes
+        # and edges (all of them when None), with reset the previously saved stages are discarded.
+        # Without pyarrow, the whole graph is pickled
         print ('Size of the knowledge graph: Nodes -', len(self.umls_G.nodes()), ", Edges -", len(self.umls_G.edges()))
         print ('Saving temporary files ...')
-        nx.write_gpickle(self.umls_G, self.data_folder +
-                         self.model_type + "_umls_G.gpickle")
+        if graph_store.pa is not None:
+            graph_store.save_graph_stage(self.umls_G, self.graph_folder, stage, self.model_type,
+                                         nodes=nodes, edges=edges, reset=reset, compression=self.compression)
+        else:
+            with open(self.data_folder + self.model_type + "_umls_G.pickle", 'wb') as graph_file:
+                pickle.dump(self.umls_G, graph_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load_temp_files(self):
+        # Loads the saved graph: columnar tables, else the pickled graph, else a graph saved by
+        # previous versions with nx.write_gpickle
+        pickle_path = self.data_folder + self.model_type + "_umls_G.pickle"
+        gpickle_path = self.data_folder + self.model_type + "_umls_G.gpickle"
+        if graph_store.pa is not None and graph_store.read_manifest(self.graph_folder) is not None:
+            self.umls_G = graph_store.load_graph(self.graph_folder)
+        elif os.path.exists(pickle_path):
+            with open(pickle_path, 'rb') as graph_file:
+                self.umls_G = pickle.load(graph_file)
+        elif os.path.exists(gpickle_path) and hasattr(nx, 'read_gpickle'):
+            self.umls_G = nx.read_gpickle(gpickle_path)
+        else:
+            raise IOError("No UMLS Knowledge Graph saved in " + self.data_folder)
+
+    def create_compact_graph(self):
+        # Builds the labels and hierarchical relations into an array-backed graph (see compact_graph.py)
+        print ('Creating the compact UMLS Knowledge Graph')
+        umls_terms = read_table(self.data_folder, 'selected_vocab_terms.tsv')
+        alternate_labels = read_table(self.data_folder, 'alternate_labels.tsv')
+        umls_hierarchy = read_table(self.data_folder, 'hierarchies.tsv')
+        hierarchy_edges = hierarchy_edge_table(
+            umls_terms, umls_hierarchy, self.model_type)
+        self.compact_G = CompactUMLSGraph.from_tables(
+            umls_terms, alternate_labels, hierarchy_edges, model_type=self.model_type)
+        print ('Size of the knowledge graph: Nodes -', self.compact_G.number_of_nodes(),
+               ", Edges -", self.compact_G.number_of_edges())
+        print ('Saving temporary files ...')
+        with open(self.data_folder + self.model_type + "_umls_compact.pickle", 'wb') as graph_file:
+            pickle.dump(self.compact_G, graph_file, protocol=pickle.HIGHEST_PROTOCOL)
+        print("--------------------")
+        if self.hierarchy_index:
+            self.create_hierarchy_index(hierarchy_edges)
+
+    def create_hierarchy_index(self, hierarchy_edges=None):
+        # Builds the ancestor/descendant index of the hierarchical edges (see hierarchy_index.py),
+        # from the hierarchical edge table with the compact backend, else from the graph
+        print ('Creating the hierarchy index of the UMLS Knowledge Graph')
+        if hierarchy_edges is not None:
+            self.umls_hierarchy_index = HierarchyIndex.from_edges(
+                hierarchy_edges['source'], hierarchy_edges['target'])
+        else:
+            self.umls_hierarchy_index = HierarchyIndex.from_graph(self.umls_G)
+        self.save_hierarchy_index()
+        print("--------------------")
+
+    def save_hierarchy_index(self):
+        print ('Size of the hierarchy index: Nodes -', self.umls_hierarchy_index.number_of_nodes(),
+               ", Intervals -", self.umls_hierarchy_index.number_of_intervals())
+        with open(self.hierarchy_index_file, 'wb') as index_file:
+            pickle.dump(self.umls_hierarchy_index, index_file, protocol=pickle.HIGHEST_PROTOCOL)
 
     def populate_labels(self):
         print ('Populating labels in the UMLS Knowledge Graph')
-        umls_terms = pd.read_csv(
-            self.data_folder + 'selected_vocab_terms.tsv', sep='\t')
-        alternate_labels = pd.read_csv(
-            self.data_folder + 'alternate_labels.tsv', sep='\t')
+        umls_terms = read_table(self.data_folder, 'selected_vocab_terms.tsv')
+        alternate_labels = read_table(self.data_folder, 'alternate_labels.tsv')
 
         print ("Read in", umls_terms.shape[0], "UMLS concept labels")
 
@@ -71,41 +200,232 @@ class UMLSGraphCreator():
                 self.umls_reverse_lookup[k[2]].append(k[4])
 
         print ('Labels populated in the UMLS Knowledge Graph')
-        self.save_temp_files()
+        self.save_temp_files('labels', reset=True)
         print("--------------------")
 
     def populate_hierarchy_edges(self):
         print ('Populating hierarchical relations in the UMLS Knowledge Graph')
-        umls_hierarchy = pd.read_csv(
-            self.data_folder + 'hierarchies.tsv', sep="\t")
-        ap = umls_hierarchy.drop_duplicates(['CUI', 'AUI', 'PAUI', 'SAB'])
+        umls_terms = read_table(self.data_folder, 'selected_vocab_terms.tsv',
+                                columns=['CUI', 'AUI', 'CODE'])
+        umls_hierarchy = read_table(self.data_folder, 'hierarchies.tsv',
+                                    columns=['AUI', 'PAUI', 'SAB'])
 
         # Model 1 creates hierarchical edges between CUIs instead of terminology codes
         # Model 2 creates hierarchical edges between terminology codes
-        for k in ap.values.tolist():
-            cids = self.umls_reverse_lookup[k[1]
-                                            ] if k[1] in self.umls_reverse_lookup else []
-            pids = self.umls_reverse_lookup[k[2]
-                                            ] if k[2] in self.umls_reverse_lookup else []
-            for m in cids:
-                for n in pids:
+        # The edges are joined and deduplicated as a table, then added to the graph in bulk
+        hierarchy_edges = hierarchy_edge_table(
+            umls_terms, umls_hierarchy, self.model_type)
+        with graph_store.paused_gc():
+            new_edges, updated_edges = [], []
+            if self.model_type == 'model1':
+                edge_vocabs = {}
+                for m, n, sab in zip(hierarchy_edges['source'].values.tolist(), hierarchy_edges['target'].values.tolist(),
+                                     hierarchy_edges['SAB'].astype(str).values.tolist()):
+                    if (m, n) not in edge_vocabs:
+                        edge_vocabs[(m, n)] = set([])
+                    edge_vocabs[(m, n)].add(sab)
+                for (m, n), vocab in edge_vocabs.items():
+                    if self.umls_G.has_edge(m, n):
+                        self.umls_G[m][n]['vocab'].update(vocab)
+                        updated_edges.append((m, n))
+                    else:
+                        new_edges.append(
+                            (m, n, {'edge_type': "IS_SUBCLASS_OF", 'vocab': vocab}))
+            else:
+                for m, n in hierarchy_edges[['source', 'target']].drop_duplicates().values.tolist():
                     if not self.umls_G.has_edge(m, n):
-                        if self.model_type == 'model1':
-                            self.umls_G.add_edge(
-                                m, n, edge_type="IS_SUBCLASS_OF", vocab=set([]))
-                        else:
-                            self.umls_G.add_edge(
-                                m, n, edge_type="IS_SUBCLASS_OF")
-                    if self.model_type == 'model1':
-                        self.umls_G[m][n]['vocab'].add(k[3])
+                        new_edges.append((m, n, {'edge_type': "IS_SUBCLASS_OF"}))
+            self.umls_G.add_edges_from(new_edges)
 
         print ('Hierarchical relations populated in the UMLS Knowledge Graph')
-        self.save_temp_files()
+        # Only the edges added or modified by this stage are saved
+        self.save_temp_files('hierarchies', nodes=[],
+                             edges=updated_edges + [(m, n) for m, n, attributes in new_edges])
+        print("--------------------")
+
+    def apply_delta(self, delta_folder):
+        # Updates the saved knowledge graph in place with a delta between two UMLS releases (see umls_delta.py).
+        # The labels of the affected CUIs (model1) or codes (model2) are rebuilt from their terms in the
+        # new release, and the hierarchical edges added/removed between the releases are applied.
+        # With include_relations, the associative edges of the affected node pairs are rebuilt
+        print ('Applying the UMLS release delta in', delta_folder, 'to the UMLS Knowledge Graph')
+        self.load_temp_files()
+        affected_nodes = read_table(delta_folder, 'affected_nodes.tsv')
+        affected_terms = read_table(delta_folder, 'affected_terms.tsv')
+        affected_alternate_labels = read_table(
+            delta_folder, 'affected_alternate_labels.tsv')
+        affected_cuis = set(
+            affected_nodes[affected_nodes['node_kind'] == 'CUI']['node'])
+        affected_codes = set(
+            affected_nodes[affected_nodes['node_kind'] == 'CODE']['node'])
+
+        if self.model_type == 'model1':
+            for m in affected_cuis:
+                if self.umls_G.has_node(m):
+                    self.umls_G.nodes[m].update(vocabcodes=set([]), preflabels=set([]), altlabels=set([]))
+            for k in affected_terms[affected_terms['CUI'].isin(affected_cuis)].values.tolist():
+                if not self.umls_G.has_node(k[0]):
+                    self.umls_G.add_node(k[0], node_type='UMLS_CUI', vocabcodes=set([]),
+                                         preflabels=set([]), altlabels=set([]))
+                self.umls_G.nodes[k[0]]['vocabcodes'].add(k[3] + ": " + k[4])
+                if k[1] == 'P':
+                    self.umls_G.nodes[k[0]]['preflabels'].add(
+                        str(k[5]).lower())
+                if k[1] == 'S':
+                    self.umls_G.nodes[k[0]]['altlabels'].add(str(k[5]).lower())
+            for k in affected_alternate_labels.values.tolist():
+                if self.umls_G.has_node(k[0]):
+                    self.umls_G.nodes[k[0]]['altlabels'].add(str(k[2]).lower())
+            removed_nodes = affected_cuis - set(affected_terms['CUI'])
+        else:
+            for n in affected_codes:
+                if self.umls_G.has_node(n):
+                    self.umls_G.nodes[n].update(preflabels=set([]), altlabels=set([]))
+                    self.umls_G.nodes[n].pop('node_type', None)
+                    self.umls_G.remove_edges_from([e for e in self.umls_G.out_edges(n, data='edge_type')
+                                                   if e[2] == 'HAS_CUI'])
+            for k in affected_terms.values.tolist():
+                if not self.umls_G.has_node(k[0]):
+                    self.umls_G.add_node(k[0], node_type='UMLS_CUI')
+                if not self.umls_G.has_node(k[4]):
+                    self.umls_G.add_node(k[4], node_type=k[3],
+                                         preflabels=set([]), altlabels=set([]))
+                elif 'node_type' not in self.umls_G.nodes[k[4]]:
+                    self.umls_G.nodes[k[4]]['node_type'] = k[3]
+                self.umls_G.add_edge(k[4], k[0], edge_type='HAS_CUI')
+
+                if k[1] == 'P':
+                    self.umls_G.nodes[k[4]]['preflabels'].add(
+                        str(k[5]).lower())
+                if k[1] == 'S':
+                    self.umls_G.nodes[k[4]]['altlabels'].add(str(k[5]).lower())
+            removed_nodes = (affected_cuis - set(affected_terms['CUI'])).union(
+                affected_codes - set(affected_terms['CODE']))
+        self.umls_G.remove_nodes_from(removed_nodes)
+        print ('Labels updated for', len(affected_cuis), 'CUIs and', len(affected_codes), 'codes,',
+               len(removed_nodes), 'nodes removed')
+
+        # The associative relations of the affected node pairs are removed before the hierarchical
+        # edges are updated, and added back from the new release afterwards, as in a full build
+        if self.include_relations:
+            affected_pairs = read_table(
+                delta_folder, 'relation_edges_' + self.model_type + '_pairs.tsv')
+            for m, n in affected_pairs[['source', 'target']].values.tolist():
+                if not self.umls_G.has_edge(m, n):
+                    continue
+                if self.umls_G[m][n]['edge_type'] == "HAS_RELATION":
+                    self.umls_G.remove_edge(m, n)
+                else:
+                    self.umls_G[m][n].pop('relas', None)
+
+        removed_edges = read_table(
+            delta_folder, 'hierarchy_edges_' + self.model_type + '_removed.tsv')
+        added_edges = read_table(
+            delta_folder, 'hierarchy_edges_' + self.model_type + '_added.tsv')
+        # model1 edges are listed per terminology (source, target, SAB), model2 edges as (source, target)
+        for k in removed_edges.values.tolist():
+            m, n = k[0], k[1]
+            if not self.umls_G.has_edge(m, n) or self.umls_G[m][n]['edge_type'] != "IS_SUBCLASS_OF":
+                continue
+            if self.model_type == 'model1':
+                self.umls_G[m][n]['vocab'].discard(k[2])
+                if len(self.umls_G[m][n]['vocab']) == 0:
+                    self.umls_G.remove_edge(m, n)
+            else:
+                self.umls_G.remove_edge(m, n)
+        for k in added_edges.values.tolist():
+            m, n = k[0], k[1]
+            if not self.umls_G.has_edge(m, n):
+                if self.model_type == 'model1':
+                    self.umls_G.add_edge(
+                        m, n, edge_type="IS_SUBCLASS_OF", vocab=set([]))
+                else:
+                    self.umls_G.add_edge(
+                        m, n, edge_type="IS_SUBCLASS_OF")
+            if self.model_type == 'model1':
+                self.umls_G[m][n]['vocab'].add(k[2])
+        print ('Hierarchical relations updated:', added_edges.shape[0], 'added,',
+               removed_edges.shape[0], 'removed')
+
+        # A saved hierarchy index is updated with the changed hierarchical edges
+        if os.path.exists(self.hierarchy_index_file):
+            with open(self.hierarchy_index_file, 'rb') as index_file:
+                self.umls_hierarchy_index = pickle.load(index_file)
+            changed_edges = [(k[0], k[1]) for k in removed_edges.values.tolist() + added_edges.values.tolist()]
+            if self.umls_hierarchy_index.update(self.umls_G, changed_edges):
+                print ('Hierarchy index updated for', len(changed_edges), 'hierarchical relations')
+            else:
+                print ('Hierarchy index rebuilt, the hierarchical cycles changed')
+            self.save_hierarchy_index()
+        elif self.hierarchy_index:
+            self.umls_hierarchy_index = HierarchyIndex.from_graph(self.umls_G)
+            self.save_hierarchy_index()
+
+        if self.include_relations:
+            affected_edges = read_table(
+                delta_folder, 'relation_edges_' + self.model_type + '_affected.tsv')
+            if self.relation_types:
+                affected_edges = affected_edges[affected_edges['RELA'].isin(self.relation_types)]
+            self.add_relation_edges(affected_edges)
+            print ('Associative relations updated for', affected_pairs.shape[0], 'node pairs')
+
+        print ('UMLS release delta applied to the UMLS Knowledge Graph')
+        self.save_temp_files('full', reset=True)
         print("--------------------")
 
     def populate_relations_edges(self):
-        umls_relations = pd.read_csv(
-            self.data_folder + 'relations_selected.tsv', sep="\t")
+        print ('Populating associative relations in the UMLS Knowledge Graph')
+        umls_terms = read_table(self.data_folder, 'selected_vocab_terms.tsv',
+                                columns=['CUI', 'AUI', 'CODE'])
+        node_lookup = relation_node_lookup(umls_terms, self.model_type)
+
+        # Model 1 creates associative edges between CUIs, Model 2 between terminology codes.
+        # The relations are streamed in chunks, optionally restricted to some relation types (RELA)
+        n_relations = 0
+        changed_edges = set([])
+        for umls_relations in iter_table(self.data_folder, 'relations_selected.tsv',
+                                         columns=['CUI1', 'AUI1', 'CUI2', 'AUI2', 'RELA', 'SAB'],
+                                         chunksize=self.chunksize):
+            if self.relation_types:
+                umls_relations = umls_relations[umls_relations['RELA'].isin(self.relation_types)]
+            relation_edges = relation_edge_table(
+                umls_relations, node_lookup, self.model_type)
+            changed_edges.update(self.add_relation_edges(relation_edges))
+            n_relations += relation_edges.shape[0]
+            print ('Associative relations added:', n_relations)
+
+        print ('Associative relations populated in the UMLS Knowledge Graph')
+        self.save_temp_files('relations', nodes=[], edges=changed_edges)
+        print("--------------------")
+
+    def add_relation_edges(self, relation_edges):
+        # Adds associative edges with their relation types (relas) and, for model1, terminologies (vocab).
+        # Node pairs already linked by another edge type get the relation types on that edge.
+        # Returns the node pairs of the added or modified edges
+        edge_relas = {}
+        for m, n, rela, sab in relation_edges[['source', 'target', 'RELA', 'SAB']].values.tolist():
+            if (m, n) not in edge_relas:
+                edge_relas[(m, n)] = (set([]), set([]))
+            edge_relas[(m, n)][0].add(rela)
+            edge_relas[(m, n)][1].add(sab)
+
+        with graph_store.paused_gc():
+            new_edges = []
+            for (m, n), (relas, vocab) in edge_relas.items():
+                if not self.umls_G.has_edge(m, n):
+                    attributes = {'edge_type': "HAS_RELATION", 'relas': relas}
+                    if self.model_type == 'model1':
+                        attributes['vocab'] = vocab
+                    new_edges.append((m, n, attributes))
+                    continue
+                edge = self.umls_G[m][n]
+                if 'relas' not in edge:
+                    edge['relas'] = set([])
+                edge['relas'].update(relas)
+                if edge['edge_type'] == "HAS_RELATION" and self.model_type == 'model1':
+                    edge['vocab'].update(vocab)
+            self.umls_G.add_edges_from(new_edges)
+        return edge_relas.keys()
 
 
 def main():
@@ -114,15 +434,40 @@ def main():
                         help='Folder path to where the temporary input/output files are saved')
     parser.add_argument('--modeltype', type=str, required=False,
                         help='Representation model for the UMLS knowledge graph (See README for for more information)')
+    parser.add_argument('--backend', type=str, required=False, default='networkx', choices=['networkx', 'compact'],
+                        help='Graph representation: networkx DiGraph or compact array-backed graph (see compact_graph.py)')
+    parser.add_argument('--relations', action='store_true',
+                        help='Also populate the associative relations (relations_selected.tsv)')
+    parser.add_argument('--relationtypes', type=str, required=False,
+                        help='Comma-separated list of relation types (RELA) to include, all by default')
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE,
+                        help='Number of associative relations loaded at a time')
+    parser.add_argument('--compression', type=str, default='uncompressed', choices=['uncompressed', 'lz4', 'zstd'],
+                        help='Compression of the saved graph tables (uncompressed tables are memory-mapped when loaded)')
+    parser.add_argument('--hierarchyindex', action='store_true',
+                        help='Also build an ancestor/descendant index of the hierarchical relations (see hierarchy_index.py)')
+    parser.add_argument('--deltafolder', type=str, required=False,
+                        help='Folder path to a delta between two UMLS releases (see umls_delta.py) to apply to the saved graph')
     args = parser.parse_args()
+    if args.backend == 'compact' and (args.relations or args.relationtypes):
+        parser.error('--relations and --relationtypes are not supported with --backend compact')
+    if args.backend == 'compact' and args.deltafolder:
+        parser.error('--deltafolder updates the networkx graph, it is not supported with --backend compact')
 
     data_folder = args.datafolder if args.datafolder and len(
         args.datafolder) > 0 else 'tempdata/'
     model_type = args.modeltype if args.modeltype and len(
         args.modeltype) > 0 else 'model1'
+    relation_types = [k.strip() for k in args.relationtypes.split(
+        ",") if len(k.strip()) > 0] if args.relationtypes else None
     umls_graph_creator = UMLSGraphCreator(
-        data_folder=data_folder, model_type=model_type)
-    umls_graph_creator.main()
+        data_folder=data_folder, model_type=model_type, backend=args.backend,
+        include_relations=args.relations, relation_types=relation_types, chunksize=args.chunksize,
+        compression=args.compression, hierarchy_index=args.hierarchyindex)
+    if args.deltafolder:
+        umls_graph_creator.apply_delta(args.deltafolder)
+    else:
+        umls_graph_creator.main()
 
 
 if __name__ == "__main__":
@@ -19,10 +19,18 @@
 
 
 import re
+from array import array
+from collections import deque
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
 
 INPUT_ENCODING = "UTF-8"
 OUTPUT_ENCODING = "UTF-8"
 DEBUG_GTB_TOKENIZATION = False
+# Use the fast core (_tokenize_fast), which gives output identical to
+# _tokenize; the latter is kept as the reference implementation.
+USE_FAST_TOKENIZATION = True
 
 # Penn treebank bracket escapes (others excluded)
 PTB_ESCAPES = [('(', '-LRB-'),
@@ -210,39 +218,189 @@ def _tokenize(s):
     return s
 
 
-def tokenize(s, ptb_escaping=False, use_single_quotes_only=False,
-             escape_token_internal_parens=False):
-    """Tokenizes the given string with a GTB-like tokenization.
+# The fast core (_tokenize_fast) gives exactly the same output as
+# _tokenize(), but avoids running ~100 regexes over the whole string:
+#
+# - None of the rules can match across a space: a match either lies
+#   within a space-separated token or starts/ends with the spaces
+#   around it (lookarounds only check the next or previous character).
+#   The core is thus run on each token separately, with a space on
+#   either side, and the results are cached, so that only tokens not
+#   seen before are actually processed. Tokens made of letters and
+#   digits only are never changed by the per-token rules and are
+#   passed through as is.
+# - The exceptions are the sentence-final period rule (anchored at the
+#   end of the string), which only runs on the last token, and the
+#   final rules that need a space on both sides of the match (" cannot "
+#   etc.) or join spaces, which still run over the whole string.
+# - Within a token, rules matching a fixed string are applied with
+#   str.replace(), and a rule is skipped if the token lacks the
+#   characters it needs to match. The set of characters is computed
+#   once and then only grows with the characters of the replacements,
+#   so a rule that could match is never skipped.
+#
+# Run "gtbtokenize.py -check FILE" to compare the two cores on a corpus.
+
+# characters needed for a rule to match: the rule can only match if all
+# the characters of at least one of the given strings are present.
+__needs = {
+    r'([,;:@#]) ': (',', ';', ':', '@', '#'),
+    r' ([,;:@#])': (',', ';', ':', '@', '#'),
+    r'([,:;])([\[\]\)\}\>\"\']* +)': (',', ':', ';'),
+    r'(\.+)([\[\]\)\}\>\"\']* +)$': ('.',),
+    r'((?:=\/)?<+(?:\/=|--+>?)?)': ('<',),
+    r'((?:<?--+|=\/)?>+(?:\/=)?)': ('>',),
+    r'(<?--+\>?)': ('-',),
+    r'\(([^ A-Z()\[\]{}]+)\)-': ('()-',),
+    r'(?<![ (\[{])\(([^ ()\[\]{}]*)\)': ('()',),
+    r'\(([^ ()\[\]{}]*)\)(?![ )\]}\/-])': ('()',),
+    r'(?<![ (\[{])\[([^ ()\[\]{}]*)\]': ('[]',),
+    r'\[([^ ()\[\]{}]*)\](?![ )\]}\/-])': ('[]',),
+    r'(?<![ (\[{])\{([^ ()\[\]{}]*)\}': ('{}',),
+    r'\{([^ ()\[\]{}]*)\}(?![ )\]}\/-])': ('{}',),
+    r' (\'+)': ("'",),
+    r'(?<![35\'])(\'+) ': ("'",),
+}
+
+# rules needing spaces on both sides of the match, run on the whole string
+__whole_string = set([r'  +'])
+
+# bound on the number of cached tokens (per cache, the last token of a
+# string being processed differently)
+TOKEN_CACHE_SIZE = 1000000
+__token_cache, __last_token_cache = {}, {}
+
+
+def __literal(pattern):
+    """Returns the fixed string matched by the given regex, or None if
+    the regex uses any special characters."""
+    if re.search(r'[.^$*+?{}\[\]|()\\]', re.sub(r'\\\W', '', pattern)):
+        return None
+    return re.sub(r'\\(\W)', r'\1', pattern)
+
+
+def __compile_fast(rules):
+    """Compiles (regex, replacement) rules into (regex or fixed string,
+    replacement, needed characters, added characters, end-anchored)
+    rules for the fast core."""
+    compiled = []
+    for r, t in rules:
+        literal = __literal(r.pattern)
+        added = frozenset(re.sub(r'\\\d', '', t))
+        if literal is not None and '\\' not in t:
+            compiled.append((literal, t, (frozenset(literal),), added, False))
+            continue
+        needs = __needs.get(r.pattern)
+        if needs is not None:
+            needs = tuple(frozenset(k) for k in needs)
+        compiled.append((r, t, needs, added, r.pattern.endswith('$')))
+    return compiled
+
+
+def __is_whole_string(rule):
+    r, t = rule
+    literal = __literal(r.pattern)
+    return r.pattern in __whole_string or (
+        literal is not None and literal.startswith(' ') and literal.endswith(' '))
+
+
+# the final rules from the first whole-string rule on are all run on the
+# whole string (which is always safe, as that is what _tokenize() does)
+__split = min([i for i, k in enumerate(__final) if __is_whole_string(k)] + [len(__final)])
+__fast_initial = __compile_fast(__initial)
+__fast_repeated = __compile_fast(__repeated)
+__fast_final = __compile_fast(__final[:__split])
+__whole_final = [(k[0], k[1]) for k in __compile_fast(__final[__split:])]
+
+
+def __apply_fast(s, chars, rules, at_end):
+    for r, t, needs, added, anchored in rules:
+        if anchored and not at_end:
+            continue
+        if needs is not None and not any(k <= chars for k in needs):
+            continue
+        if isinstance(r, str):
+            s = s.replace(r, t)
+        else:
+            s = r.sub(t, s)
+        chars |= added
+    return s
 
-    Input will adjusted by removing surrounding space, if any. Arguments
-    hopefully self-explanatory.
+
+def __tokenize_token(s, at_end):
+    """Runs the core up to the whole-string rules on a single token
+    (or any string with initial and terminating space)."""
+    chars = set(s)
+    s = __apply_fast(s, chars, __fast_initial, at_end)
+
+    while True:
+        o = s
+        s = __apply_fast(s, chars, __fast_repeated, at_end)
+        if o == s:
+            break
+
+    return __apply_fast(s, chars, __fast_final, at_end)
+
+
+def _tokenize_fast(s):
+    """Tokenizer core, faster version.
+
+    Gives the same output as _tokenize(), see the comments above for how
+    this is done. Assumes given string has initial and terminating space.
     """
 
-    if DEBUG_GTB_TOKENIZATION:
-        orig = s
+    if len(s) > 1 and s[0] == ' ' and s[-1] == ' ':
+        tokens = s[1:-1].split(' ')
+        # the sentence-final period rule can only match in the last
+        # token, any empty tokens after it being extra spaces
+        last = len(tokens) - 1
+        while last > 0 and len(tokens[last]) == 0:
+            last -= 1
+        for cache in (__token_cache, __last_token_cache):
+            if len(cache) > TOKEN_CACHE_SIZE:
+                cache.clear()
+        for i, t in enumerate(tokens):
+            if len(t) == 0 or (t.isalnum() and i != last):
+                continue
+            cache = __last_token_cache if i == last else __token_cache
+            tokenized = cache.get(t)
+            if tokenized is None:
+                tokenized = __tokenize_token(' ' + t + ' ', i == last)[1:-1]
+                cache[t] = tokenized
+            tokens[i] = tokenized
+        s = ' ' + ' '.join(tokens) + ' '
+    else:
+        s = __tokenize_token(s, True)
 
-    # Core tokenization needs starting and ending space and no newline;
-    # store to return string ending similarly
-    # TODO: this isn't this difficult ... rewrite nicely
-    s = re.sub(r'^', ' ', s)
-    m = re.match(r'^((?:.+|\n)*?) *(\n*)$', s)
-    assert m, "INTERNAL ERROR on '%s'" % s  # should always match
-    s, s_end = m.groups()
-    s = re.sub(r'$', ' ', s)
+    for r, t in __whole_final:
+        if isinstance(r, str):
+            s = s.replace(r, t)
+        else:
+            s = r.sub(t, s)
+
+    return s
 
+
+def __separate_opening_quotes(s, ptb_escaping, use_single_quotes_only):
+    """Separates (and escapes) the opening double quotes before the core
+    tokenization."""
     if ptb_escaping:
         if use_single_quotes_only:
             # special case for McCCJ: escape into single quotes.
-            s = re.sub(r'([ \(\[\{\<])\"', r'\1 ' + "' ", s)
+            return re.sub(r'([ \(\[\{\<])\"', r'\1 ' + "' ", s)
         else:
             # standard PTB quote escaping
-            s = re.sub(r'([ \(\[\{\<])\"', r'\1 `` ', s)
+            return re.sub(r'([ \(\[\{\<])\"', r'\1 `` ', s)
     else:
         # no escaping, just separate
-        s = re.sub(r'([ \(\[\{\<])\"', r'\1 " ', s)
+        return re.sub(r'([ \(\[\{\<])\"', r'\1 " ', s)
 
-    s = _tokenize(s)
 
+def __escape_quotes_and_brackets(s, ptb_escaping, use_single_quotes_only,
+                                 escape_token_internal_parens):
+    """Separates (and escapes) the other double quotes after the core
+    tokenization, and unescapes the brackets the core escaped unless PTB
+    escaping is used."""
     # as above (not quite sure why this is after primary tokenization...)
     if ptb_escaping:
         if use_single_quotes_only:
@@ -266,6 +424,38 @@ def tokenize(s, ptb_escaping=False, use_single_quotes_only=False,
             s = re.sub(r'(?<= )-RSB-(?= )', ']', s)
             s = re.sub(r'(?<= )-LCB-(?= )', '{', s)
             s = re.sub(r'(?<= )-RCB-(?= )', '}', s)
+    return s
+
+
+def tokenize(s, ptb_escaping=False, use_single_quotes_only=False,
+             escape_token_internal_parens=False):
+    """Tokenizes the given string with a GTB-like tokenization.
+
+    Input will adjusted by removing surrounding space, if any. Arguments
+    hopefully self-explanatory.
+    """
+
+    if DEBUG_GTB_TOKENIZATION:
+        orig = s
+
+    # Core tokenization needs starting and ending space and no newline;
+    # store to return string ending similarly
+    # TODO: this isn't this difficult ... rewrite nicely
+    s = re.sub(r'^', ' ', s)
+    m = re.match(r'^((?:.+|\n)*?) *(\n*)$', s)
+    assert m, "INTERNAL ERROR on '%s'" % s  # should always match
+    s, s_end = m.groups()
+    s = re.sub(r'$', ' ', s)
+
+    s = __separate_opening_quotes(s, ptb_escaping, use_single_quotes_only)
+
+    if USE_FAST_TOKENIZATION:
+        s = _tokenize_fast(s)
+    else:
+        s = _tokenize(s)
+
+    s = __escape_quotes_and_brackets(s, ptb_escaping, use_single_quotes_only,
+                                     escape_token_internal_parens)
 
     # Clean up added space (well, maybe other also)
     s = re.sub(r'  +', ' ', s)
@@ -308,6 +498,222 @@ def tokenize(s, ptb_escaping=False, use_single_quotes_only=False,
     return s + s_end
 
 
+# (token, input) substrings the tokenization may replace one another
+# with: brackets and quotes are escaped, and escapes in the input are
+# unescaped unless PTB escaping is used
+SPAN_ESCAPES = [(e, u) for u, e in PTB_ESCAPES] + [(u, e) for u, e in PTB_ESCAPES] + \
+    [('``', '"'), ("''", '"'), ("'", '"')]
+
+
+def __token_end(token, s, i):
+    """Returns the end offset of the given token starting at offset i of
+    the input string s, where the token differs from the input by the
+    escapes in SPAN_ESCAPES."""
+    j = 0
+    while j < len(token):
+        if i < len(s) and s[i] == token[j]:
+            i, j = i + 1, j + 1
+            continue
+        for e, u in SPAN_ESCAPES:
+            if token.startswith(e, j) and s.startswith(u, i):
+                i, j = i + len(u), j + len(e)
+                break
+        else:
+            raise ValueError("cannot find token '%s' at offset %d" % (token, i))
+    return i
+
+
+def __offsets(pieces, s, i, skip_space):
+    """Returns the start and end offsets of the given pieces of the text
+    of s from offset i on, the pieces only differing from the text by the
+    escapes in SPAN_ESCAPES. Consecutive pieces are either adjacent in s
+    or, with skip_space, separated by whitespace."""
+    offsets = []
+    for piece in pieces:
+        while skip_space and s[i].isspace():
+            i += 1
+        offsets.append(i)
+        i = i + len(piece) if s.startswith(piece, i) else __token_end(piece, s, i)
+        offsets.append(i)
+    return offsets
+
+
+# Spans are tracked through the fast core: the core only adds space
+# within the space-separated tokens of its input (and escapes brackets),
+# so the sub-tokens of a token are found in the token once, when it is
+# first tokenized, and their offsets relative to the token are cached
+# with the tokenized token. The input tokens themselves are only split
+# off the input, so the offsets of the output follow by adding the
+# offset of each input token. The later steps only change the few
+# tokens with double quotes or escapes, and the whole-string final
+# rules the few tokens like "cannot" they split.
+__span_cache, __last_span_cache = {}, {}
+__needs_escaping = re.compile(r'["\-\s]')
+
+
+def __core_spans(t, s, i, at_end):
+    """Runs the fast core on a single token t found at offset i of s,
+    returns the tokenized token and the offsets of its sub-tokens in s."""
+    verbatim = s.startswith(t, i)
+    cache = __last_span_cache if at_end else __span_cache
+    cached = cache.get(t) if verbatim else None
+    if cached is None:
+        if t.isalnum() and not at_end:
+            tokenized = t
+        else:
+            tokenized = __tokenize_token(' ' + t + ' ', at_end)[1:-1]
+        offsets = __offsets([k for k in tokenized.split(' ') if len(k) > 0], s, i, False)
+        cached = (tokenized, array('i', [k - i for k in offsets]))
+        if verbatim:
+            cache[t] = cached
+    return cached[0], [k + i for k in cached[1]]
+
+
+def tokenize_spans(s, ptb_escaping=False, use_single_quotes_only=False,
+                   escape_token_internal_parens=False):
+    """Tokenizes the given string like tokenize(), returns the list of
+    tokens and a packed array of their character offsets in s, with the
+    start and end (exclusive) of token k at positions 2*k and 2*k+1.
+
+    The offsets are tracked through the fast core (see the comments
+    above), the tokens are those of tokenize().
+    """
+    for cache in (__span_cache, __last_span_cache):
+        if len(cache) > TOKEN_CACHE_SIZE:
+            cache.clear()
+
+    # The input tokens of the core, with their offsets: tokenize() drops
+    # the trailing space and newlines, and only adds space around opening
+    # quotes before the core. The space added at the end goes before a
+    # final newline left by the match ('$' also matches there)
+    stripped = re.match(r'^((?:.+|\n)*?) *(\n*)$', s).group(1)
+    final_newline = stripped.endswith('\n')
+    words = (stripped[:-1] if final_newline else stripped).split(' ')
+    core_tokens = []
+    i = 0
+    for word in words:
+        if '"' not in word:
+            core_tokens.append((word, i))
+        else:
+            separated = __separate_opening_quotes(' ' + word + ' ', ptb_escaping,
+                                                  use_single_quotes_only)[1:-1].split(' ')
+            offsets = __offsets([k for k in separated if len(k) > 0], s, i, False)
+            starts = iter(offsets[::2])
+            core_tokens.extend([(k, next(starts) if len(k) > 0 else i) for k in separated])
+        i += len(word) + 1
+    if final_newline:
+        core_tokens.append(('\n', len(stripped) - 1))
+    last = len(core_tokens) - 1
+    while last > 0 and len(core_tokens[last][0]) == 0:
+        last -= 1
+
+    tokenized, pieces, offsets = [], [], []
+    for k, (t, i) in enumerate(core_tokens):
+        if len(t) == 0:
+            tokenized.append(t)
+            continue
+        t, t_offsets = __core_spans(t, s, i, k == last)
+        tokenized.append(t)
+        pieces.extend([k for k in t.split(' ') if len(k) > 0])
+        offsets.extend(t_offsets)
+
+    # The whole-string final rules only split some tokens
+    core = ' ' + ' '.join(tokenized) + ' '
+    final = core
+    for r, t in __whole_final:
+        if isinstance(r, str):
+            final = final.replace(r, t)
+        else:
+            final = r.sub(t, final)
+    if final != core:
+        final_pieces, final_offsets = [], []
+        split = iter([k for k in final.split(' ') if len(k) > 0])
+        for k, piece in enumerate(pieces):
+            parts = [next(split)]
+            while sum(map(len, parts)) < len(piece):
+                parts.append(next(split))
+            final_pieces.extend(parts)
+            final_offsets.extend(offsets[2 * k:2 * k + 2] if len(parts) == 1 else
+                                 __offsets(parts, s, offsets[2 * k], False))
+        pieces, offsets = final_pieces, final_offsets
+
+    # Only the tokens with double quotes, escapes or whitespace are
+    # changed by the steps after the core
+    tokens, spans = [], array('i')
+    for k, piece in enumerate(pieces):
+        if __needs_escaping.search(piece) is None:
+            tokens.append(piece)
+            spans.extend(offsets[2 * k:2 * k + 2])
+            continue
+        escaped = __escape_quotes_and_brackets(' ' + piece + ' ', ptb_escaping, use_single_quotes_only,
+                                               escape_token_internal_parens).split()
+        tokens.extend(escaped)
+        spans.extend(__offsets(escaped, s, offsets[2 * k], True))
+    return tokens, spans
+
+
+def _map_chunk(function, chunk):
+    return [function(item) for item in chunk]
+
+
+def imap_bounded(pool, function, items, chunksize, max_chunks):
+    """Like pool.imap(function, items, chunksize), yielding the results in
+    the order of the items, but reading the items lazily: at most
+    max_chunks chunks are submitted ahead of the results consumed, so
+    memory use is bounded by max_chunks * chunksize items and results
+    instead of growing with the input."""
+    items = iter(items)
+    pending = deque()
+    while True:
+        while len(pending) < max_chunks:
+            chunk = list(islice(items, chunksize))
+            if len(chunk) == 0:
+                break
+            pending.append(pool.apply_async(_map_chunk, (function, chunk)))
+        if len(pending) == 0:
+            return
+        for result in pending.popleft().get():
+            yield result
+
+
+def tokenize_batch(texts, jobs=1, chunksize=256, spans=False, **kwargs):
+    """Tokenizes an iterable of texts, yielding the tokenized texts in
+    the order of the input, or (tokens, offsets) pairs as returned by
+    tokenize_spans() if spans is set. With jobs > 1, chunks of chunksize
+    texts are tokenized in a pool of worker processes, reading the input
+    only a few chunks ahead (see imap_bounded). Other keyword arguments
+    are passed to tokenize()."""
+    tokenize_text = partial(tokenize_spans if spans else tokenize, **kwargs)
+    if jobs <= 1:
+        for text in texts:
+            yield tokenize_text(text)
+        return
+    with Pool(jobs) as pool:
+        for tokenized in imap_bounded(pool, tokenize_text, texts, chunksize, 2 * jobs):
+            yield tokenized
+
+
+def check_fast_tokenization(texts, **kwargs):
+    """Tokenizes the given texts with both the fast and the reference
+    core, returns the number of texts and the (text, reference, fast)
+    triples for the texts where the two differ."""
+    global USE_FAST_TOKENIZATION
+    use_fast = USE_FAST_TOKENIZATION
+    n, mismatches = 0, []
+    try:
+        for text in texts:
+            USE_FAST_TOKENIZATION = False
+            reference = tokenize(text, **kwargs)
+            USE_FAST_TOKENIZATION = True
+            fast = tokenize(text, **kwargs)
+            if reference != fast:
+                mismatches.append((text, reference, fast))
+            n += 1
+    finally:
+        USE_FAST_TOKENIZATION = use_fast
+    return n, mismatches
+
+
 def __argparser():
     import argparse
 
@@ -328,6 +734,16 @@ def __argparser():
         default=False,
         action="store_true",
         help="Special processing for Stanford parser+PTBEscapingProcessor input. (not necessary for Stanford Parser version 1.6.5 and newer)")
+    ap.add_argument(
+        "-j",
+        type=int,
+        default=1,
+        help="Number of worker processes to tokenize with")
+    ap.add_argument(
+        "-check",
+        default=False,
+        action="store_true",
+        help="Compare the fast and the reference tokenization on the input instead of tokenizing it")
     ap.add_argument(
         "files",
         metavar="FILE",
@@ -359,16 +775,32 @@ def main(argv):
     if len(arg.files) == 0:
         arg.files.append('/dev/stdin')
 
+    if arg.check:
+        for fn in arg.files:
+            with codecs.open(fn, encoding=INPUT_ENCODING) as f:
+                n, mismatches = check_fast_tokenization(
+                    f,
+                    ptb_escaping=ptb_escaping,
+                    use_single_quotes_only=use_single_quotes_only,
+                    escape_token_internal_parens=escape_token_internal_parens)
+            for text, reference, fast in mismatches:
+                print("MISMATCH:\nTEXT: %r\nREFERENCE: %r\nFAST: %r" % (text, reference, fast), file=sys.stderr)
+            print("%s: %d lines, %d mismatches" % (fn, n, len(mismatches)), file=sys.stderr)
+            if len(mismatches) > 0:
+                return 1
+        return 0
+
+    out = codecs.getwriter(OUTPUT_ENCODING)(sys.stdout.buffer)
     for fn in arg.files:
         try:
             with codecs.open(fn, encoding=INPUT_ENCODING) as f:
-                for l in f:
-                    t = tokenize(
-                        l,
+                for t in tokenize_batch(
+                        f,
+                        jobs=arg.j,
                         ptb_escaping=ptb_escaping,
                         use_single_quotes_only=use_single_quotes_only,
-                        escape_token_internal_parens=escape_token_internal_parens)
-                    sys.stdout.write(t.encode(OUTPUT_ENCODING))
+                        escape_token_internal_parens=escape_token_internal_parens):
+                    out.write(t)
         except Exception as e:
             print("Failed to read", fn, ":", e, file=sys.stderr)
 